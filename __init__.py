@@ -17,31 +17,61 @@ if "bpy" in locals():
 
     imp.reload(addon_updater_ops)
     imp.reload(analytics)
+    imp.reload(animation_manifest)
+    imp.reload(animation_shards)
     imp.reload(config)
+    imp.reload(generated_image)
     imp.reload(handlers)
+    imp.reload(image_encoding)
+    imp.reload(image_pool)
+    imp.reload(headless)
+    imp.reload(http_sessions)
+    imp.reload(native_animation)
     imp.reload(operators)
     imp.reload(preferences)
     imp.reload(progress_bar)
     imp.reload(properties)
+    imp.reload(render_capture)
+    imp.reload(sd_job)
+    imp.reload(server_pool)
+    imp.reload(streaming_json)
     imp.reload(task_queue)
+    imp.reload(temp_store)
     imp.reload(ui_panels)
     imp.reload(ui_preset_styles)
     imp.reload(utils)
+    imp.reload(write_queue)
     imp.reload(automatic1111_api)
+    imp.reload(automatic1111_progress)
     imp.reload(stability_api)
     imp.reload(stablehorde_api)
+    imp.reload(stablehorde_jobs)
 else:
     from . import (
         addon_updater_ops,
         analytics,
+        animation_manifest,
+        animation_shards,
         config,
+        generated_image,
         handlers,
+        image_encoding,
+        image_pool,
+        headless,
+        http_sessions,
+        native_animation,
         operators,
         preferences,
         progress_bar,
         properties,
+        render_capture,
+        sd_job,
+        server_pool,
+        streaming_json,
         task_queue,
+        temp_store,
         utils,
+        write_queue,
     )
     from .ui import (
         ui_panels,
@@ -49,8 +79,10 @@ else:
     )
     from .sd_backends import (
         automatic1111_api,
+        automatic1111_progress,
         stability_api,
         stablehorde_api,
+        stablehorde_jobs,
     )
 
 import bpy
@@ -65,6 +97,7 @@ def register():
     progress_bar.register()
     properties.register()
     task_queue.register()
+    temp_store.register()
     ui_panels.register()
     ui_preset_styles.register()
 
@@ -73,11 +106,15 @@ def unregister():
     addon_updater_ops.unregister()
     analytics.unregister()
     handlers.unregister()
+    http_sessions.unregister()
     operators.unregister()
     preferences.unregister()
     progress_bar.unregister()
     properties.unregister()
     task_queue.unregister()
+    # finish writing any files before the temp files they come from are cleaned up
+    write_queue.unregister()
+    temp_store.unregister()
     ui_panels.unregister()
     ui_preset_styles.unregister()
 
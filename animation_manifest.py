@@ -0,0 +1,124 @@
+import json
+import os
+import time
+from . import (
+    config,
+)
+
+
+# the settings that determine what a frame looks like. a completed frame is only
+# reused when all of these match
+FRAME_PARAM_NAMES = [
+    "backend_name",
+    "prompt",
+    "negative_prompt",
+    "width",
+    "height",
+    "image_similarity",
+    "seed",
+    "cfg_scale",
+    "steps",
+    "sampler",
+    "sd_model",
+    "controlnet_is_enabled",
+    "controlnet_model",
+    "controlnet_module",
+    "controlnet_weight",
+    "do_upscale",
+    "upscale_factor",
+    "upscaler_model",
+]
+
+
+def get_manifest_path(animation_output_path):
+    return os.path.join(animation_output_path, config.animation_manifest_filename)
+
+
+def get_frame_params(job):
+    """Return the settings that determine the output of a frame (a random seed isn't included, since it will be different every time)"""
+    params = {name: getattr(job, name) for name in FRAME_PARAM_NAMES}
+    if job.use_random_seed:
+        del params["seed"]
+    return params
+
+
+def record_frame(job, output_file):
+    """Add a completed frame to the manifest in the animation output path"""
+    add_record(job.animation_output_path, {
+        "frame": job.frame,
+        "status": "completed",
+        "output_file": os.path.basename(output_file),
+        "params": get_frame_params(job),
+        "completed_at": round(time.time()),
+    })
+
+
+def record_failed_frame(animation_output_path, frame, error_message):
+    """Add a failed frame to the manifest, so it can be rendered again later"""
+    add_record(animation_output_path, {
+        "frame": frame,
+        "status": "failed",
+        "error": error_message,
+        "failed_at": round(time.time()),
+    })
+
+
+def add_record(animation_output_path, record):
+    try:
+        with open(get_manifest_path(animation_output_path), "a", encoding="utf-8") as manifest_file:
+            manifest_file.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"AI Render: Couldn't update the animation manifest ({e})")
+
+
+def load_frames(animation_output_path):
+    """Return a dict of frame number to the most recent record for that frame in the manifest"""
+    frames = {}
+
+    try:
+        with open(get_manifest_path(animation_output_path), "r", encoding="utf-8") as manifest_file:
+            for line in manifest_file:
+                try:
+                    record = json.loads(line)
+                    frames[record["frame"]] = record
+                except (ValueError, KeyError, TypeError):
+                    # skip a partial line (e.g. if Blender quit while it was being written)
+                    continue
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"AI Render: Couldn't read the animation manifest ({e})")
+
+    return frames
+
+
+def load_completed_frames(animation_output_path):
+    """Return a dict of frame number to manifest record, for the frames that were completed"""
+    frames = load_frames(animation_output_path)
+    return {frame: record for frame, record in frames.items() if record.get("status", "completed") == "completed"}
+
+
+def load_failed_frames(animation_output_path):
+    """Return a sorted list of the frames that failed (and haven't been completed since)"""
+    frames = load_frames(animation_output_path)
+    return sorted(frame for frame, record in frames.items() if record.get("status") == "failed")
+
+
+def clear(animation_output_path):
+    """Start a new, empty manifest"""
+    try:
+        open(get_manifest_path(animation_output_path), "w", encoding="utf-8").close()
+    except Exception as e:
+        print(f"AI Render: Couldn't reset the animation manifest ({e})")
+
+
+def is_frame_complete(completed_frames, job, animation_output_path):
+    """Return True if the manifest has this frame, with the same settings, and its image still exists"""
+    record = completed_frames.get(job.frame)
+    if not record:
+        return False
+
+    if record.get("params") != json.loads(json.dumps(get_frame_params(job))):
+        return False
+
+    return os.path.isfile(os.path.join(animation_output_path, record.get("output_file", "")))
@@ -0,0 +1,178 @@
+import json
+import os
+import socket
+import time
+import uuid
+from . import (
+    animation_manifest,
+    config,
+    utils,
+)
+
+
+# results of claiming a frame
+CLAIMED = "claimed"
+CLAIMED_ELSEWHERE = "claimed_elsewhere"
+COMPLETED_ELSEWHERE = "completed_elsewhere"
+
+
+def get_claims_dir(animation_output_path):
+    return os.path.join(animation_output_path, config.animation_claims_dirname)
+
+
+def get_claim_path(animation_output_path, frame):
+    return os.path.join(get_claims_dir(animation_output_path), f"frame-{str(frame).zfill(4)}.claim")
+
+
+def get_shard_frames(frames, shard_index, shard_count):
+    """Return every shard_count-th frame, starting at shard_index (so each shard gets an even mix of the whole range)"""
+    return [frame for i, frame in enumerate(frames) if i % shard_count == shard_index]
+
+
+def get_run_path(animation_output_path):
+    return os.path.join(get_claims_dir(animation_output_path), "run.json")
+
+
+def write_json_file(file_path, value):
+    # write to a temp file and rename it into place, so readers never see a partial file
+    temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as json_file:
+        json_file.write(json.dumps(value))
+    os.replace(temp_path, file_path)
+
+
+def read_json_file(file_path):
+    try:
+        with open(file_path, "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def start_run(animation_output_path, is_new_run):
+    """Start a new run of claims, so claims left from earlier renders are ignored, or join the current run (when resuming, or when another instance started the render). Returns the run id"""
+    os.makedirs(get_claims_dir(animation_output_path), exist_ok=True)
+
+    if not is_new_run:
+        run = read_json_file(get_run_path(animation_output_path))
+        if run and run.get("run_id"):
+            return run["run_id"]
+
+    run_id = uuid.uuid4().hex
+    write_json_file(get_run_path(animation_output_path), {"run_id": run_id, "started_at": round(time.time())})
+    return run_id
+
+
+def create_claim(frame, run_id, is_completed=False):
+    return {
+        "frame": frame,
+        "run_id": run_id,
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "claimed_at": round(time.time()),
+        "completed": is_completed,
+    }
+
+
+def is_claim_stale(claim, claim_path, run_id):
+    """Return True if a claim can be taken over: it's from another run, its instance has quit (on this machine), or it's been held longer than the claim timeout"""
+    if claim is None:
+        # a claim that's still being written is only unreadable for a moment
+        try:
+            return time.time() - os.path.getmtime(claim_path) > config.animation_claim_write_timeout
+        except OSError:
+            return True
+
+    if claim.get("run_id") != run_id:
+        return True
+    if claim.get("completed"):
+        return False
+    if claim.get("host") == socket.gethostname() and (claim.get("pid") == os.getpid() or not utils.is_process_running(claim.get("pid", 0))):
+        return True
+    return time.time() - claim.get("claimed_at", 0) > config.animation_claim_timeout
+
+
+def take_over_claim(claim_path, stale_claim):
+    """Move a stale claim out of the way. Returns False if another instance got to it first"""
+    stale_path = f"{claim_path}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(claim_path, stale_path)
+    except OSError:
+        return False
+
+    # if another instance replaced the claim since it was read, put it back
+    is_same_claim = read_json_file(stale_path) == stale_claim
+    if not is_same_claim:
+        try:
+            os.rename(stale_path, claim_path)
+        except OSError:
+            pass
+        return False
+
+    os.remove(stale_path)
+    return True
+
+
+def claim_frame(animation_output_path, frame, run_id):
+    """Atomically claim a frame for this instance. Returns CLAIMED, or CLAIMED_ELSEWHERE if another instance in this run is rendering it, or COMPLETED_ELSEWHERE if another instance has finished it"""
+    os.makedirs(get_claims_dir(animation_output_path), exist_ok=True)
+    claim_path = get_claim_path(animation_output_path, frame)
+
+    for attempt in range(2):
+        try:
+            # O_EXCL makes the create fail if the file exists, so only one instance can win
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            claim = read_json_file(claim_path)
+            if claim and claim.get("run_id") == run_id and claim.get("completed"):
+                return COMPLETED_ELSEWHERE
+            if attempt == 0 and is_claim_stale(claim, claim_path, run_id) and take_over_claim(claim_path, claim):
+                print(f"AI Render: Taking over the stale claim on frame {frame}")
+                continue
+            return CLAIMED_ELSEWHERE
+
+        with os.fdopen(fd, "w", encoding="utf-8") as claim_file:
+            claim_file.write(json.dumps(create_claim(frame, run_id)))
+        return CLAIMED
+
+    return CLAIMED_ELSEWHERE
+
+
+def complete_frame(animation_output_path, frame, run_id):
+    """Mark a claimed frame as done, so other instances in this run skip it (even after this instance quits)"""
+    try:
+        write_json_file(get_claim_path(animation_output_path, frame), create_claim(frame, run_id, is_completed=True))
+    except Exception as e:
+        print(f"AI Render: Couldn't mark the claim on frame {frame} as completed ({e})")
+
+
+def release_frame(animation_output_path, frame):
+    """Give up the claim on a frame, so another instance (or a later render) can take it"""
+    try:
+        os.remove(get_claim_path(animation_output_path, frame))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"AI Render: Couldn't release the claim on frame {frame} ({e})")
+
+
+def find_missing_frames(animation_output_path, frames, filename_prefix, image_format):
+    """Return the frames that don't have an image in the animation output path, or that failed most recently"""
+    failed_frames = set(animation_manifest.load_failed_frames(animation_output_path))
+    return [
+        frame for frame in frames
+        if frame in failed_frames
+        or not os.path.isfile(os.path.join(animation_output_path, utils.get_animation_frame_filename(filename_prefix, frame, image_format)))
+    ]
+
+
+def format_frame_ranges(frames):
+    """Format a list of frames compactly, like "1-10, 15, 20-22\""""
+    ranges = []
+    for frame in sorted(frames):
+        if ranges and frame == ranges[-1][1] + 1:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+
+    return ", ".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
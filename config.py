@@ -13,7 +13,37 @@ filename_template_allowed_vars = [
     "negative_prompt",
 ]
 tmp_path_subfolder = "ai-render-temp"
+temp_store_min_file_age = 600
+write_queue_max_bytes = 512 * 1024 * 1024
 animated_prompts_text_name = "AI Render Animated Prompts"
+animation_manifest_filename = "ai-render-manifest.jsonl"
+animation_claims_dirname = ".ai-render-claims"
+animation_claim_timeout = 60 * 60
+animation_claim_write_timeout = 60
+animation_output_filename_prefix = "ai-render-"
+generated_image_property = "ai_render_generated_image"
+generated_image_viewed_property = "ai_render_viewed_at"
+animation_retry_base_delay = 2
+animation_retry_max_delay = 60
+server_pool_health_check_interval = 15
+server_pool_health_check_timeout = 5
+server_pool_max_consecutive_failures = 3
+http_pool_default_size = 4
+http_pool_extra_connections = 2
+http_pool_max_hosts = 10
+http_download_timeout = 20
+http_download_max_retries = 3
+stablehorde_poll_min_interval = 1
+stablehorde_poll_max_interval = 15
+stablehorde_poll_wait_fraction = 0.5
+stablehorde_poll_jitter = 0.2
+stablehorde_wait_grace_period = 30
+stablehorde_poll_batch_window = 0.5
+stablehorde_submit_retry_interval = 5
+automatic1111_progress_interval = 1
+automatic1111_progress_timeout = 5
+automatic1111_preview_interval = 3
+automatic1111_preview_image_name = "ai-render-preview"
 
 ADDON_DOWNLOAD_URL = "https://blendermarket.com/products/ai-render"
 STABILITY_API_V1_URL = "https://api.stability.ai/v1/generation/"
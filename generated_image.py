@@ -0,0 +1,54 @@
+import io
+import shutil
+from . import (
+    temp_store,
+    utils,
+    write_queue,
+)
+
+
+class GeneratedImage:
+    """An image from Stable Diffusion, held in memory. It's only written to a file when something needs the file. (An image that was downloaded straight to a file has no data in memory, just the file)"""
+
+    def __init__(self, data, image_format, filename_prefix, file_path=""):
+        self.data = data
+        self.image_format = image_format
+        self.filename_prefix = filename_prefix
+        self.file_path = file_path
+
+    def get_data(self):
+        if self.data is not None:
+            return self.data
+        with open(self.file_path, "rb") as file:
+            return file.read()
+
+    def open(self):
+        """Return a file-like object for the image, so it can be sent to an api"""
+        if self.data is None:
+            return open(self.file_path, "rb")
+        image_file = io.BytesIO(self.data)
+        image_file.name = f"{self.filename_prefix}.{self.image_format}"
+        return image_file
+
+    def save(self, file_path):
+        """Write the image to a file (and remember it as the image's file)"""
+        if self.data is None:
+            shutil.copyfile(self.file_path, file_path)
+        else:
+            with open(file_path, "wb") as file:
+                file.write(self.data)
+        self.file_path = file_path
+        return file_path
+
+    def save_later(self, file_path, on_saved=None, on_error=None):
+        """Queue the image to be written to a file in the background. If it already has a file, that's linked or copied instead"""
+        write_queue.add(file_path, data=self.data, source_path=self.file_path, on_done=on_saved, on_error=on_error)
+        return file_path
+
+    def ensure_file(self):
+        """Return the path of a file with this image, writing a temp file if it hasn't been saved anywhere yet"""
+        if self.file_path:
+            temp_store.touch(self.file_path)
+        else:
+            self.save(utils.create_temp_file(self.filename_prefix + "-", suffix=f".{self.image_format}"))
+        return self.file_path
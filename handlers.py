@@ -2,12 +2,17 @@ import bpy
 from bpy.app.handlers import persistent
 import functools
 from . import (
+    config,
+    native_animation,
     operators,
     preferences,
     properties,
+    render_capture,
     task_queue,
+    temp_store,
     utils,
 )
+from .sd_backends import automatic1111_progress
 
 
 @persistent
@@ -47,6 +52,19 @@ def render_init_handler(scene):
     operators.do_pre_render_setup(scene)
 
 
+@persistent
+def render_pre_handler(scene):
+    """Handle a frame about to be rendered"""
+
+    # if AI Render isn't enabled, or the render isn't going to be captured in memory, quit here
+    if not utils.is_installation_valid() or not scene.air_props.is_enabled:
+        return
+    if not utils.get_addon_preferences().use_in_memory_render_capture:
+        return
+
+    render_capture.record_viewer_before_render(scene)
+
+
 @persistent
 def frame_change_pre_handler(scene):
     """Handle frame change"""
@@ -60,6 +78,44 @@ def frame_change_pre_handler(scene):
         scene.air_props.is_rendering_animation = int(scene.air_props.animation_init_frame) != int(scene.frame_current)
 
 
+def should_run_automatically(scene):
+    # return true if AI Render is installed correctly, enabled, set to run automatically,
+    # and has an API Key (if we're using DreamStudio)
+    return (
+        utils.is_installation_valid()
+        and scene.air_props.is_enabled
+        and scene.air_props.auto_run
+        and (utils.get_dream_studio_api_key() or utils.sd_backend() != "dreamstudio")
+    )
+
+
+@persistent
+def render_write_handler(scene):
+    """Handle a rendered frame being written to disk (during a native animation render)"""
+
+    # if we don't want to process native animation renders, quit here
+    if (
+        not should_run_automatically(scene)
+        or not scene.air_props.use_native_animation_render
+        or scene.air_props.is_rendering_animation_manually
+    ):
+        return
+
+    # send the frame to Stable Diffusion (in the background, while blender renders the next one)
+    native_animation.queue_frame(scene)
+
+
+@persistent
+def render_cancel_handler(scene):
+    """Handle a render being canceled"""
+
+    # stop sending new frames of a native animation render, and interrupt the frames that
+    # are still being generated
+    if native_animation.is_running():
+        native_animation.finish(scene, should_cancel_queued_frames=True)
+        automatic1111_progress.cancel()
+
+
 @persistent
 def render_complete_handler(scene):
     """Handle render completed (this is where the API and Stable Diffusion start)"""
@@ -67,12 +123,17 @@ def render_complete_handler(scene):
     # if AI Render wasn't installed correctly, or it isn't enabled, or we don't want
     # to run automatically, or we don't have an API Key (and we're using DreamStudio),
     # quit here
-    if (
-        not utils.is_installation_valid()
-        or not scene.air_props.is_enabled
-        or not scene.air_props.auto_run
-        or (not utils.get_dream_studio_api_key() and utils.sd_backend() == "dreamstudio")
-    ):
+    if not should_run_automatically(scene):
+        return
+
+    # if we sent the frames of a native animation render to Stable Diffusion, finish up
+    # (in background mode, this waits for the remaining frames)
+    if native_animation.is_running():
+        native_animation.finish(scene)
+
+        # track that we're not rendering
+        scene.air_props.is_rendering = False
+        scene.air_props.is_rendering_animation = False
         return
 
     # if we are rendering an animation...
@@ -81,7 +142,7 @@ def render_complete_handler(scene):
         # if we are rendering an animation, but not manually, set a silent error message,
         # just to warn users that this won't work with AI Render
         if scene.air_props.is_rendering_animation and not scene.air_props.is_rendering_animation_manually:
-            operators.set_silent_error(scene, "To render an animation with AI Render, use the \"Render Animation\" button in the Animation panel below")
+            operators.set_silent_error(scene, "To render an animation with AI Render, use the \"Render Animation\" button in the Animation panel below, or turn on \"Process Blender Animation Renders\"")
 
         # track that we're not rendering
         scene.air_props.is_rendering = False
@@ -109,15 +170,36 @@ def render_complete_handler(scene):
     scene.air_props.is_rendering_animation = False
 
 
+@persistent
+def save_pre_handler(filename):
+    """Handle the blend file about to be saved"""
+
+    # remove the packed data from generated images that have been saved to a file, so
+    # they don't bloat the blend file (they'll be loaded from their file instead). temp
+    # files can be evicted or cleaned up, so those images stay packed
+    for img in bpy.data.images:
+        file_path = bpy.path.abspath(img.filepath_raw)
+        if img.get(config.generated_image_property) and img.packed_file and utils.is_file_readable(file_path) and not temp_store.is_in_store(file_path):
+            img.unpack(method='REMOVE')
+
+
 def register():
     bpy.app.handlers.load_post.append(load_post_handler)
+    bpy.app.handlers.save_pre.append(save_pre_handler)
     bpy.app.handlers.render_init.append(render_init_handler)
+    bpy.app.handlers.render_pre.append(render_pre_handler)
     bpy.app.handlers.frame_change_pre.append(frame_change_pre_handler)
+    bpy.app.handlers.render_write.append(render_write_handler)
+    bpy.app.handlers.render_cancel.append(render_cancel_handler)
     bpy.app.handlers.render_complete.append(render_complete_handler)
 
 
 def unregister():
     bpy.app.handlers.load_post.remove(load_post_handler)
+    bpy.app.handlers.save_pre.remove(save_pre_handler)
     bpy.app.handlers.render_init.remove(render_init_handler)
+    bpy.app.handlers.render_pre.remove(render_pre_handler)
     bpy.app.handlers.frame_change_pre.remove(frame_change_pre_handler)
+    bpy.app.handlers.render_write.remove(render_write_handler)
+    bpy.app.handlers.render_cancel.remove(render_cancel_handler)
     bpy.app.handlers.render_complete.remove(render_complete_handler)
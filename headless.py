@@ -0,0 +1,239 @@
+"""Render an animation through Stable Diffusion without any ui (for blender -b on a render farm).
+
+Run it with the ai_render.render_frames_headless operator, e.g.:
+
+    blender -b scene.blend --python-expr "import bpy, sys; sys.exit(0 if bpy.ops.ai_render.render_frames_headless(frame_start=1, frame_end=250) == {'FINISHED'} else 1)"
+
+The frame range, step and number of workers default to the scene's frame range and the
+backend's max frames in flight. To share an animation between several farm nodes, set
+the scene's animation_shard_mode (and shard index and count) first. Progress is printed to stdout as one json object per
+line, prefixed with AIR_PROGRESS.
+"""
+
+import bpy
+import concurrent.futures
+import json
+import time
+import traceback
+from . import (
+    animation_manifest,
+    animation_shards,
+    operators,
+    sd_job,
+    task_queue,
+    utils,
+    write_queue,
+)
+
+
+PROGRESS_PREFIX = "AIR_PROGRESS"
+
+
+def emit(event, **data):
+    """Print a machine-readable progress line"""
+    print(f"{PROGRESS_PREFIX} {json.dumps({'event': event, 'time': round(time.time(), 3), **data})}", flush=True)
+
+
+def get_prompts(scene, animated_prompts, frame):
+    if animated_prompts:
+        positive_lines, negative_lines = animated_prompts
+        return {
+            "prompt": operators.get_prompt_at_frame(positive_lines, frame),
+            "negative_prompt": operators.get_prompt_at_frame(negative_lines, frame),
+        }
+
+    return {
+        "prompt": operators.get_full_prompt(scene),
+        "negative_prompt": scene.air_props.negative_prompt_text.strip(),
+    }
+
+
+def is_frame_complete(scene, completed_frames, animation_output_path, prompts):
+    if not completed_frames:
+        return False
+
+    job = sd_job.create_job(scene, "generate", prompts["prompt"], prompts["negative_prompt"])
+    return animation_manifest.is_frame_complete(completed_frames, job, animation_output_path)
+
+
+def prepare_frame(scene, frame, prompts):
+    """Render a frame and capture its job (in the main thread)"""
+    scene.frame_set(frame)
+    bpy.ops.render.render()
+
+    job = operators.prepare_sd_generate(scene, prompts)
+    if not job:
+        return False
+
+    # there's no ui to show the result in
+    return job.replace(should_view_result=False)
+
+
+def finish_frame(scene, job, result):
+    """Save the result of a frame (in the main thread). Returns an error message, or None if the frame succeeded"""
+    errors = (result.get("errors") if result else None) or []
+    if errors and not result.get("generated_image"):
+        return errors[-1][0]
+
+    with operators.capture_errors() as processing_errors:
+        was_successful = operators.process_sd_generate_result(scene, job, result)
+
+    # errors after the generate step (like a failed upscale) come back with the result
+    errors = errors + processing_errors
+    if was_successful:
+        return None
+    elif errors:
+        return errors[-1][0]
+    else:
+        return "Unknown error"
+
+
+# public methods
+def render_frames(scene, frames, max_workers, lookahead_frames=1):
+    """Render the frames and send them to Stable Diffusion with a pool of worker threads, blocking until they're all done. Returns the number of frames that failed (or -1 if it couldn't start)"""
+    props = scene.air_props
+    animation_output_path = sd_job.get_absolute_dir(props.animation_output_path)
+    should_skip_failed_frames = props.animation_failure_policy == "skip"
+    should_claim_frames = props.animation_shard_mode == "claim"
+
+    # if we're sharing the animation with other instances, only render this shard
+    if props.animation_shard_mode == "index":
+        frames = animation_shards.get_shard_frames(frames, props.animation_shard_index, props.animation_shard_count)
+
+    with operators.capture_errors() as setup_errors:
+        is_valid = operators.validate_params(scene) and operators.validate_animation_output_path(scene)
+        animated_prompts = None
+        if is_valid and props.use_animated_prompts:
+            animated_prompts = operators.validate_and_process_animated_prompt_text(scene)
+            is_valid = bool(animated_prompts[0])
+
+    if not is_valid:
+        emit("error", message=setup_errors[-1][0] if setup_errors else "Couldn't start the render")
+        return -1
+
+    operators.do_pre_render_setup(scene)
+    operators.do_pre_api_setup(scene)
+
+    if props.resume_animation:
+        completed_frames = animation_manifest.load_completed_frames(animation_output_path)
+    else:
+        completed_frames = {}
+        if props.animation_shard_mode == "none":
+            animation_manifest.clear(animation_output_path)
+
+    # claims from earlier renders are ignored, unless we're resuming
+    claim_run_id = animation_shards.start_run(animation_output_path, not props.resume_animation) if should_claim_frames else ""
+
+    emit("start", frames=len(frames), workers=max_workers, backend=utils.sd_backend())
+
+    num_completed = 0
+    num_failed = 0
+    num_skipped = 0
+    num_claimed_elsewhere = 0
+    should_stop = False
+    pending = {}
+
+    def handle_done(done):
+        nonlocal num_completed, num_failed, should_stop
+
+        for future in done:
+            job = pending.pop(future)
+
+            # an unexpected error in the worker fails this frame, not the whole run
+            try:
+                result = future.result()
+            except Exception as e:
+                print("AI Render: Error in background task")
+                traceback.print_exception(type(e), e, e.__traceback__)
+                error_message = f"Error sending the frame to Stable Diffusion: {e}"
+            else:
+                error_message = finish_frame(scene, job, result)
+
+            if error_message is None:
+                num_completed += 1
+                if should_claim_frames:
+                    animation_shards.complete_frame(animation_output_path, job.frame, claim_run_id)
+                emit("frame_complete", frame=job.frame, completed=num_completed, failed=num_failed, total=len(frames))
+            else:
+                num_failed += 1
+                emit("frame_failed", frame=job.frame, error=error_message, completed=num_completed, failed=num_failed, total=len(frames))
+                if should_claim_frames:
+                    animation_shards.release_frame(animation_output_path, job.frame)
+                if should_skip_failed_frames:
+                    animation_manifest.record_failed_frame(animation_output_path, job.frame, error_message)
+                else:
+                    should_stop = True
+
+        # run the callbacks from the writes that have finished (like recording frames in
+        # the manifest). the timer that normally runs them doesn't run in background mode,
+        # so otherwise nothing would be recorded until the end, and a killed job couldn't resume
+        task_queue.execute_queued_functions()
+
+    # NOTE: is_rendering_animation_manually stops the render handlers from sending each
+    # render to Stable Diffusion on their own
+    orig_current_frame = scene.frame_current
+    props.is_rendering_animation_manually = True
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for frame in frames:
+                if should_stop:
+                    break
+
+                prompts = get_prompts(scene, animated_prompts, frame)
+                scene.frame_set(frame)
+                if props.resume_animation and is_frame_complete(scene, completed_frames, animation_output_path, prompts):
+                    num_skipped += 1
+                    emit("frame_skipped", frame=frame)
+                    continue
+
+                claim_result = animation_shards.claim_frame(animation_output_path, frame, claim_run_id) if should_claim_frames else animation_shards.CLAIMED
+                if claim_result == animation_shards.COMPLETED_ELSEWHERE:
+                    num_skipped += 1
+                    emit("frame_skipped", frame=frame)
+                    continue
+                elif claim_result == animation_shards.CLAIMED_ELSEWHERE:
+                    num_claimed_elsewhere += 1
+                    emit("frame_claimed_elsewhere", frame=frame)
+                    continue
+
+                # render the next frame while earlier frames are at the api, but don't get
+                # too far ahead
+                while len(pending) >= max_workers + lookahead_frames:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    handle_done(done)
+
+                emit("frame_render", frame=frame)
+                with operators.capture_errors() as render_errors:
+                    job = prepare_frame(scene, frame, prompts)
+
+                if not job:
+                    num_failed += 1
+                    error_message = render_errors[-1][0] if render_errors else "Couldn't render the frame"
+                    emit("frame_failed", frame=frame, error=error_message, completed=num_completed, failed=num_failed, total=len(frames))
+                    if should_claim_frames:
+                        animation_shards.release_frame(animation_output_path, frame)
+                    if should_skip_failed_frames:
+                        animation_manifest.record_failed_frame(animation_output_path, frame, error_message)
+                        continue
+                    break
+
+                future = executor.submit(operators.send_generate_request_with_retries, job, props.animation_max_retries, False)
+                pending[future] = job
+
+                # process any frames that have finished in the meantime
+                handle_done([future for future in pending if future.done()])
+
+            # wait for the rest of the frames
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                handle_done(done)
+    finally:
+        props.is_rendering_animation_manually = False
+        scene.frame_set(orig_current_frame)
+
+    # make sure every frame is on disk (and in the manifest) before we finish
+    write_queue.flush()
+
+    emit("finish", completed=num_completed, failed=num_failed, skipped=num_skipped, claimed_elsewhere=num_claimed_elsewhere, total=len(frames))
+    return num_failed
@@ -0,0 +1,147 @@
+import requests
+import requests.adapters
+import threading
+from . import (
+    config,
+    streaming_json,
+)
+
+
+# one session per backend (or other user of the network), so connections are kept alive
+# and reused across requests and frames
+sessions = {}
+sessions_lock = threading.Lock()
+
+# connection and request counts from adapters that have been replaced (see get_session)
+retired_stats = {}
+
+
+class Session:
+    def __init__(self, name, pool_size):
+        self.name = name
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.mount_adapter()
+
+    def mount_adapter(self):
+        # pool_block=False means that if more requests than pool_size are in flight, extra
+        # connections are opened (they just aren't kept alive afterwards)
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.http_pool_max_hosts,
+            pool_maxsize=self.pool_size,
+            pool_block=False,
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def resize(self, pool_size):
+        # requests that are in flight keep using the old adapter, so it's not closed here
+        add_stats(retired_stats.setdefault(self.name, {"requests": 0, "connections": 0}), get_adapter_stats(self.adapter))
+        self.pool_size = pool_size
+        self.mount_adapter()
+
+
+def get_adapter_stats(adapter):
+    stats = {"requests": 0, "connections": 0}
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool:
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    return stats
+
+
+def add_stats(total, stats):
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+# public methods
+def get_session(name, pool_size=None):
+    """Return the shared requests session for a backend. If pool_size is given, it's how many connections to keep alive (this should match how many requests can be in flight at once)"""
+    with sessions_lock:
+        session = sessions.get(name)
+        if not session:
+            session = sessions[name] = Session(name, pool_size or config.http_pool_default_size)
+        elif pool_size and pool_size != session.pool_size:
+            session.resize(pool_size)
+        return session.session
+
+
+def get_stats(name):
+    """Return the number of requests sent and connections opened by a backend's session (so requests - connections were sent on a reused connection)"""
+    with sessions_lock:
+        stats = add_stats({"requests": 0, "connections": 0}, retired_stats.get(name, {}))
+        session = sessions.get(name)
+        if session:
+            add_stats(stats, get_adapter_stats(session.adapter))
+            stats["pool_size"] = session.pool_size
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        return stats
+
+
+def get_expected_size(response):
+    """Return the full size of the file being downloaded, or None if the server didn't say (or the body is compressed, so the size won't match)"""
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    if response.status_code == 206:
+        total_size = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total_size) if total_size.isdigit() else None
+    content_length = response.headers.get("Content-Length", "")
+    return int(content_length) if content_length.isdigit() else None
+
+
+def download_file(session, url, file_path, timeout=None, max_retries=None):
+    """Stream a file to disk in chunks. If the transfer is interrupted, it's resumed from where it stopped with a Range request (up to max_retries times). The size is checked against the Content-Length. Returns the number of bytes written"""
+    timeout = timeout or config.http_download_timeout
+    max_retries = config.http_download_max_retries if max_retries is None else max_retries
+
+    num_bytes = 0
+    expected_size = None
+    num_retries = 0
+
+    with open(file_path, "wb") as file:
+        while True:
+            headers = {"Range": f"bytes={num_bytes}-"} if num_bytes else {}
+            try:
+                with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                    response.raise_for_status()
+
+                    # if the server ignored the range, start over
+                    if num_bytes and response.status_code != 206:
+                        file.seek(0)
+                        file.truncate()
+                        num_bytes = 0
+
+                    expected_size = get_expected_size(response) or expected_size
+                    for chunk in response.iter_content(chunk_size=streaming_json.RESPONSE_CHUNK_SIZE):
+                        file.write(chunk)
+                        num_bytes += len(chunk)
+
+                if expected_size is None or num_bytes == expected_size:
+                    return num_bytes
+                if num_bytes > expected_size:
+                    raise ValueError(f"Downloaded {num_bytes} bytes, but expected {expected_size}")
+
+                # the connection closed early without an error
+                raise requests.exceptions.ChunkedEncodingError(f"The download stopped after {num_bytes} of {expected_size} bytes")
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if num_retries >= max_retries:
+                    raise
+                num_retries += 1
+                print(f"WARN: Download of {url} was interrupted after {num_bytes} bytes ({e}). Resuming...")
+
+
+def close_all():
+    with sessions_lock:
+        for session in sessions.values():
+            session.session.close()
+        sessions.clear()
+        retired_stats.clear()
+
+
+def unregister():
+    close_all()
@@ -0,0 +1,48 @@
+import numpy as np
+import struct
+import zlib
+
+
+def linear_to_srgb(values):
+    """Convert linear values (0-1) to sRGB, using the standard sRGB transfer function"""
+    values = np.clip(values, 0.0, 1.0)
+    return np.where(
+        values <= 0.0031308,
+        values * 12.92,
+        1.055 * np.power(values, 1.0 / 2.4) - 0.055,
+    )
+
+
+def unpremultiply(pixels):
+    """Convert premultiplied RGBA float pixels to straight alpha (in place), as PNG expects"""
+    alpha = pixels[..., 3:4]
+    np.divide(pixels[..., :3], alpha, out=pixels[..., :3], where=alpha > 0)
+    return pixels
+
+
+def quantize(pixels):
+    """Convert 0-1 float pixels to 8-bit"""
+    return (np.clip(pixels, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xFFFFFFFF)
+
+
+def encode_png(pixels, compress_level=6):
+    """Encode an (height, width, channels) uint8 array (top row first) as PNG bytes. Channels can be 3 (RGB) or 4 (RGBA)"""
+    height, width, channels = pixels.shape
+    color_type = {3: 2, 4: 6}[channels]
+
+    # each row starts with a filter type byte (0 = no filter)
+    rows = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * channels)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        png_chunk(b"IHDR", header),
+        png_chunk(b"IDAT", zlib.compress(rows.tobytes(), compress_level)),
+        png_chunk(b"IEND", b""),
+    ])
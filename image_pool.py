@@ -0,0 +1,111 @@
+import bpy
+import time
+from . import (
+    config,
+    utils,
+)
+
+
+def get_generated_images():
+    return [img for img in bpy.data.images if img.get(config.generated_image_property)]
+
+
+def get_images_in_view():
+    """Return the images that are open in an image editor (in any window)"""
+    images = set()
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'IMAGE_EDITOR' and area.spaces.active.image:
+                images.add(area.spaces.active.image)
+    return images
+
+
+def get_viewed_time(img):
+    return img.get(config.generated_image_viewed_property, 0)
+
+
+def mark_viewed(img):
+    img[config.generated_image_viewed_property] = time.time()
+
+
+def ensure_file(img):
+    """Make sure a generated image can be loaded again from disk after it's removed from memory. Returns the path of its file"""
+    file_path = bpy.path.abspath(img.filepath_raw)
+    if file_path and utils.is_file_readable(file_path):
+        return file_path
+
+    if not img.packed_file:
+        return ""
+
+    extension = utils.get_extension_from_file_format(img.file_format) or "png"
+    file_path = utils.create_temp_file(utils.sanitize_filename(img.name) + "-", suffix=f".{extension}")
+    with open(file_path, "wb") as file:
+        file.write(img.packed_file.data)
+    return file_path
+
+
+def get_referenced_images(images):
+    """Return the images that are used by other data (like materials, textures or nodes), other than the screens that show them in an image editor"""
+    user_map = bpy.data.user_map(subset=images)
+    return {
+        img for img, users in user_map.items()
+        if any(not isinstance(user, (bpy.types.Screen, bpy.types.WindowManager)) for user in users)
+    }
+
+
+def get_evictable_images():
+    """Return the generated images that can be removed from memory (or reused), least recently viewed first. Images that are open in an image editor, that have a fake user, or that are used by anything else in the file, are kept"""
+    images_in_view = get_images_in_view()
+    images = [img for img in get_generated_images() if img not in images_in_view and not img.use_fake_user]
+    referenced_images = get_referenced_images(images) if images else set()
+    return sorted(
+        [img for img in images if img not in referenced_images],
+        key=get_viewed_time,
+    )
+
+
+def evict(img):
+    file_path = ensure_file(img)
+    print(f"AI Render: Removed the image \"{img.name}\" from memory" + (f" (it's still saved at {file_path})" if file_path else ""))
+    bpy.data.images.remove(img)
+
+
+# public methods
+def get_slot(data_block_name):
+    """Return an image data block to load a generated image into. This is the data block with this name if there is one. Otherwise, if the pool is full, the least recently viewed image is reused (renamed). Otherwise, a new data block is created"""
+    img = bpy.data.images.get(data_block_name)
+    if img:
+        return img
+
+    preferences = utils.get_addon_preferences()
+    if preferences.limit_generated_images:
+        evictable_images = get_evictable_images()
+        num_to_free = len(get_generated_images()) - preferences.max_generated_images + 1
+
+        # remove any extra images (if the limit was lowered), and reuse the next one
+        while num_to_free > 1 and evictable_images:
+            evict(evictable_images.pop(0))
+            num_to_free -= 1
+
+        if num_to_free > 0 and evictable_images:
+            img = evictable_images.pop(0)
+            file_path = ensure_file(img)
+            print(f"AI Render: Reusing the image data block \"{img.name}\" for \"{data_block_name}\"" + (f" (the old image is still saved at {file_path})" if file_path else ""))
+            img.name = data_block_name
+            return img
+
+    img = bpy.data.images.new(data_block_name, 8, 8)
+    img[config.generated_image_property] = True
+    return img
+
+
+def trim():
+    """Remove the least recently viewed generated images until there are no more than the limit in the preferences"""
+    preferences = utils.get_addon_preferences()
+    if not preferences.limit_generated_images:
+        return
+
+    evictable_images = get_evictable_images()
+    num_to_free = len(get_generated_images()) - preferences.max_generated_images
+    for img in evictable_images[:max(num_to_free, 0)]:
+        evict(img)
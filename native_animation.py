@@ -0,0 +1,229 @@
+import bpy
+import concurrent.futures
+import functools
+import random
+import threading
+import time
+import traceback
+from . import (
+    animation_manifest,
+    operators,
+    sd_job,
+    task_queue,
+    utils,
+    write_queue,
+)
+
+
+# private
+state_lock = threading.Lock()
+executor = None
+futures = set()
+is_active = False
+is_valid = False
+num_queued = 0
+num_completed = 0
+num_failed = 0
+num_skipped = 0
+
+
+def start(scene):
+    """Start a new pipeline for a native animation render (the first time a frame is written)"""
+    global executor, is_active, is_valid, num_queued, num_completed, num_failed, num_skipped
+
+    props = scene.air_props
+
+    # a pool of workers, so we don't send more frames at once than the backend can handle
+    # (the rest wait in the pool's queue, without a thread each)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=utils.get_active_backend().max_in_flight_frames())
+    futures.clear()
+    is_active = True
+    is_valid = validate_render(scene)
+    num_queued = 0
+    num_completed = 0
+    num_failed = 0
+    num_skipped = 0
+
+    if is_valid and not props.resume_animation and props.animation_shard_mode == "none":
+        animation_manifest.clear(sd_job.get_absolute_dir(props.animation_output_path))
+
+
+def validate_render(scene):
+    if not operators.validate_animation_output_path(scene):
+        return False
+
+    # the frame blender wrote is sent as-is, so it has to be in a format the backend accepts
+    if scene.render.image_settings.file_format != utils.get_upload_format():
+        return operators.handle_error(f"To send Blender's animation frames to Stable Diffusion, set the render output file format to {utils.get_upload_format()} (the upload format in the add-on preferences)", "native_animation_file_format")
+
+    return True
+
+
+def create_frame_job(scene):
+    """Capture the job for the frame that blender just wrote. This can be called from the render thread, so it only reads Blender data"""
+    props = scene.air_props
+    frame = scene.frame_current
+
+    # get the prompts for this frame
+    if props.use_animated_prompts:
+        prompt, negative_prompt = operators.validate_and_process_animated_prompt_text_for_single_frame(scene, frame)
+        if not prompt:
+            return False
+    else:
+        prompt = operators.get_full_prompt(scene)
+        negative_prompt = props.negative_prompt_text.strip()
+
+    if not operators.validate_params(scene, prompt):
+        return False
+
+    # choose a random seed without changing the scene (the render is still running)
+    seed = random.randint(1000000000, 2147483647) if props.use_random_seed else props.seed
+
+    return sd_job.create_job(
+        scene,
+        "generate",
+        prompt,
+        negative_prompt,
+        seed=seed,
+        input_file=bpy.path.abspath(scene.render.frame_path(frame=frame)),
+        upload_format=scene.render.image_settings.file_format,
+        after_output_filename_prefix=utils.get_image_filename(scene, prompt, negative_prompt, "-2-after"),
+        animation_output_path=sd_job.get_absolute_dir(props.animation_output_path),
+        frame=frame,
+        is_animation_frame=True,
+        should_view_result=False,
+    )
+
+
+def handle_frame_done(on_complete, future):
+    """Hand a frame's result back to the main thread (called from the worker thread when the request is done)"""
+    with state_lock:
+        futures.discard(future)
+
+    if future.cancelled():
+        result = False
+    else:
+        try:
+            result = future.result()
+        except Exception as e:
+            print("AI Render: Error in background task")
+            traceback.print_exception(type(e), e, e.__traceback__)
+            result = False
+
+    task_queue.add(functools.partial(on_complete, result))
+
+
+def on_frame_complete(scene, frame, should_skip_failed_frames, was_successful):
+    global num_completed, num_failed
+
+    with state_lock:
+        if was_successful:
+            num_completed += 1
+        else:
+            num_failed += 1
+
+    if not was_successful and should_skip_failed_frames:
+        animation_manifest.record_failed_frame(sd_job.get_absolute_dir(scene.air_props.animation_output_path), frame, scene.air_props.error_message)
+
+    print(f"AI Render: Frame {frame} {'completed' if was_successful else 'failed'} ({get_progress_summary()})")
+
+    # once blender has finished and every frame is back, make sure they're all on disk
+    if not is_active and num_completed + num_failed == num_queued:
+        write_queue.flush()
+
+
+# public methods
+def queue_frame(scene):
+    """Send the frame that blender just wrote to disk to Stable Diffusion, while blender keeps rendering"""
+    global num_queued, num_skipped
+
+    if not is_active:
+        start(scene)
+
+    # in background mode, the timer that runs the task queue doesn't run during the render.
+    # so save the frames that have come back so far now, instead of holding every result in
+    # memory (and off disk) until the render is done
+    if bpy.app.background:
+        task_queue.execute_queued_functions()
+
+    if not is_valid:
+        return False
+
+    job = create_frame_job(scene)
+    if not job:
+        return False
+
+    # skip frames that are already done (when resuming)
+    if scene.air_props.resume_animation:
+        completed_frames = animation_manifest.load_completed_frames(job.animation_output_path)
+        if animation_manifest.is_frame_complete(completed_frames, job, job.animation_output_path):
+            with state_lock:
+                num_skipped += 1
+            return True
+
+    with state_lock:
+        num_queued += 1
+
+    max_retries = scene.air_props.animation_max_retries
+    should_skip_failed_frames = scene.air_props.animation_failure_policy == "skip"
+
+    future = executor.submit(operators.send_generate_request_with_retries, job, max_retries, not should_skip_failed_frames)
+    with state_lock:
+        futures.add(future)
+    future.add_done_callback(functools.partial(
+        handle_frame_done,
+        functools.partial(
+            operators.finish_sd_generate,
+            scene,
+            job,
+            functools.partial(on_frame_complete, scene, job.frame, should_skip_failed_frames),
+        ),
+    ))
+    return True
+
+
+def wait_for_frames():
+    """Block until every frame has come back and been saved, running the queued functions as they come in (for background mode, where the task queue's timer doesn't run)"""
+    while num_frames_in_flight() > 0:
+        task_queue.execute_queued_functions()
+        time.sleep(0.2)
+
+    executor.shutdown(wait=True)
+    task_queue.execute_queued_functions()
+    write_queue.flush()
+    task_queue.execute_queued_functions()
+
+
+def num_frames_in_flight():
+    with state_lock:
+        return len(futures)
+
+
+def finish(scene, should_cancel_queued_frames=False):
+    """End the pipeline when blender has finished rendering the animation (or the render was canceled, in which case the frames that haven't been sent yet are dropped). In background mode, this waits for the remaining frames, because blender will quit as soon as the render is done"""
+    global is_active
+
+    if not is_active:
+        return
+
+    if should_cancel_queued_frames:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if bpy.app.background:
+        wait_for_frames()
+        print(f"AI Render: Animation finished ({get_progress_summary()})")
+    else:
+        # the pool's workers finish the frames in flight and then exit
+        executor.shutdown(wait=False)
+        print("AI Render: Blender finished rendering the animation. Stable Diffusion will keep processing the remaining frames")
+
+    is_active = False
+
+
+def is_running():
+    return is_active
+
+
+def get_progress_summary():
+    with state_lock:
+        return f"{num_completed + num_failed}/{num_queued} frames done, {num_failed} failed, {num_skipped} skipped"
@@ -1,24 +1,54 @@
 import bpy
+import collections
+import contextlib
 import functools
-import math
+import os
 import random
 import re
+import threading
 import time
 
 from . import (
     analytics,
+    animation_manifest,
+    animation_shards,
     config,
+    headless,
+    image_pool,
     progress_bar,
+    render_capture,
+    sd_job,
+    server_pool,
     task_queue,
+    temp_store,
     utils,
+    write_queue,
 )
 
 from .sd_backends import automatic1111_api
+from .sd_backends import automatic1111_progress
 
 
 example_dimensions_tuple_list = utils.generate_example_dimensions_tuple_list()
 sdxl_1024_dimensions_tuple_list = utils.generate_sdxl_1024_dimensions_tuple_list()
 
+# errors handled while capture_errors() is active are collected here (per thread)
+captured_errors = threading.local()
+
+# the size and encode time of the last upload to each backend (see record_upload_encoding)
+last_upload_encoding = {}
+
+# errors that might go away if the same request is tried again (timeouts, connection
+# errors and server errors, but not errors about the request itself)
+RETRYABLE_ERROR_KEYS = [
+    "timeout",
+    "connection_error",
+    "local_server_not_found",
+    "server_pool_unavailable",
+    "unknown_error_response",
+    "status_check_failed",
+]
+
 
 def enable_air(scene):
     # register the task queue (this also needs to be done post-load,
@@ -39,11 +69,36 @@ def set_image_dimensions(context, width, height):
     clear_error(context.scene)
 
 
+@contextlib.contextmanager
+def capture_errors():
+    """Collect the errors handled in this thread in a list, instead of showing them, until the block ends"""
+    errors = []
+    previous_errors = getattr(captured_errors, "errors", None)
+    captured_errors.errors = errors
+    try:
+        yield errors
+    finally:
+        captured_errors.errors = previous_errors
+
+
 def handle_error(msg, error_key = ''):
     """Show an error popup, and set the error message to be displayed in the ui"""
     print("AI Render Error:", msg)
+
+    # if errors are being captured in this thread, just collect this one
+    errors = getattr(captured_errors, "errors", None)
+    if errors is not None:
+        errors.append((msg, error_key))
+        return False
+
+    # there's no ui to show a popup in, in background mode
+    if bpy.app.background:
+        return False
+
     task_queue.add(functools.partial(bpy.ops.ai_render.show_error_popup, 'INVOKE_DEFAULT', error_message=msg, error_key=error_key))
-    analytics.track_event('ai_render_error', value=error_key)
+    # NOTE: This can be called from a background thread (by the api functions), so
+    # track the event from the main thread
+    task_queue.add(functools.partial(analytics.track_event, 'ai_render_error', value=error_key))
     return False
 
 
@@ -111,88 +166,173 @@ def ensure_animated_prompts_text_editor(context):
 
 
 def render_frame(context, current_frame, prompts):
-    """Render the current frame as part of an animation"""
+    """Render the current frame as part of an animation, and prepare (but don't send) its Stable Diffusion request"""
     # set the frame
     context.scene.frame_set(current_frame)
 
     # render the frame
     bpy.ops.render.render()
 
-    # post to the api
-    return sd_generate(context.scene, prompts)
+    # prepare the api request (this returns the job, or False)
+    return prepare_sd_generate(context.scene, prompts)
+
+
+def capture_render(scene):
+    """Return the rendered image as bytes in the backend's upload format, or None if it has to go through a file instead"""
+    if not utils.get_addon_preferences().use_in_memory_render_capture or utils.get_upload_format() != "PNG":
+        return None
+
+    upload_settings = utils.get_upload_settings()
+    return render_capture.capture_render_png(
+        scene,
+        utils.get_output_width(scene),
+        utils.get_output_height(scene),
+        compress_level=round(upload_settings.png_compression * 9 / 100),
+        include_alpha=not upload_settings.strip_alpha,
+    )
 
 
 def save_render_to_file(scene, filename_prefix):
+    upload_format = utils.get_upload_format()
+    upload_settings = utils.get_upload_settings()
+
     try:
-        temp_file = utils.create_temp_file(filename_prefix + "-", suffix=f".{utils.get_image_format()}")
+        temp_file = utils.create_temp_file(filename_prefix + "-", suffix=f".{utils.get_extension_from_file_format(upload_format)}")
     except:
         return handle_error("Couldn't create temp file for image", "temp_file")
 
-    try:
-        orig_render_file_format = scene.render.image_settings.file_format
-        orig_render_color_mode = scene.render.image_settings.color_mode
-        orig_render_color_depth = scene.render.image_settings.color_depth
+    image_settings = scene.render.image_settings
+    orig_settings = {
+        "file_format": image_settings.file_format,
+        "color_mode": image_settings.color_mode,
+        "color_depth": image_settings.color_depth,
+        "compression": image_settings.compression,
+        "quality": image_settings.quality,
+    }
 
-        scene.render.image_settings.file_format = utils.get_image_format(to_lower=False)
-        scene.render.image_settings.color_mode = 'RGBA'
-        scene.render.image_settings.color_depth = '8'
+    try:
+        image_settings.file_format = upload_format
+        image_settings.color_mode = 'RGB' if upload_settings.strip_alpha or upload_format == "JPEG" else 'RGBA'
+        if upload_format != "JPEG":
+            image_settings.color_depth = '8'
+        image_settings.compression = upload_settings.png_compression
+        image_settings.quality = upload_settings.quality
 
         bpy.data.images['Render Result'].save_render(temp_file)
-
-        scene.render.image_settings.file_format = orig_render_file_format
-        scene.render.image_settings.color_mode = orig_render_color_mode
-        scene.render.image_settings.color_depth = orig_render_color_depth
     except:
-        return handle_error("Couldn't save rendered image", "save_render")
+        return handle_error(f"Couldn't save rendered image as {upload_format}", "save_render")
+    finally:
+        for key, value in orig_settings.items():
+            try:
+                setattr(image_settings, key, value)
+            except:
+                pass
 
     return temp_file
 
 
+def record_upload_encoding(upload_format, num_bytes, encode_time):
+    """Remember how big the last upload to the active backend was, and how long it took to encode"""
+    last_upload_encoding[utils.sd_backend()] = {
+        "format": upload_format,
+        "bytes": num_bytes,
+        "encode_time": encode_time,
+    }
+    print(f"AI Render: Encoded the upload as {upload_format}: {round(num_bytes / 1024)} KB in {round(encode_time * 1000)} ms")
+
+
 def save_before_image(scene, filename_prefix):
     ext = utils.get_extension_from_file_format(scene.render.image_settings.file_format)
     if ext:
         ext = f".{ext}"
     filename = f"{filename_prefix}{ext}"
-    full_path_and_filename = utils.get_absolute_path_for_output_file(scene.air_props.autosave_image_path, filename)
+    full_path_and_filename = bpy.path.abspath(utils.get_absolute_path_for_output_file(scene.air_props.autosave_image_path, filename))
+
+    # save to a local temp file (which is quick), and move it to the autosave path in the background
     try:
-        bpy.data.images['Render Result'].save_render(bpy.path.abspath(full_path_and_filename))
+        temp_file = utils.create_temp_file(filename_prefix + "-", suffix=ext)
+        bpy.data.images['Render Result'].save_render(temp_file)
     except:
-        return handle_error(f"Couldn't save 'before' image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
+        return handle_error(f"Couldn't save 'before' image to {full_path_and_filename}", "save_image")
 
+    write_queue.add(
+        full_path_and_filename,
+        source_path=temp_file,
+        should_move=True,
+        on_error=functools.partial(handle_save_error, f"Couldn't save 'before' image to {full_path_and_filename}"),
+    )
+    return full_path_and_filename
 
-def save_after_image(scene, filename_prefix, img_file):
-    filename = f"{filename_prefix}.{utils.get_image_format()}"
-    full_path_and_filename = utils.get_absolute_path_for_output_file(scene.air_props.autosave_image_path, filename)
-    try:
-        utils.copy_file(img_file, full_path_and_filename)
-        return full_path_and_filename
-    except:
-        return handle_error(f"Couldn't save 'after' image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
 
+def save_after_image(job, filename_prefix, generated_image, on_saved=None):
+    filename = f"{filename_prefix}.{job.image_format}"
+    full_path_and_filename = os.path.join(job.autosave_image_path, filename)
 
-def save_animation_image(scene, filename_prefix, img_file):
-    filename = f"{filename_prefix}{str(scene.frame_current).zfill(4)}.{utils.get_image_format()}"
-    full_path_and_filename = utils.get_absolute_path_for_output_file(scene.air_props.animation_output_path, filename)
-    try:
-        utils.copy_file(img_file, full_path_and_filename)
-        return full_path_and_filename
-    except:
-        return handle_error(f"Couldn't save animation image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
+    # the file is written in the background, so a slow autosave path doesn't hold anything up
+    # (on_saved is called when it's on disk)
+    return generated_image.save_later(
+        full_path_and_filename,
+        on_saved=on_saved,
+        on_error=functools.partial(handle_save_error, f"Couldn't save 'after' image to {full_path_and_filename}"),
+    )
+
+
+def save_animation_image(job, filename_prefix, generated_image, on_saved=None):
+    filename = utils.get_animation_frame_filename(filename_prefix, job.frame, job.image_format)
+    full_path_and_filename = os.path.join(job.animation_output_path, filename)
+
+    # the file is written in the background (on_saved is called when it's on disk)
+    return generated_image.save_later(
+        full_path_and_filename,
+        on_saved=on_saved,
+        on_error=functools.partial(handle_save_error, f"Couldn't save animation image to {full_path_and_filename}"),
+    )
+
+
+def handle_save_error(message, error):
+    return handle_error(f"{message} ({error})", "save_image")
+
+
+def use_saved_file(scene, data_block_name, is_last_generated_image, file_path):
+    """Once a generated image has been saved (in the main thread), point its data block, and the last generated image if it's that one, at the saved file instead of a temp file"""
+    if is_last_generated_image:
+        scene.air_props.last_generated_image_filename = file_path
 
+    img = bpy.data.images.get(data_block_name)
+    if img and img.get(config.generated_image_property) and (not img.filepath_raw or temp_store.is_in_store(bpy.path.abspath(img.filepath_raw))):
+        img.filepath_raw = file_path
 
-def load_image(filename, data_block_name=None):
-    name = filename
-    if data_block_name:
-        name = data_block_name
 
-    if name in bpy.data.images:
-        existing_img = bpy.data.images[name]
-        existing_img.filepath = filename
-        return existing_img
+def use_saved_animation_file(scene, job, data_block_name, is_last_generated_image, file_path):
+    # record the frame in the manifest, so a later render can resume after it
+    animation_manifest.record_frame(job, file_path)
+    use_saved_file(scene, data_block_name, is_last_generated_image, file_path)
 
-    img_file = bpy.data.images.load(filename, check_existing=False)
-    img_file.name = name
-    return img_file
+
+def wait_for_saved_images():
+    """Finish any queued writes, so the last generated image points at its saved file (before it's used as an input)"""
+    write_queue.flush()
+
+
+def load_generated_image(generated_image, data_block_name):
+    """Load a generated image into blender straight from memory, into a data block from the image pool"""
+    # NOTE: Packing the image data lets blender decode it from memory, without writing
+    # or reading a file. The packed data is removed before the blend file is saved, as
+    # long as the image has been saved to a file (see handlers.save_pre_handler)
+    img = image_pool.get_slot(data_block_name)
+    data = generated_image.get_data()
+    img.pack(data=data, data_len=len(data))
+
+    # a new data block starts out as a generated image, but a reused one needs reloading
+    if img.source == 'GENERATED':
+        img.source = 'FILE'
+    else:
+        img.reload()
+
+    img.filepath_raw = generated_image.file_path
+    img[config.generated_image_property] = True
+    image_pool.mark_viewed(img)
+    return img
 
 def do_pre_render_setup(scene):
     # Lock the user interface when rendering, so that we can change
@@ -316,8 +456,17 @@ def validate_and_process_animated_prompt_text_for_single_frame(scene, frame):
         return get_prompt_at_frame(positive_lines, frame), get_prompt_at_frame(negative_lines, frame)
 
 
-def sd_generate(scene, prompts=None, use_last_sd_image=False):
-    """Post to the API to generate a Stable Diffusion image and then process it"""
+def sd_generate(scene, prompts=None, use_last_sd_image=False, on_complete=None):
+    """Prepare a Stable Diffusion request, then post it to the API on a background thread and process the result when it's done"""
+    job = prepare_sd_generate(scene, prompts, use_last_sd_image)
+    if not job:
+        return False
+
+    return send_sd_generate(scene, job, on_complete)
+
+
+def prepare_sd_generate(scene, prompts=None, use_last_sd_image=False):
+    """Validate and capture a Stable Diffusion request (in the main thread), and return its job"""
     props = scene.air_props
 
     # get the prompt if we haven't been given one
@@ -343,24 +492,37 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False):
     # prepare the output filenames
     before_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-1-before")
     after_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-2-after")
-    animation_output_filename_prefix = "ai-render-"
 
     # if we want to use the last SD image, try loading it now
     if use_last_sd_image:
+        wait_for_saved_images()
         if not props.last_generated_image_filename:
             return handle_error("Couldn't find the last Stable Diffusion image", "last_generated_image_filename")
-        try:
-            img_file = open(props.last_generated_image_filename, 'rb')
-        except:
+        input_file = props.last_generated_image_filename
+        input_image_data = b""
+        upload_format = utils.get_image_format(to_lower=False)
+        if not utils.is_file_readable(input_file):
             return handle_error("Couldn't load the last Stable Diffusion image. It's probably been deleted or moved. You'll need to restore it or render a new image.", "load_last_generated_image")
     else:
         # else, use the rendered image...
 
-        # save the rendered image and then read it back in
-        temp_input_file = save_render_to_file(scene, before_output_filename_prefix)
-        if not temp_input_file:
-            return False
-        img_file = open(temp_input_file, 'rb')
+        # capture the rendered image in memory if we can. otherwise, save it to a file (it
+        # will be read back in when the request is sent)
+        upload_format = utils.get_upload_format()
+        encode_start_time = time.monotonic()
+        input_image_data = capture_render(scene) or b""
+        if input_image_data:
+            input_file = ""
+        else:
+            input_file = save_render_to_file(scene, before_output_filename_prefix)
+            if not input_file:
+                return False
+
+        record_upload_encoding(
+            upload_format,
+            len(input_image_data) or os.path.getsize(input_file),
+            time.monotonic() - encode_start_time,
+        )
 
         # autosave the before image, if we want that, and we're not rendering an animation
         if (
@@ -371,98 +533,239 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False):
         ):
             save_before_image(scene, before_output_filename_prefix)
 
-    # prepare data for the API request
-    params = {
-        "prompt": prompt,
-        "negative_prompt": negative_prompt,
-        "width": utils.get_output_width(scene),
-        "height": utils.get_output_height(scene),
-        "image_similarity": props.image_similarity,
-        "seed": props.seed,
-        "cfg_scale": props.cfg_scale,
-        "steps": props.steps,
-        "sampler": props.sampler,
+    # capture everything the request needs, so the scene can change while we wait for it
+    job = sd_job.create_job(
+        scene,
+        "generate",
+        prompt,
+        negative_prompt,
+        input_file=input_file,
+        input_image_data=input_image_data,
+        upload_format=upload_format,
+        before_output_filename_prefix=before_output_filename_prefix,
+        after_output_filename_prefix=after_output_filename_prefix,
+    )
+
+    return job
+
+
+def send_sd_generate(scene, job, on_complete=None, max_retries=0, report_errors=True):
+    """Post a prepared Stable Diffusion request to the API (on a background thread), and process the result when it's done"""
+
+    # send to whichever API we're using (on a different thread, so the UI doesn't freeze)
+    task_queue.add_background(
+        functools.partial(send_generate_request_with_retries, job, max_retries, report_errors),
+        functools.partial(finish_sd_generate, scene, job, on_complete),
+    )
+
+    # return success (the request has been sent)
+    return True
+
+
+def send_generate_request(job):
+    """Send the generate (and optional upscale) request to the API. This runs on a background thread, so it must only use the job, and not any Blender data"""
+    start_time = time.time()
+    generated_image = server_pool.run_request(job, request_generate)
+
+    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
+    if not generated_image:
+        return False
+
+    # if we want to automatically upscale, do it now
+    upscaled_image = None
+    if job.do_upscale:
+        upscaled_image = server_pool.run_request(job, functools.partial(request_upscale, image=generated_image, filename_prefix=job.after_output_filename_prefix + "-upscaled"))
+
+    return {
+        "generated_image": generated_image,
+        "upscaled_image": upscaled_image,
+        "duration": round(time.time() - start_time),
     }
 
-    # get the backend we're using
-    sd_backend = utils.get_active_backend()
 
-    # send to whichever API we're using
+def send_generate_request_with_retries(job, max_retries=0, report_errors=True):
+    """Send the generate request, retrying (with exponential backoff) on errors that might be temporary. If report_errors is False, errors from the last attempt are returned in the result instead of being shown"""
+    attempt = 0
+    while True:
+        with capture_errors() as errors:
+            result = send_generate_request(job)
+
+        # the generate step worked, but any errors after it (like a failed upscale) still
+        # need to be shown
+        if result:
+            if errors and report_errors:
+                show_errors(errors)
+            elif errors:
+                result["errors"] = errors
+            return result
+
+        if attempt >= max_retries or not is_retryable(errors):
+            break
+
+        attempt += 1
+        delay = get_retry_delay(attempt)
+        print(f"AI Render: Retrying frame {job.frame} in {delay:.1f} seconds (retry {attempt} of {max_retries})")
+        time.sleep(delay)
+
+    if not report_errors:
+        return {"errors": errors}
+
+    show_errors(errors)
+    return False
+
+
+def show_errors(errors):
+    for msg, error_key in errors:
+        handle_error(msg, error_key)
+
+
+def is_retryable(errors):
+    return bool(errors) and all(error_key in RETRYABLE_ERROR_KEYS for msg, error_key in errors)
+
+
+def get_retry_delay(attempt):
+    # double the delay for each attempt, and add some jitter so that frames that
+    # failed together don't all retry at the same moment
+    delay = min(config.animation_retry_max_delay, config.animation_retry_base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def send_request(job, request_function):
+    """Send a single request to the API, and time it. This runs on a background thread, so it must only use the job, and not any Blender data"""
     start_time = time.time()
-    generated_image_file = sd_backend.generate(params, img_file, after_output_filename_prefix, props)
+    generated_image = server_pool.run_request(job, request_function)
 
     # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
+    if not generated_image:
         return False
 
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
+    return {
+        "generated_image": generated_image,
+        "duration": round(time.time() - start_time),
+    }
 
-        if not generated_image_file:
-            return False
 
-    # store this image filename as the last generated image
-    props.last_generated_image_filename = generated_image_file
+def request_generate(job):
+    return job.backend.generate(job.generation_params(), job.open_input_file(), job.after_output_filename_prefix, job)
 
-    # if we want to automatically upscale (and the backend supports it), do it now
-    if props.do_upscale_automatically and sd_backend.supports_upscaling() and sd_backend.is_upscaler_model_list_loaded():
-        after_output_filename_prefix = after_output_filename_prefix + "-upscaled"
 
-        opened_image_file = open(generated_image_file, 'rb')
-        generated_image_file = sd_backend.upscale(opened_image_file, after_output_filename_prefix, props)
+def request_upscale(job, filename_prefix, image=None):
+    # upscale the given generated image, or else the job's input file
+    img_file = image.open() if image else job.open_input_file()
+    return job.backend.upscale(img_file, filename_prefix, job)
 
-        # if the upscale failed, stop here (an error will have been handled by the api function)
-        if not generated_image_file:
-            return False
 
-        # autosave the upscaled after image, if we should
-        if utils.should_autosave_after_image(props):
-            generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
+def request_inpaint(job):
+    return job.backend.inpaint(job.inpaint_params(), job.open_input_file(), job.open_mask_file(), job.after_output_filename_prefix, job)
 
-            if not generated_image_file:
-                return False
 
-    # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
+def request_outpaint(job):
+    return job.backend.outpaint(job.outpaint_params(), job.open_input_file(), job.after_output_filename_prefix, job)
+
+
+def finish_sd_generate(scene, job, on_complete, result):
+    """Process the result of a generate request (in the main thread)"""
+    was_successful = process_sd_generate_result(scene, job, result)
+
+    # if the errors weren't shown, put the last one in the ui (without a popup)
+    errors = result.get("errors") if result else None
+    if errors:
+        set_silent_error(scene, *errors[-1])
+
+    if on_complete:
+        on_complete(was_successful)
 
-        if not generated_image_file:
+
+def process_sd_generate_result(scene, job, result):
+    props = scene.air_props
+
+    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
+    if not result or not result.get("generated_image"):
+        return False
+
+    generated_image = result["generated_image"]
+    after_output_filename_prefix = job.after_output_filename_prefix
+
+    # this (not the upscaled version) will be the last generated image. if it's saved
+    # somewhere, the last generated image points at that file once it's written. otherwise,
+    # it's written to a temp file now, since later operations need a file
+    if not job.autosave_image_path and not (job.is_animation_frame and not job.do_upscale):
+        try:
+            props.last_generated_image_filename = generated_image.ensure_file()
+        except:
+            return handle_error("Couldn't write to temp file.", "temp_file_write")
+
+    # autosave the after image, if we should
+    if job.autosave_image_path:
+        save_after_image(
+            job,
+            after_output_filename_prefix,
+            generated_image,
+            on_saved=functools.partial(use_saved_file, scene, after_output_filename_prefix, True),
+        )
+
+    # if we upscaled the image, use the upscaled version from here on
+    if job.do_upscale:
+        after_output_filename_prefix = after_output_filename_prefix + "-upscaled"
+        generated_image = result["upscaled_image"]
+
+        # if the upscale failed, stop here (an error will have been handled by the api function)
+        if not generated_image:
             return False
 
-    # load the image into our scene
-    try:
-        img = load_image(generated_image_file, after_output_filename_prefix)
-    except:
-        return handle_error("Couldn't load the image from Stable Diffusion", "load_sd_image")
+        # autosave the upscaled after image, if we should
+        if job.autosave_image_path:
+            save_after_image(
+                job,
+                after_output_filename_prefix,
+                generated_image,
+                on_saved=functools.partial(use_saved_file, scene, after_output_filename_prefix, False),
+            )
 
-    try:
-        # View the image in the Render Result view
-        utils.view_sd_in_render_view(img, scene)
-    except:
-        return handle_error("Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+    # if we're rendering an animation manually, save the image to the animation output path
+    # (the frame is recorded in the manifest once it's on disk)
+    if job.is_animation_frame:
+        save_animation_image(
+            job,
+            job.animation_output_filename_prefix,
+            generated_image,
+            on_saved=functools.partial(use_saved_animation_file, scene, job, after_output_filename_prefix, not job.do_upscale),
+        )
+
+    # load the image into our scene (unless blender is busy rendering other frames)
+    if job.should_view_result:
+        try:
+            img = load_generated_image(generated_image, after_output_filename_prefix)
+        except:
+            return handle_error("Couldn't load the image from Stable Diffusion", "load_sd_image")
+
+        try:
+            # View the image in the Render Result view
+            utils.view_sd_in_render_view(img, scene)
+        except:
+            return handle_error("Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
 
     # track an analytics event
     additional_params = {
-        "backend": utils.sd_backend(),
-        "model": props.sd_model if sd_backend.supports_choosing_model() else "none",
-        "preset_style": props.preset_style if props.use_preset else "none",
-        "is_animation_frame": "yes" if prompts else "no",
-        "has_animated_prompt": "yes" if props.use_animated_prompts else "no",
-        "upscale_enabled": "yes" if props.do_upscale_automatically else "no",
-        "upscale_factor": props.upscale_factor,
-        "upscaler_model": props.upscaler_model,
-        "duration": round(time.time() - start_time),
+        "backend": job.backend_name,
+        "model": job.sd_model if job.backend.supports_choosing_model() else "none",
+        "preset_style": job.preset_style if job.use_preset else "none",
+        "is_animation_frame": "yes" if job.is_animation_frame else "no",
+        "has_animated_prompt": "yes" if job.use_animated_prompts else "no",
+        "upscale_enabled": "yes" if job.do_upscale_automatically else "no",
+        "upscale_factor": job.upscale_factor,
+        "upscaler_model": job.upscaler_model,
+        "duration": result["duration"],
     }
-    if props.controlnet_is_enabled and utils.sd_backend() == "automatic1111":
+    if job.controlnet_is_enabled and job.backend_name == "automatic1111":
         additional_params["controlnet_enabled"] = "yes"
-        additional_params["controlnet_model"] = props.controlnet_model
-        additional_params["controlnet_module"] = props.controlnet_module
+        additional_params["controlnet_model"] = job.controlnet_model
+        additional_params["controlnet_module"] = job.controlnet_module
     else:
         additional_params["controlnet_enabled"] = "no"
         additional_params["controlnet_model"] = "none"
         additional_params["controlnet_module"] = "none"
-    event_params = analytics.prepare_event('generate_image', generation_params=params, additional_params=additional_params)
+    event_params = analytics.prepare_event('generate_image', generation_params=job.generation_params(), additional_params=additional_params)
     analytics.track_event('generate_image', event_params=event_params)
 
     # return success
@@ -470,42 +773,59 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False):
 
 
 def sd_upscale(scene):
-    """Post to the API to upscale the most recent Stable Diffusion image and then process it"""
+    """Post to the API (on a background thread) to upscale the most recent Stable Diffusion image and then process it"""
     props = scene.air_props
 
     # try loading the last SD image
+    wait_for_saved_images()
     if not props.last_generated_image_filename:
         return handle_error("Couldn't find the last Stable Diffusion image", "last_generated_image_filename")
-    try:
-        img_file = open(props.last_generated_image_filename, 'rb')
-    except:
+    if not utils.is_file_readable(props.last_generated_image_filename):
         return handle_error("Couldn't load the last Stable Diffusion image. It's probably been deleted or moved. You'll need to restore it or render a new image.", "load_last_generated_image")
 
     # create a filename for the after image, based on the before image
     # get the filename from the full path and filename
     after_output_filename_prefix = utils.get_filename_from_path(props.last_generated_image_filename, False) + "-upscaled"
 
-    # get the backend we're using
-    sd_backend = utils.get_active_backend()
+    # capture everything the request needs, so the scene can change while we wait for it
+    job = sd_job.create_job(
+        scene,
+        "upscale",
+        input_file=props.last_generated_image_filename,
+        after_output_filename_prefix=after_output_filename_prefix,
+    )
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.upscale(img_file, after_output_filename_prefix, props)
+    # send to whichever API we're using (on a different thread, so the UI doesn't freeze)
+    task_queue.add_background(
+        functools.partial(send_request, job, functools.partial(request_upscale, filename_prefix=after_output_filename_prefix)),
+        functools.partial(finish_sd_upscale, scene, job),
+    )
+
+    # return success (the request has been sent)
+    return True
+
+
+def finish_sd_upscale(scene, job, result):
+    """Process the result of an upscale request (in the main thread)"""
 
     # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
+    if not result:
         return False
 
-    # autosave the image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
+    generated_image = result["generated_image"]
 
-        if not generated_image_file:
-            return False
+    # autosave the image, if we should
+    if job.autosave_image_path:
+        save_after_image(
+            job,
+            job.after_output_filename_prefix,
+            generated_image,
+            on_saved=functools.partial(use_saved_file, scene, job.after_output_filename_prefix, False),
+        )
 
     # load the image into our scene
     try:
-        img = load_image(generated_image_file, after_output_filename_prefix)
+        img = load_generated_image(generated_image, job.after_output_filename_prefix)
     except:
         return handle_error("Couldn't load the image from Stable Diffusion", "load_sd_image")
 
@@ -517,10 +837,10 @@ def sd_upscale(scene):
 
     # track an analytics event
     additional_params = {
-        "backend": utils.sd_backend(),
-        "upscale_factor": props.upscale_factor,
-        "upscaler_model": props.upscaler_model,
-        "duration": round(time.time() - start_time),
+        "backend": job.backend_name,
+        "upscale_factor": job.upscale_factor,
+        "upscaler_model": job.upscaler_model,
+        "duration": result["duration"],
     }
     event_params = analytics.prepare_event('upscale_image', additional_params=additional_params)
     analytics.track_event('upscale_image', event_params=event_params)
@@ -531,7 +851,7 @@ def sd_upscale(scene):
 
 # Inpainting
 def sd_inpaint(scene):
-    """Post to the API to generate a Stable Diffusion image with inpainting, and then process it"""
+    """Post to the API (on a background thread) to generate a Stable Diffusion image with inpainting, and then process it"""
     props = scene.air_props
 
     # get the prompt if we haven't been given one
@@ -554,84 +874,45 @@ def sd_inpaint(scene):
     # prepare the output filenames
     before_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-1-before")
     after_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-2-inpainted")
-    animation_output_filename_prefix = "ai-render-"
 
     # if we want to use the last SD image, try loading it now
+    wait_for_saved_images()
     if not props.last_generated_image_filename:
         return handle_error("Couldn't find the last Stable Diffusion image", "last_generated_image_filename")
-    try:
-        img_file = open(props.last_generated_image_filename, 'rb')
-    except:
+    if not utils.is_file_readable(props.last_generated_image_filename):
         return handle_error("Couldn't load the last Stable Diffusion image. It's probably been deleted or moved. You'll need to restore it or render a new image.", "load_last_generated_image")
 
-    # load mask here
+    # check the mask here
     if props.inpaint_mask_path == "":
         return handle_error("Couldn't find the Inpaint Mask File", "inpaint_mask_path")
-    try:
-        mask_file = open(props.inpaint_mask_path, 'rb')
-    except:
+    if not utils.is_file_readable(props.inpaint_mask_path):
         return handle_error("Couldn't load the uploaded inpaint mask file", "inpaint_mask_path")
 
-    # prepare data for the API request
-    params = {
-        "prompt": prompt,
-        "negative_prompt": negative_prompt,
-        "width": utils.get_output_width(scene),
-        "height": utils.get_output_height(scene),
-        "seed": props.seed,
-        "cfg_scale": props.cfg_scale,
-        "steps": props.steps,
-        "is_full_res" : props.inpaint_full_res,
-        "full_res_padding" : props.inpaint_padding,
-    }
-
-    # get the backend we're using
-    sd_backend = utils.get_active_backend()
-
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.inpaint(params, img_file, mask_file, after_output_filename_prefix, props)
-
-    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
-        return False
-
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
-
-        if not generated_image_file:
-            return False
-
-    # store this image filename as the last generated image
-    props.last_generated_image_filename = generated_image_file
-
-    # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
-
-        if not generated_image_file:
-            return False
-
-    # load the image into our scene
-    try:
-        img = load_image(generated_image_file, after_output_filename_prefix)
-    except:
-        return handle_error("Couldn't load the image from Stable Diffusion", "load_sd_image")
+    # capture everything the request needs, so the scene can change while we wait for it
+    job = sd_job.create_job(
+        scene,
+        "inpaint",
+        prompt,
+        negative_prompt,
+        input_file=props.last_generated_image_filename,
+        mask_file=props.inpaint_mask_path,
+        before_output_filename_prefix=before_output_filename_prefix,
+        after_output_filename_prefix=after_output_filename_prefix,
+    )
 
-    try:
-        # View the image in the Render Result view
-        utils.view_sd_in_render_view(img, scene)
-    except:
-        return handle_error("Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+    # send to whichever API we're using (on a different thread, so the UI doesn't freeze)
+    task_queue.add_background(
+        functools.partial(send_request, job, request_inpaint),
+        functools.partial(finish_sd_inpaint_or_outpaint, scene, job),
+    )
 
-    # return success
+    # return success (the request has been sent)
     return True
 
 
 # Outpainting
 def sd_outpaint(scene):
-    """Post to the API to generate a Stable Diffusion image with outpainting, and then process it"""
+    """Post to the API (on a background thread) to generate a Stable Diffusion image with outpainting, and then process it"""
     props = scene.air_props
 
     # get the prompt if we haven't been given one
@@ -654,64 +935,65 @@ def sd_outpaint(scene):
     # prepare the output filenames
     before_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-1-before")
     after_output_filename_prefix = utils.get_image_filename(scene, prompt, negative_prompt, "-2-outpainted")
-    animation_output_filename_prefix = "ai-render-"
 
     # if we want to use the last SD image, try loading it now
+    wait_for_saved_images()
     if not props.last_generated_image_filename:
         return handle_error("Couldn't find the last Stable Diffusion image", "last_generated_image_filename")
-    try:
-        img_file = open(props.last_generated_image_filename, 'rb')
-    except:
+    if not utils.is_file_readable(props.last_generated_image_filename):
         return handle_error("Couldn't load the last Stable Diffusion image. It's probably been deleted or moved. You'll need to restore it or render a new image.", "load_last_generated_image")
 
+    # capture everything the request needs, so the scene can change while we wait for it
+    job = sd_job.create_job(
+        scene,
+        "outpaint",
+        prompt,
+        negative_prompt,
+        input_file=props.last_generated_image_filename,
+        before_output_filename_prefix=before_output_filename_prefix,
+        after_output_filename_prefix=after_output_filename_prefix,
+    )
 
-    # prepare data for the API request
-    params = {
-        "prompt": prompt,
-        "negative_prompt": negative_prompt,
-        "width": utils.get_output_width(scene),
-        "height": utils.get_output_height(scene),
-        "seed": props.seed,
-        "cfg_scale": props.cfg_scale,
-        "steps": props.steps,
-        "pixels": props.outpaint_pixels_to_expand,
-        "mask_blur": props.outpaint_mask_blur,
-        "directions": [props.outpaint_direction],
-        "noise_q": props.outpaint_noise_q,
-        "color_variation": props.outpaint_color_variation,
-    }
+    # send to whichever API we're using (on a different thread, so the UI doesn't freeze)
+    task_queue.add_background(
+        functools.partial(send_request, job, request_outpaint),
+        functools.partial(finish_sd_inpaint_or_outpaint, scene, job),
+    )
 
-    # get the backend we're using
-    sd_backend = utils.get_active_backend()
+    # return success (the request has been sent)
+    return True
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.outpaint(params, img_file, after_output_filename_prefix, props)
+
+def finish_sd_inpaint_or_outpaint(scene, job, result):
+    """Process the result of an inpaint or outpaint request (in the main thread)"""
+    props = scene.air_props
 
     # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
+    if not result:
         return False
 
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
+    generated_image = result["generated_image"]
+    on_saved = functools.partial(use_saved_file, scene, job.after_output_filename_prefix, True)
 
-        if not generated_image_file:
-            return False
+    # store this image filename as the last generated image. if it's saved somewhere, that's
+    # done once the file is written. otherwise, it's written to a temp file now
+    if not job.autosave_image_path and not job.is_animation_frame:
+        try:
+            props.last_generated_image_filename = generated_image.ensure_file()
+        except:
+            return handle_error("Couldn't write to temp file.", "temp_file_write")
 
-    # store this image filename as the last generated image
-    props.last_generated_image_filename = generated_image_file
+    # autosave the after image, if we should
+    if job.autosave_image_path:
+        save_after_image(job, job.after_output_filename_prefix, generated_image, on_saved=on_saved)
 
     # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
-
-        if not generated_image_file:
-            return False
+    if job.is_animation_frame:
+        save_animation_image(job, job.animation_output_filename_prefix, generated_image, on_saved=on_saved)
 
     # load the image into our scene
     try:
-        img = load_image(generated_image_file, after_output_filename_prefix)
+        img = load_generated_image(generated_image, job.after_output_filename_prefix)
     except:
         return handle_error("Couldn't load the image from Stable Diffusion", "load_sd_image")
 
@@ -916,6 +1198,62 @@ class AIR_OT_upscale_last_sd_image(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class AnimationFramesInFlight:
+    """The frames of an animation render that have been sent to the api. Their results can come back after the render operator has ended (e.g. when it's canceled), so they're handled here instead of by the operator"""
+
+    def __init__(self, animation_output_path, claim_run_id):
+        self.animation_output_path = animation_output_path
+        self.claim_run_id = claim_run_id
+        self.claimed_frames = set()
+        self.num_in_flight = 0
+        self.results = collections.deque()
+        self.is_cancelled = False
+
+    def claim(self, frame):
+        claim_result = animation_shards.claim_frame(self.animation_output_path, frame, self.claim_run_id)
+        if claim_result == animation_shards.CLAIMED:
+            self.claimed_frames.add(frame)
+        return claim_result
+
+    def release(self, frame):
+        if frame in self.claimed_frames:
+            self.claimed_frames.discard(frame)
+            animation_shards.release_frame(self.animation_output_path, frame)
+
+    def complete(self, frame):
+        if frame in self.claimed_frames:
+            self.claimed_frames.discard(frame)
+            animation_shards.complete_frame(self.animation_output_path, frame, self.claim_run_id)
+
+    def send(self, scene, job, max_retries, report_errors):
+        self.num_in_flight += 1
+        task_queue.add_background(
+            functools.partial(send_generate_request_with_retries, job, max_retries, report_errors),
+            functools.partial(self.finish, scene, job),
+        )
+
+    def finish(self, scene, job, result):
+        # NOTE: This is called in the main thread, when the api request for the frame has
+        # finished. if the render was canceled in the meantime, the result is thrown away
+        self.num_in_flight -= 1
+        if self.is_cancelled:
+            print(f"AI Render: Discarding frame {job.frame}, which finished after the animation render was canceled")
+            self.release(job.frame)
+            return
+
+        finish_sd_generate(scene, job, functools.partial(self.on_frame_complete, scene, job.frame), result)
+
+    def on_frame_complete(self, scene, frame, was_successful):
+        if was_successful:
+            self.complete(frame)
+        else:
+            # give up the claim on the frame, so it can be rendered again
+            self.release(frame)
+
+        # the operator picks up the result on its next tick (if it's still running)
+        self.results.append((frame, was_successful, scene.air_props.error_message))
+
+
 class AIR_OT_render_animation(bpy.types.Operator):
     "Render an animation using Stable Diffusion"
     bl_idname = "ai_render.render_animation"
@@ -924,15 +1262,28 @@ class AIR_OT_render_animation(bpy.types.Operator):
     _timer = None
     _ticks_since_last_render = 0
     _finished = True
-    _start_frame = 0
-    _end_frame = 0
-    _frame_step = 1
-    _current_frame = 0
+    _frames = []
+    _next_frame_index = 0
     _orig_current_frame = 0
     _animated_prompts = None
     _animated_negative_prompts = None
     _static_prompt = None
     _negative_static_prompt = None
+    _lookahead_frames = 0
+    _max_in_flight = 1
+    _rendered_requests = None
+    _frames_in_flight = None
+    _num_completed = 0
+    _num_skipped = 0
+    _num_failed = 0
+    _has_error = False
+    _animation_output_path = ""
+    _completed_frames = None
+    _max_retries = 0
+    _should_skip_failed_frames = False
+    _only_failed_frames = False
+    _should_claim_frames = False
+    _num_claimed_elsewhere = 0
 
     def _pre_render(self, context):
         scene = context.scene
@@ -954,16 +1305,67 @@ class AIR_OT_render_animation(bpy.types.Operator):
             self._static_prompt = get_full_prompt(context.scene)
             self._negative_static_prompt = scene.air_props.negative_prompt_text.strip()
 
+        # get the frames to render
+        self._animation_output_path = sd_job.get_absolute_dir(scene.air_props.animation_output_path)
+        self._frames = self._get_frames_to_render(context)
+        if not self._frames:
+            if self._only_failed_frames:
+                return handle_error("There are no failed frames to render again", "no_failed_frames")
+            return handle_error("There are no frames to render in this shard", "no_frames")
+
         return True
 
+    def _get_frames_to_render(self, context):
+        props = context.scene.air_props
+
+        if self._only_failed_frames:
+            frames = animation_manifest.load_failed_frames(self._animation_output_path)
+        else:
+            frames = list(range(context.scene.frame_start, context.scene.frame_end + 1, context.scene.frame_step))
+
+        # if we're sharing the animation with other instances, only render this shard
+        if props.animation_shard_mode == "index":
+            frames = animation_shards.get_shard_frames(frames, props.animation_shard_index, props.animation_shard_count)
+
+        return frames
+
     def _start_render(self, context):
         self._finished = False
 
         self._orig_current_frame = context.scene.frame_current
-        self._start_frame = context.scene.frame_start
-        self._end_frame = context.scene.frame_end
-        self._frame_step = context.scene.frame_step
-        self._current_frame = context.scene.frame_start
+        self._next_frame_index = 0
+        self._lookahead_frames = context.scene.air_props.animation_lookahead_frames
+        self._max_in_flight = utils.get_active_backend().max_in_flight_frames()
+        self._rendered_requests = collections.deque()
+        self._num_completed = 0
+        self._num_skipped = 0
+        self._num_failed = 0
+        self._has_error = False
+        self._max_retries = context.scene.air_props.animation_max_retries
+        self._should_skip_failed_frames = context.scene.air_props.animation_failure_policy == "skip"
+        self._should_claim_frames = context.scene.air_props.animation_shard_mode == "claim"
+        self._num_claimed_elsewhere = 0
+
+        # claims from earlier renders are ignored, unless we're resuming (or just
+        # re-rendering the frames that failed)
+        claim_run_id = ""
+        if self._should_claim_frames:
+            is_new_run = not context.scene.air_props.resume_animation and not self._only_failed_frames
+            claim_run_id = animation_shards.start_run(self._animation_output_path, is_new_run)
+        self._frames_in_flight = AnimationFramesInFlight(self._animation_output_path, claim_run_id)
+
+        # when resuming, load the frames that have already been completed. otherwise,
+        # start a new manifest (unless we're just re-rendering the frames that failed, or
+        # other instances are sharing the manifest)
+        if self._only_failed_frames:
+            self._completed_frames = {}
+        elif context.scene.air_props.resume_animation:
+            self._completed_frames = animation_manifest.load_completed_frames(self._animation_output_path)
+        else:
+            self._completed_frames = {}
+            if context.scene.air_props.animation_shard_mode == "none":
+                animation_manifest.clear(self._animation_output_path)
+
         context.scene.air_props.is_rendering_animation_manually = True
 
         context.scene.air_progress_status_message = ""
@@ -974,9 +1376,23 @@ class AIR_OT_render_animation(bpy.types.Operator):
         self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
         context.window_manager.modal_handler_add(self)
 
-    def _end_render(self, context, status_message):
+    def _end_render(self, context, status_message, is_cancelled=False):
         self._finished = True
 
+        # frames that are still at the api finish on their own (and are thrown away if the
+        # render was canceled)
+        self._frames_in_flight.is_cancelled = is_cancelled
+        if self._frames_in_flight.num_in_flight:
+            print(f"AI Render: {self._frames_in_flight.num_in_flight} frames are still being generated" + (" (they'll be discarded)" if is_cancelled else ""))
+
+        # make sure every frame is on disk before we say we're done
+        write_queue.flush()
+
+        # forget any rendered frames that were never sent (and give up their claims)
+        for job in self._rendered_requests:
+            self._frames_in_flight.release(job.frame)
+        self._rendered_requests.clear()
+
         context.scene.frame_current = self._orig_current_frame
         context.scene.air_props.is_rendering_animation_manually = False
 
@@ -985,69 +1401,181 @@ class AIR_OT_render_animation(bpy.types.Operator):
 
         context.window_manager.event_timer_remove(self._timer)
 
-    def _advance_frame(self, context):
-        self._current_frame += self._frame_step
-        if self._current_frame > context.scene.frame_end:
-            self._end_render(context, "Animation Render Complete")
+    def _has_frames_to_render(self):
+        return self._next_frame_index < len(self._frames)
+
+    def _can_render_ahead(self):
+        # only render ahead while the number of frames waiting on (or at) the api is
+        # within the look-ahead depth
+        num_pending = len(self._rendered_requests) + self._frames_in_flight.num_in_flight
+        return num_pending < self._max_in_flight + self._lookahead_frames
+
+    def _send_rendered_requests(self, context):
+        while self._rendered_requests and self._frames_in_flight.num_in_flight < self._max_in_flight:
+            job = self._rendered_requests.popleft()
+            self._frames_in_flight.send(context.scene, job, self._max_retries, not self._should_skip_failed_frames)
+
+    def _get_prompts(self, context, frame):
+        if context.scene.air_props.use_animated_prompts:
+            prompt = get_prompt_at_frame(self._animated_prompts, frame)
+            negative_prompt = get_prompt_at_frame(self._animated_negative_prompts, frame)
+        else:
+            prompt = self._static_prompt
+            negative_prompt = self._negative_static_prompt
+
+        return {"prompt": prompt, "negative_prompt": negative_prompt}
+
+    def _is_frame_completed(self, context, frame):
+        # check if the manifest says this frame is already done with the same settings
+        # (the frame has to be set first, in case any settings are animated)
+        if frame not in self._completed_frames:
+            return False
+
+        context.scene.frame_set(frame)
+        prompts = self._get_prompts(context, frame)
+        job = sd_job.create_job(context.scene, "generate", prompts["prompt"], prompts["negative_prompt"])
+        return animation_manifest.is_frame_complete(self._completed_frames, job, self._animation_output_path)
+
+    def _claim_frame(self, frame):
+        if not self._should_claim_frames:
+            return animation_shards.CLAIMED
+        return self._frames_in_flight.claim(frame)
+
+    def _skip_frames(self, context):
+        # skip over frames that were completed in a previous render, or that another
+        # instance has claimed
+        while self._has_frames_to_render():
+            current_frame = self._frames[self._next_frame_index]
+
+            if self._is_frame_completed(context, current_frame):
+                self._num_completed += 1
+                self._num_skipped += 1
+            else:
+                claim_result = self._claim_frame(current_frame)
+                if claim_result == animation_shards.CLAIMED:
+                    return
+                elif claim_result == animation_shards.COMPLETED_ELSEWHERE:
+                    self._num_completed += 1
+                    self._num_skipped += 1
+                else:
+                    self._num_claimed_elsewhere += 1
+
+            self._next_frame_index += 1
+
+    def _render_next_frame(self, context):
+        current_frame = self._frames[self._next_frame_index]
+        self._next_frame_index += 1
+
+        job = render_frame(context, current_frame, self._get_prompts(context, current_frame))
+        if not job:
+            return False
+
+        self._rendered_requests.append(job)
+        return True
+
+    def _process_frame_results(self):
+        # count the frames that have come back from the api since the last tick
+        while self._frames_in_flight.results:
+            frame, was_successful, error_message = self._frames_in_flight.results.popleft()
+            if was_successful:
+                self._num_completed += 1
+            else:
+                self._on_frame_failed(frame, error_message)
+
+    def _on_frame_failed(self, frame, error_message):
+        # give up the claim on the frame, so it can be rendered again
+        self._frames_in_flight.release(frame)
+
+        if not self._should_skip_failed_frames:
+            self._has_error = True
+            return
+
+        # record the failed frame, so it can be rendered again later, and keep going
+        print(f"AI Render: Skipping frame {frame}, which failed: {error_message}")
+        self._num_failed += 1
+        animation_manifest.record_failed_frame(self._animation_output_path, frame, error_message)
 
     def _report_complete(self):
-        print("AI Render animation completed")
-        self.report({'INFO'}, "AI Render animation completed")
+        if self._num_skipped:
+            print(f"AI Render animation completed (skipped {self._num_skipped} frames that were already rendered)")
+        else:
+            print("AI Render animation completed")
+
+        if self._num_claimed_elsewhere:
+            print(f"AI Render: {self._num_claimed_elsewhere} frames were rendered by other instances")
+
+        if self._num_failed:
+            self.report({'WARNING'}, f"AI Render animation completed, but {self._num_failed} frames failed")
+        else:
+            self.report({'INFO'}, "AI Render animation completed")
+
+    def _get_complete_status_message(self):
+        if self._num_failed:
+            return f"Animation Render Complete ({self._num_failed} Failed)"
+        return "Animation Render Complete"
 
     def _get_total_frames(self):
-        return math.floor(((self._end_frame - self._start_frame) / self._frame_step) + 1)
+        return len(self._frames)
 
     def _get_completed_frames(self):
-        return math.floor((self._current_frame - self._start_frame) / self._frame_step)
+        return self._num_completed
 
     def _get_completed_percent(self):
-        return round(self._get_completed_frames() / self._get_total_frames(), 2)
+        return round((self._get_completed_frames() + self._num_failed + self._num_claimed_elsewhere) / self._get_total_frames(), 2)
 
     def _get_label(self):
+        if self._num_failed:
+            return f"AI Render (Frame {self._get_completed_frames()}/{self._get_total_frames()}, {self._num_failed} Failed)"
         return f"AI Render (Frame {self._get_completed_frames()}/{self._get_total_frames()})"
 
     def modal(self, context, event):
         if event.type == 'ESC':
             print("AI Render animation canceled")
             self.report({'INFO'}, "AI Render animation canceled")
-            self._end_render(context, "Animation Render Canceled")
+
+            # stop the frames that are still being generated, too
+            automatic1111_progress.cancel()
+            self._end_render(context, "Animation Render Canceled", is_cancelled=True)
             return {'CANCELLED'}
 
         elif event.type == 'TIMER' and not self._finished:
-            # after each render, wait a few ticks before starting the next one,
-            # to give Blender time to update the UI
-            if self._ticks_since_last_render < 2:
-                self._ticks_since_last_render += 1
-                return {'PASS_THROUGH'}
-            else:
-                self._ticks_since_last_render = 0
-
-            # render the current frame
-            if context.scene.air_props.use_animated_prompts:
-                prompt = get_prompt_at_frame(self._animated_prompts, self._current_frame)
-                negative_prompt = get_prompt_at_frame(self._animated_negative_prompts, self._current_frame)
-            else:
-                prompt = self._static_prompt
-                negative_prompt = self._negative_static_prompt
+            self._process_frame_results()
 
-            was_successful = render_frame(context, self._current_frame, {"prompt": prompt, "negative_prompt": negative_prompt})
-
-            # if the render was successful, advance to the next frame.
-            # otherwise, quit here with an error.
-            if was_successful:
-                self._advance_frame(context)
-            else:
+            # if any frame failed, quit here with an error
+            if self._has_error:
                 print("AI Render animation ended with error")
                 self.report({'INFO'}, "AI Render animation ended with error")
                 self._end_render(context, "Animation Render Error")
                 return {'CANCELLED'}
 
+            # send any rendered frames that are waiting for the api
+            self._send_rendered_requests(context)
+
+            # skip any frames that were completed in a previous render (or that another
+            # instance is rendering)
+            self._skip_frames(context)
+
+            # render the next frame while earlier frames are at the api, as long as we
+            # haven't gotten too far ahead. (after each render, wait a few ticks before
+            # starting the next one, to give Blender time to update the UI)
+            if self._has_frames_to_render() and self._can_render_ahead():
+                if self._ticks_since_last_render < 2:
+                    self._ticks_since_last_render += 1
+                else:
+                    self._ticks_since_last_render = 0
+
+                    if self._render_next_frame(context):
+                        self._send_rendered_requests(context)
+                    else:
+                        self._on_frame_failed(self._frames[self._next_frame_index - 1], context.scene.air_props.error_message or "Couldn't render the frame")
+
             # update the progress bar
             context.scene.air_progress_label = self._get_label()
             context.scene.air_progress = self._get_completed_percent() * 100
 
-            # if we're done, report success and quit. otherwise, pass through
-            if self._finished:
+            # if every frame is done, report success and quit. otherwise, pass through
+            if not self._has_error and not self._has_frames_to_render() and not self._rendered_requests and self._frames_in_flight.num_in_flight == 0:
+                self._end_render(context, self._get_complete_status_message())
                 self._report_complete()
                 return {'FINISHED'}
             else:
@@ -1055,7 +1583,7 @@ class AIR_OT_render_animation(bpy.types.Operator):
 
         elif self._finished:
             self._report_complete()
-            self._end_render(context, "Animation Render Complete")
+            self._end_render(context, self._get_complete_status_message())
             return {'FINISHED'}
 
         return {'RUNNING_MODAL'}
@@ -1068,6 +1596,90 @@ class AIR_OT_render_animation(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
 
+class AIR_OT_render_failed_animation_frames(AIR_OT_render_animation):
+    "Render the animation frames that failed last time (as recorded in the manifest in the animation output path)"
+    bl_idname = "ai_render.render_failed_animation_frames"
+    bl_label = "Re-render Failed Frames"
+
+    _only_failed_frames = True
+
+
+class AIR_OT_verify_animation_frames(bpy.types.Operator):
+    "Check the animation output path for frames that are missing or failed (e.g. after rendering with several instances), and release their claims so they can be rendered again"
+    bl_idname = "ai_render.verify_animation_frames"
+    bl_label = "Verify Frames"
+
+    def execute(self, context):
+        scene = context.scene
+        if not validate_animation_output_path(scene):
+            return {'CANCELLED'}
+
+        animation_output_path = sd_job.get_absolute_dir(scene.air_props.animation_output_path)
+        frames = list(range(scene.frame_start, scene.frame_end + 1, scene.frame_step))
+        missing_frames = animation_shards.find_missing_frames(animation_output_path, frames, config.animation_output_filename_prefix, utils.get_image_format())
+
+        if not missing_frames:
+            self.report({'INFO'}, f"All {len(frames)} frames are complete")
+            return {'FINISHED'}
+
+        # release the claims on the missing frames, so they can be rendered again
+        for frame in missing_frames:
+            animation_shards.release_frame(animation_output_path, frame)
+
+        message = f"{len(missing_frames)} of {len(frames)} frames are missing: {animation_shards.format_frame_ranges(missing_frames)}"
+        print(f"AI Render: {message}")
+        self.report({'WARNING'}, message)
+        return {'FINISHED'}
+
+
+class AIR_OT_render_frames_headless(bpy.types.Operator):
+    "Render an animation using Stable Diffusion without any ui, and wait until it's done. This is for running in background mode (blender -b)"
+    bl_idname = "ai_render.render_frames_headless"
+    bl_label = "Render Frames (Headless)"
+
+    frame_start: bpy.props.IntProperty(
+        name="Start Frame",
+        description="The first frame to render (defaults to the scene's start frame)",
+    )
+    frame_end: bpy.props.IntProperty(
+        name="End Frame",
+        description="The last frame to render (defaults to the scene's end frame)",
+    )
+    frame_step: bpy.props.IntProperty(
+        name="Frame Step",
+        description="The number of frames to advance by (defaults to the scene's frame step)",
+        min=1,
+        default=1,
+    )
+    workers: bpy.props.IntProperty(
+        name="Workers",
+        description="How many Stable Diffusion requests to run at the same time (defaults to the backend's max frames in flight)",
+        min=0,
+        default=0,
+    )
+
+    def execute(self, context):
+        scene = context.scene
+
+        frame_start = self.frame_start if self.properties.is_property_set("frame_start") else scene.frame_start
+        frame_end = self.frame_end if self.properties.is_property_set("frame_end") else scene.frame_end
+        frame_step = self.frame_step if self.properties.is_property_set("frame_step") else scene.frame_step
+        workers = self.workers or utils.get_active_backend().max_in_flight_frames()
+
+        frames = list(range(frame_start, frame_end + 1, frame_step))
+        num_failed = headless.render_frames(scene, frames, workers, scene.air_props.animation_lookahead_frames)
+
+        if num_failed < 0:
+            self.report({'ERROR'}, "AI Render couldn't start rendering the frames")
+            return {'CANCELLED'}
+        elif num_failed > 0:
+            self.report({'ERROR'}, f"AI Render finished, but {num_failed} frames failed")
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "AI Render finished rendering the frames")
+        return {'FINISHED'}
+
+
 class AIR_OT_setup_instructions_popup(bpy.types.Operator):
     "Show the setup instructions in a popup dialog"
     bl_idname = "ai_render.show_setup_instructions_popup"
@@ -1209,6 +1821,70 @@ class AIR_OT_outpaint_from_last_sd_image(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class AIR_OT_add_pool_server(bpy.types.Operator):
+    "Add a Stable Diffusion web server to the server pool"
+    bl_idname = "ai_render.add_pool_server"
+    bl_label = "Add Server"
+
+    def execute(self, context):
+        preferences = utils.get_addon_preferences(context)
+        server = preferences.server_pool.add()
+        server.url = preferences.local_sd_url
+        preferences.server_pool_active_index = len(preferences.server_pool) - 1
+        return {'FINISHED'}
+
+
+class AIR_OT_remove_pool_server(bpy.types.Operator):
+    "Remove the selected server from the server pool"
+    bl_idname = "ai_render.remove_pool_server"
+    bl_label = "Remove Server"
+
+    def execute(self, context):
+        preferences = utils.get_addon_preferences(context)
+        index = preferences.server_pool_active_index
+        if 0 <= index < len(preferences.server_pool):
+            preferences.server_pool.remove(index)
+            preferences.server_pool_active_index = max(0, min(index, len(preferences.server_pool) - 1))
+        return {'FINISHED'}
+
+
+class AIR_OT_check_pool_servers(bpy.types.Operator):
+    "Check which servers in the server pool are responding"
+    bl_idname = "ai_render.check_pool_servers"
+    bl_label = "Check Servers"
+
+    def execute(self, context):
+        urls = [server.url.strip() for server in utils.get_addon_preferences(context).server_pool if server.url.strip()]
+
+        # check the servers in the background, and then redraw the preferences
+        task_queue.add_background(functools.partial(server_pool.check_servers, urls), redraw_preferences)
+        return {'FINISHED'}
+
+
+class AIR_OT_cancel_generation(bpy.types.Operator):
+    "Stop generating the image (the Automatic1111 server is interrupted, and the result is thrown away)"
+    bl_idname = "ai_render.cancel_generation"
+    bl_label = "Cancel Generation"
+
+    @classmethod
+    def poll(cls, context):
+        return automatic1111_progress.is_running()
+
+    def execute(self, context):
+        if not automatic1111_progress.cancel():
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "AI Render: Cancelling the image")
+        return {'FINISHED'}
+
+
+def redraw_preferences(result=None):
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'PREFERENCES':
+                area.tag_redraw()
+
+
 classes = [
     AIR_OT_enable,
     AIR_OT_disable,
@@ -1221,6 +1897,9 @@ classes = [
     AIR_OT_generate_new_image_from_last_sd_image,
     AIR_OT_upscale_last_sd_image,
     AIR_OT_render_animation,
+    AIR_OT_render_failed_animation_frames,
+    AIR_OT_verify_animation_frames,
+    AIR_OT_render_frames_headless,
     AIR_OT_setup_instructions_popup,
     AIR_OT_show_error_popup,
     AIR_OT_automatic1111_load_upscaler_models,
@@ -1229,6 +1908,10 @@ classes = [
     AIR_OT_automatic1111_load_controlnet_models_and_modules,
     AIR_OT_inpaint_from_last_sd_image,
     AIR_OT_outpaint_from_last_sd_image,
+    AIR_OT_add_pool_server,
+    AIR_OT_remove_pool_server,
+    AIR_OT_check_pool_servers,
+    AIR_OT_cancel_generation,
 ]
 
 
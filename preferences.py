@@ -2,10 +2,99 @@ import bpy
 from . import (
     addon_updater_ops,
     config,
+    http_sessions,
+    image_pool,
     operators,
     properties,
+    server_pool,
+    temp_store,
     utils,
 )
+from .sd_backends import stablehorde_jobs
+
+
+def trim_generated_images(self, context):
+    image_pool.trim()
+
+
+class AIRServerPoolEntry(bpy.types.PropertyGroup):
+    url: bpy.props.StringProperty(
+        name="URL",
+        description="The location of a Stable Diffusion web server in the pool",
+        default="http://127.0.0.1:7860",
+    )
+
+    weight: bpy.props.IntProperty(
+        name="Weight",
+        description="How much work to send to this server, relative to the others (give faster servers a higher weight)",
+        default=1,
+        min=1,
+        max=10,
+    )
+
+    max_concurrency: bpy.props.IntProperty(
+        name="Max Requests",
+        description="How many requests can be sent to this server at the same time",
+        default=1,
+        min=1,
+        soft_max=8,
+        max=32,
+    )
+
+    is_enabled: bpy.props.BoolProperty(
+        name="Enabled",
+        description="Send requests to this server",
+        default=True,
+    )
+
+
+class AIRUploadSettings(bpy.types.PropertyGroup):
+    image_format: bpy.props.EnumProperty(
+        name="Upload Format",
+        description="The file format rendered images are uploaded in",
+        default="DEFAULT",
+        items=[
+            ('DEFAULT', 'Backend Default', 'Upload in the same format the backend returns its images in'),
+            ('PNG', 'PNG', 'Lossless and widely supported, but the largest'),
+            ('JPEG', 'JPEG', 'Much smaller, but lossy (and without transparency)'),
+            ('WEBP', 'WebP', 'Smaller than PNG, and lossless at 100% quality (needs Blender 3.4 or newer)'),
+        ],
+    )
+
+    png_compression: bpy.props.IntProperty(
+        name="PNG Compression",
+        description="How much to compress PNG uploads. Higher values make smaller files, but take longer to encode",
+        default=15,
+        min=0,
+        max=100,
+        subtype="PERCENTAGE",
+    )
+
+    quality: bpy.props.IntProperty(
+        name="Quality",
+        description="The quality of JPEG and WebP uploads. For WebP, 100% is lossless",
+        default=95,
+        min=1,
+        max=100,
+        subtype="PERCENTAGE",
+    )
+
+    strip_alpha: bpy.props.BoolProperty(
+        name="Remove Alpha",
+        description="Upload RGB instead of RGBA. Stable Diffusion doesn't use the alpha channel, so this makes uploads smaller",
+        default=False,
+    )
+
+
+class AIR_UL_server_pool(bpy.types.UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align=True)
+        row.prop(item, "is_enabled", text="")
+        row.prop(item, "url", text="", emboss=False)
+        row.prop(item, "weight")
+        row.prop(item, "max_concurrency", text="Max")
+        status_icon = "CHECKMARK" if server_pool.is_server_healthy(item.url) else "ERROR"
+        row.label(text="", icon=status_icon)
 
 
 class AIRPreferences(bpy.types.AddonPreferences):
@@ -62,6 +151,97 @@ class AIRPreferences(bpy.types.AddonPreferences):
         max=3600,
     )
 
+    automatic1111_max_in_flight_frames: bpy.props.IntProperty(
+        name="Max Frames in Flight",
+        description="When rendering an animation, how many frames can be sent to the Automatic1111 server at the same time. Increase this if your server can queue or process several requests at once",
+        default=1,
+        min=1,
+        soft_max=8,
+        max=32,
+    )
+
+    automatic1111_show_progress_preview: bpy.props.BoolProperty(
+        name="Show Preview While Generating",
+        description="While an image is being generated, show the image in progress every few seconds, so a bad result can be spotted before it's finished. This makes the progress checks a little slower",
+        default=False,
+    )
+
+    shark_max_in_flight_frames: bpy.props.IntProperty(
+        name="Max Frames in Flight",
+        description="When rendering an animation, how many frames can be sent to the SHARK server at the same time. Increase this if your server has spare capacity",
+        default=1,
+        min=1,
+        soft_max=8,
+        max=32,
+    )
+
+    stablehorde_max_in_flight_frames: bpy.props.IntProperty(
+        name="Max Frames in Flight",
+        description="When rendering an animation, how many frames can be submitted to Stable Horde at the same time. The horde processes them in parallel on different workers. If this is more than your account is allowed to have queued at once, extra frames wait until earlier ones finish",
+        default=1,
+        min=1,
+        soft_max=10,
+        max=50,
+    )
+
+    use_server_pool: bpy.props.BoolProperty(
+        name="Use a Pool of Servers",
+        description="Spread requests across several Stable Diffusion web servers, instead of just the one at the Local Web Server URL. Servers that stop responding are skipped until they're working again",
+        default=False,
+    )
+
+    server_pool: bpy.props.CollectionProperty(
+        type=AIRServerPoolEntry,
+    )
+
+    server_pool_active_index: bpy.props.IntProperty(
+        name="Active Server",
+        default=0,
+    )
+
+    use_in_memory_render_capture: bpy.props.BoolProperty(
+        name="Capture Renders in Memory",
+        description="Send the rendered image straight from memory, instead of saving it to a temp file and reading it back. This is only used when the render can be read from python and uses the Standard view transform. Otherwise, AI Render saves a temp file as usual",
+        default=True,
+    )
+
+    dreamstudio_upload_settings: bpy.props.PointerProperty(type=AIRUploadSettings)
+    stablehorde_upload_settings: bpy.props.PointerProperty(type=AIRUploadSettings)
+    automatic1111_upload_settings: bpy.props.PointerProperty(type=AIRUploadSettings)
+    shark_upload_settings: bpy.props.PointerProperty(type=AIRUploadSettings)
+
+    limit_generated_images: bpy.props.BoolProperty(
+        name="Limit Images in Memory",
+        description="Only keep the newest generated images in memory. Older ones are removed (or their data blocks reused), but stay saved on disk",
+        default=True,
+        update=trim_generated_images,
+    )
+
+    max_generated_images: bpy.props.IntProperty(
+        name="Max Images",
+        description="How many generated images to keep in memory",
+        default=10,
+        min=1,
+        soft_max=50,
+        update=trim_generated_images,
+    )
+
+    http_pool_size: bpy.props.IntProperty(
+        name="Connections to Keep Open",
+        description="How many connections to the Stable Diffusion server are kept open and reused. 0 matches the max animation frames in flight",
+        default=0,
+        min=0,
+        soft_max=16,
+        max=64,
+    )
+
+    temp_store_max_size: bpy.props.IntProperty(
+        name="Max Temp Image Storage (MB)",
+        description="The most disk space AI Render's temp images can use. When it's full, the least recently used images are deleted (except the last generated image and images that are loaded in Blender)",
+        default=1024,
+        min=64,
+    )
+
     is_opted_out_of_analytics: bpy.props.BoolProperty(
         name="Opt out of analytics",
         description="If this is checked, the add-on will not send or store any analytics data",
@@ -154,6 +334,12 @@ class AIRPreferences(bpy.types.AddonPreferences):
                 row = box.row()
                 row.prop(self, "stable_horde_api_key")
 
+                row = box.row()
+                col = row.column()
+                col.label(text="Max Animation Frames in Flight:")
+                col = row.column()
+                col.prop(self, "stablehorde_max_in_flight_frames", text="")
+
             # Local Installation with Automatic1111
             if self.sd_backend == "automatic1111":
                 box = layout.box()
@@ -176,6 +362,18 @@ class AIRPreferences(bpy.types.AddonPreferences):
                 col = row.column()
                 col.prop(self, "local_sd_timeout", text="")
 
+                row = box.row()
+                col = row.column()
+                col.label(text="Max Animation Frames in Flight:")
+                col = row.column()
+                col.prop(self, "automatic1111_max_in_flight_frames", text="")
+                col.enabled = not self.use_server_pool
+
+                row = box.row()
+                row.prop(self, "automatic1111_show_progress_preview")
+
+                draw_server_pool(self, box, width_guess)
+
                 box.separator()
                 utils.label_multiline(box, text=f"AI Render will use your local Stable Diffusion installation. Please make sure the Web UI is launched and running in a terminal.", icon="KEYTYPE_BREAKDOWN_VEC", width=width_guess)
 
@@ -206,6 +404,15 @@ class AIRPreferences(bpy.types.AddonPreferences):
                 col = row.column()
                 col.prop(self, "local_sd_timeout", text="")
 
+                row = box.row()
+                col = row.column()
+                col.label(text="Max Animation Frames in Flight:")
+                col = row.column()
+                col.prop(self, "shark_max_in_flight_frames", text="")
+                col.enabled = not self.use_server_pool
+
+                draw_server_pool(self, box, width_guess)
+
                 box.separator()
                 utils.label_multiline(box, text=f"AI Render will use your local Stable Diffusion installation. Please make sure the Web UI is launched and running in a terminal.", icon="KEYTYPE_BREAKDOWN_VEC", width=width_guess)
 
@@ -220,6 +427,35 @@ class AIRPreferences(bpy.types.AddonPreferences):
 
             utils.label_multiline(box, text="AI image generation is an incredible technology, and it's only in its infancy. Please use it responsibly and ethically.", width=width_guess)
 
+            box = layout.box()
+            box.label(text="Performance:")
+            row = box.row()
+            row.prop(self, "use_in_memory_render_capture")
+            row = box.row()
+            row.prop(self, "limit_generated_images")
+            col = row.column()
+            col.prop(self, "max_generated_images")
+            col.enabled = self.limit_generated_images
+            row = box.row()
+            row.prop(self, "temp_store_max_size")
+            row = box.row()
+            row.prop(self, "http_pool_size")
+
+            http_stats = http_sessions.get_stats(self.sd_backend)
+            row = box.row()
+            row.label(text=f"Connections: {http_stats['requests']} requests on {http_stats['connections']} connections ({http_stats['reused']} reused)")
+
+            if self.sd_backend == "stablehorde":
+                horde_stats = stablehorde_jobs.get_stats()
+                row = box.row()
+                row.label(text=f"Status checks: {horde_stats['polls']} for {horde_stats['jobs']} images ({round(horde_stats['seconds'])}s waiting)")
+
+            temp_store_stats = temp_store.get_stats()
+            row = box.row()
+            row.label(text=f"Temp images: {temp_store_stats['files']} files, {round(temp_store_stats['bytes'] / (1024 * 1024))} MB ({temp_store_stats['hits']} reused, {temp_store_stats['evictions']} evicted)")
+
+            draw_upload_settings(self, box)
+
             box = layout.box()
             box.label(text="Analytics:")
             utils.label_multiline(box, text="AI Render sends anonymous meta information to Google Analytics, to help improve the add-on. No prompt text or images are sent or stored in any way.", width=width_guess)
@@ -231,6 +467,32 @@ class AIRPreferences(bpy.types.AddonPreferences):
             addon_updater_ops.update_settings_ui_condensed(self, context, box)
 
 
+def draw_server_pool(preferences, box, width_guess):
+    box.separator()
+    row = box.row()
+    row.prop(preferences, "use_server_pool")
+
+    if not preferences.use_server_pool:
+        return
+
+    utils.label_multiline(box, text="Requests will be spread across these servers (instead of the Local Web Server URL above). When rendering an animation, each server can work on up to its max number of frames at once.", width=width_guess)
+
+    row = box.row()
+    row.template_list("AIR_UL_server_pool", "", preferences, "server_pool", preferences, "server_pool_active_index", rows=3)
+
+    col = row.column(align=True)
+    col.operator(operators.AIR_OT_add_pool_server.bl_idname, text="", icon="ADD")
+    col.operator(operators.AIR_OT_remove_pool_server.bl_idname, text="", icon="REMOVE")
+
+    if 0 <= preferences.server_pool_active_index < len(preferences.server_pool):
+        active_server = preferences.server_pool[preferences.server_pool_active_index]
+        row = box.row()
+        row.label(text=f"Status: {server_pool.get_server_status(active_server.url)}")
+
+    row = box.row()
+    row.operator(operators.AIR_OT_check_pool_servers.bl_idname, icon="FILE_REFRESH")
+
+
 def update_sd_backend_from_previous_installation(context):
     preferences = utils.get_addon_preferences(context)
     if preferences.is_local_sd_enabled:
@@ -238,7 +500,39 @@ def update_sd_backend_from_previous_installation(context):
         preferences.is_local_sd_enabled = False
 
 
+def draw_upload_settings(preferences, box):
+    upload_settings = getattr(preferences, f"{preferences.sd_backend}_upload_settings")
+    upload_format = utils.get_upload_format()
+
+    box.separator()
+    row = box.row()
+    row.label(text=f"Uploads to {utils.sd_backend_formatted_name()}:")
+
+    row = box.row()
+    row.prop(upload_settings, "image_format")
+
+    if upload_format == "PNG":
+        row = box.row()
+        row.prop(upload_settings, "png_compression")
+    else:
+        row = box.row()
+        row.prop(upload_settings, "quality")
+
+    row = box.row()
+    row.prop(upload_settings, "strip_alpha")
+    row.enabled = upload_format != "JPEG"
+
+    # show what the last upload cost, so the settings can be compared
+    last_upload = operators.last_upload_encoding.get(preferences.sd_backend)
+    if last_upload:
+        row = box.row()
+        row.label(text=f"Last upload: {last_upload['format']}, {round(last_upload['bytes'] / 1024)} KB, encoded in {round(last_upload['encode_time'] * 1000)} ms")
+
+
 classes = [
+    AIRServerPoolEntry,
+    AIRUploadSettings,
+    AIR_UL_server_pool,
     AIRPreferences,
 ]
 
@@ -74,6 +74,12 @@ def register():
         update=tag_image_editor_areas_for_redraw,
     )
 
+    # show a button to cancel the request, when it can be cancelled
+    bpy.types.Scene.air_progress_can_cancel = bpy.props.BoolProperty(
+        default=False,
+        update=tag_image_editor_areas_for_redraw,
+    )
+
     # save the original draw method of the Info header
     global info_header_draw
     info_header_draw = bpy.types.IMAGE_HT_tool_header.draw
@@ -101,6 +107,9 @@ def register():
                 slider=True,
             )
 
+            if context.scene.air_progress_can_cancel:
+                self.layout.operator("ai_render.cancel_generation", text="", icon="CANCEL")
+
     # replace the draw function
     bpy.types.IMAGE_HT_tool_header.draw = newdraw
 
@@ -112,3 +121,4 @@ def unregister():
     del bpy.types.Scene.air_progress
     del bpy.types.Scene.air_progress_label
     del bpy.types.Scene.air_progress_status_message
+    del bpy.types.Scene.air_progress_can_cancel
@@ -232,6 +232,63 @@ class AIRProperties(bpy.types.PropertyGroup):
         description="The path to save the animation",
         subtype="DIR_PATH",
     )
+    animation_lookahead_frames: bpy.props.IntProperty(
+        name="Look-ahead Frames",
+        default=1,
+        min=0,
+        soft_max=4,
+        max=16,
+        description="How many frames Blender can render ahead while earlier frames are still being processed by Stable Diffusion. Rendering and Stable Diffusion then run at the same time. Set to 0 to render and process one frame at a time",
+    )
+    animation_max_retries: bpy.props.IntProperty(
+        name="Retries",
+        default=2,
+        min=0,
+        soft_max=5,
+        max=10,
+        description="How many times to retry a frame when Stable Diffusion fails with an error that might be temporary (like a timeout). Each retry waits longer than the last",
+    )
+    animation_failure_policy: bpy.props.EnumProperty(
+        name="If a Frame Fails",
+        default="stop",
+        items=[
+            ("stop", "Stop the Animation", "Stop rendering the animation when a frame fails"),
+            ("skip", "Skip the Frame", "Skip a frame that fails and keep rendering the rest of the animation. Failed frames can be rendered again afterwards"),
+        ],
+        description="What to do when a frame still fails after all its retries",
+    )
+    use_native_animation_render: bpy.props.BoolProperty(
+        name="Process Blender Animation Renders",
+        default=False,
+        description="When you render an animation with Blender's own Render Animation (or from the command line with blender -b -a), send each frame to Stable Diffusion as soon as it's written. Blender keeps rendering the next frames while Stable Diffusion works. The render output file format must match the Stable Diffusion backend (PNG)",
+    )
+    animation_shard_mode: bpy.props.EnumProperty(
+        name="Sharing Frames",
+        default="none",
+        items=[
+            ("none", "Off", "This is the only instance of Blender rendering the animation"),
+            ("index", "Shard Index/Count", "Render a fixed share of the frames: every Nth frame, where N is the shard count, starting at the shard index. Give each instance a different shard index"),
+            ("claim", "Claim Frames", "Each instance claims the next frame that no other instance has claimed (with lock files in the animation output path), so no frame is generated twice. Start the first instance as usual, and the others with Resume on, so they join its render. Claims from instances that have quit are taken over"),
+        ],
+        description="How to share the frames of the animation with other instances of Blender (on this machine or others) that are rendering to the same animation output path",
+    )
+    animation_shard_index: bpy.props.IntProperty(
+        name="Shard Index",
+        default=0,
+        min=0,
+        description="Which share of the frames this instance renders (from 0 to the shard count minus 1)",
+    )
+    animation_shard_count: bpy.props.IntProperty(
+        name="Shard Count",
+        default=1,
+        min=1,
+        description="How many instances are sharing the animation",
+    )
+    resume_animation: bpy.props.BoolProperty(
+        name="Resume",
+        default=False,
+        description="Skip frames that have already been rendered to the animation output path with the same settings (as recorded in the manifest file there). Turn this off to render every frame again",
+    )
     animation_init_frame: bpy.props.IntProperty(
         name="Initial Animtion Frame",
         default=1,
@@ -0,0 +1,164 @@
+import bpy
+import hashlib
+import numpy as np
+import os
+from . import (
+    image_encoding,
+)
+
+# blender ships with OpenColorIO's python bindings (in recent versions), which lets us
+# apply view transforms other than Standard ourselves
+try:
+    import PyOpenColorIO as OCIO
+except ImportError:
+    OCIO = None
+
+
+# cpu processors for each (display device, view transform), since they're slow to create
+ocio_processors = {}
+
+# a signature of the viewer node's pixels from just before the last render started (b"" if
+# it had none, or None if it wasn't recorded). the viewer keeps the pixels of the last
+# composite, so they're only used if this render changed them
+viewer_signature_before_render = None
+
+
+def find_composite_viewer(scene):
+    """Return the compositor's active viewer node, if it shows exactly what the composite output gets (and the compositor runs when rendering)"""
+    if not scene.render.use_compositing or not scene.use_nodes or not scene.node_tree:
+        return None
+
+    nodes = scene.node_tree.nodes
+    composite_node = next((node for node in nodes if node.type == 'COMPOSITE' and not node.mute), None)
+    viewer_node = nodes.active if nodes.active and nodes.active.type == 'VIEWER' else None
+    if not composite_node or not viewer_node or viewer_node.mute:
+        return None
+
+    composite_links = composite_node.inputs[0].links
+    viewer_links = viewer_node.inputs[0].links
+    if not composite_links or not viewer_links:
+        return None
+
+    if composite_links[0].from_socket != viewer_links[0].from_socket:
+        return None
+
+    return viewer_node
+
+
+def is_standard_srgb(scene):
+    return scene.display_settings.display_device == 'sRGB' and scene.view_settings.view_transform == 'Standard'
+
+
+def get_ocio_config_path():
+    return os.environ.get("OCIO") or bpy.utils.system_resource('DATAFILES', path=os.path.join("colormanagement", "config.ocio"))
+
+
+def get_ocio_processor(display_device, view_transform):
+    key = (display_device, view_transform)
+    if key not in ocio_processors:
+        config = OCIO.Config.CreateFromFile(get_ocio_config_path())
+        transform = OCIO.DisplayViewTransform(src=OCIO.ROLE_SCENE_LINEAR, display=display_device, view=view_transform)
+        ocio_processors[key] = config.getProcessor(transform).getDefaultCPUProcessor()
+    return ocio_processors[key]
+
+
+def is_view_transform_supported(scene):
+    # the standard sRGB transform, exposure and gamma are simple enough to do with numpy.
+    # other view transforms need OpenColorIO, and looks and curves aren't supported at
+    # all (those fall back to blender's own file output)
+    view_settings = scene.view_settings
+    if view_settings.look != 'None' or view_settings.use_curve_mapping:
+        return False
+    return is_standard_srgb(scene) or OCIO is not None
+
+
+def apply_view_transform(scene, pixels):
+    """Convert scene linear RGBA float pixels (straight alpha) to display values in place, the way blender does when it saves an 8-bit image"""
+    view_settings = scene.view_settings
+    rgb = pixels[..., :3]
+
+    if view_settings.exposure != 0:
+        rgb *= 2 ** view_settings.exposure
+
+    if is_standard_srgb(scene):
+        rgb[...] = image_encoding.linear_to_srgb(rgb)
+    else:
+        get_ocio_processor(scene.display_settings.display_device, view_settings.view_transform).applyRGBA(pixels)
+
+    if view_settings.gamma != 1:
+        rgb[...] = np.power(np.clip(rgb, 0.0, 1.0), 1.0 / view_settings.gamma)
+
+    return pixels
+
+
+def get_viewer_image(scene):
+    if not find_composite_viewer(scene):
+        return None
+    return bpy.data.images.get('Viewer Node')
+
+
+def read_pixels(image, width, height):
+    """Return an image's pixels as a (height, width, 4) float array (bottom row first), or None if it isn't that size"""
+    num_values = width * height * 4
+    if tuple(image.size) != (width, height) or len(image.pixels) != num_values:
+        return None
+
+    pixels = np.empty(num_values, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+
+def get_signature(pixels):
+    return hashlib.blake2b(pixels.tobytes(), digest_size=16).digest()
+
+
+def get_render_pixels(scene, width, height):
+    """Return the rendered pixels as a (height, width, 4) float array (bottom row first), or None if they aren't available"""
+    # blender doesn't expose the pixels of the Render Result to python, but a viewer
+    # node that shows the composite output has the same pixels
+    image = get_viewer_image(scene)
+    if not image:
+        return None
+
+    pixels = read_pixels(image, width, height)
+    if pixels is None:
+        return None
+
+    # make sure this render updated the viewer, rather than it still showing an earlier one
+    if viewer_signature_before_render is None or get_signature(pixels) == viewer_signature_before_render:
+        return None
+
+    return pixels
+
+
+# public methods
+def record_viewer_before_render(scene):
+    """Remember what the viewer node shows before a render starts, so we can tell whether the render updated it"""
+    global viewer_signature_before_render
+
+    image = get_viewer_image(scene)
+    pixels = read_pixels(image, image.size[0], image.size[1]) if image else None
+    viewer_signature_before_render = get_signature(pixels) if pixels is not None else b""
+
+
+def capture_render_png(scene, width, height, compress_level=6, include_alpha=True):
+    """Capture the rendered image as 8-bit PNG bytes (RGBA, or RGB without alpha), with the scene's color management applied, without writing a file or changing the scene's output settings. Returns None if it can't be captured this way"""
+    if not is_view_transform_supported(scene):
+        return None
+
+    try:
+        pixels = get_render_pixels(scene, width, height)
+        if pixels is None:
+            return None
+
+        image_encoding.unpremultiply(pixels)
+        apply_view_transform(scene, pixels)
+
+        if not include_alpha:
+            pixels = pixels[..., :3]
+
+        # blender stores the bottom row first, but png starts at the top
+        return image_encoding.encode_png(image_encoding.quantize(pixels[::-1]), compress_level)
+    except Exception as e:
+        print(f"AI Render: Couldn't capture the render in memory, so saving it to a file instead ({e})")
+        return None
@@ -1,34 +1,37 @@
 import bpy
-import base64
+import binascii
+import io
 import requests
 from .. import (
     config,
+    generated_image,
+    http_sessions,
     operators,
+    streaming_json,
     utils,
 )
+from . import automatic1111_progress
 
 
 # CORE FUNCTIONS:
 
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, job):
 
     # map the generic params to the specific ones for the Automatic1111 API
     map_params(params)
 
-    # add a base 64 encoded image to the params
-    params["init_images"] = [
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    ]
-    img_file.close()
+    # add the image to the params (it's base 64 encoded while the request is sent)
+    params["init_images"] = [streaming_json.Base64File(img_file, f"data:image/{job.upload_format.lower()};base64,")]
 
     # add args for ControlNet if it's enabled
-    if props.controlnet_is_enabled:
-        controlnet_model = props.controlnet_model
-        controlnet_module = props.controlnet_module
-        controlnet_weight = props.controlnet_weight
+    if job.controlnet_is_enabled:
+        controlnet_model = job.controlnet_model
+        controlnet_module = job.controlnet_module
+        controlnet_weight = job.controlnet_weight
 
         if not controlnet_model:
+            img_file.close()
             return operators.handle_error(
                 f"No ContolNet model selected. Either choose a new model or disable ControlNet. [Get help]({config.HELP_WITH_CONTROLNET_URL})",
                 "controlnet_model_missing",
@@ -48,27 +51,37 @@ def generate(params, img_file, filename_prefix, props):
 
     # prepare the server url
     try:
-        server_url = get_server_url("/sdapi/v1/img2img")
+        server_url = get_server_url("/sdapi/v1/img2img", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})",
             "local_server_url_missing",
         )
 
-    # send the API request
-    response = do_post(server_url, params)
+    # send the API request (and show its progress while waiting)
+    progress_request = automatic1111_progress.start(job, get_session(job))
+    try:
+        response = do_post(server_url, params, job)
 
-    if response == False:
-        return False
+        # if the request was cancelled, the server returns what it had so far, which is
+        # thrown away (it's not an error, so nothing is shown)
+        if progress_request.is_cancelled:
+            print("The Automatic1111 request was cancelled")
+            return False
 
-    # handle the response
-    if response.status_code == 200:
-        return handle_success(response, filename_prefix)
-    else:
-        return handle_error(response)
+        if response == False:
+            return False
+
+        # handle the response
+        if response.status_code == 200:
+            return handle_success(response, filename_prefix)
+        else:
+            return handle_error(response)
+    finally:
+        automatic1111_progress.stop(progress_request)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, job):
 
     # prepare the params
     data = {
@@ -77,27 +90,22 @@ def upscale(img_file, filename_prefix, props):
         "gfpgan_visibility": 0,
         "codeformer_visibility": 0,
         "codeformer_weight": 0,
-        "upscaling_resize": props.upscale_factor,
-        "upscaling_resize_w": utils.sanitized_upscaled_width(max_upscaled_image_size()),
-        "upscaling_resize_h": utils.sanitized_upscaled_height(
-            max_upscaled_image_size()
-        ),
+        "upscaling_resize": job.upscale_factor,
+        "upscaling_resize_w": job.upscaled_width,
+        "upscaling_resize_h": job.upscaled_height,
         "upscaling_crop": True,
-        "upscaler_1": props.upscaler_model,
+        "upscaler_1": job.upscaler_model,
         "upscaler_2": "None",
         "extras_upscaler_2_visibility": 0,
         "upscale_first": True,
     }
 
-    # add a base 64 encoded image to the params
-    data["image"] = (
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    )
-    img_file.close()
+    # add the image to the params (it's base 64 encoded while the request is sent)
+    data["image"] = streaming_json.Base64File(img_file)
 
     # prepare the server url
     try:
-        server_url = get_server_url("/sdapi/v1/extra-single-image")
+        server_url = get_server_url("/sdapi/v1/extra-single-image", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})",
@@ -105,7 +113,7 @@ def upscale(img_file, filename_prefix, props):
         )
 
     # send the API request
-    response = do_post(server_url, data)
+    response = do_post(server_url, data, job)
 
     # print log info for debugging
     # debug_log(response)
@@ -122,44 +130,31 @@ def upscale(img_file, filename_prefix, props):
 
 def handle_success(response, filename_prefix):
 
-    # ensure we have the type of response we are expecting
+    # decode the base64 image as the response arrives (the rest of the response is skipped)
+    img_file = io.BytesIO()
     try:
-        response_obj = response.json()
-        base64_img = response_obj.get("images", [False])[0] or response_obj.get("image")
-    except:
-        print("Automatic1111 response content: ")
-        print(response.content)
-        return operators.handle_error(
-            "Received an unexpected response from the Automatic1111 Stable Diffusion server.",
-            "unexpected_response",
-        )
-
-    # create a temp file
-    try:
-        output_file = utils.create_temp_file(filename_prefix + "-")
-    except:
-        return operators.handle_error(
-            "Couldn't create a temp file to save image.", "temp_file"
-        )
-
-    # decode base64 image
-    try:
-        img_binary = base64.b64decode(base64_img.replace("data:image/png;base64,", ""))
-    except:
+        decoder = streaming_json.decode_image_response(response, img_file)
+    except binascii.Error:
         return operators.handle_error(
             "Couldn't decode base64 image from the Automatic1111 Stable Diffusion server.",
             "base64_decode",
         )
+    except Exception as e:
+        print(f"Couldn't read the Automatic1111 response: {e}")
+        decoder = None
 
-    # save the image to the temp file
-    try:
-        with open(output_file, "wb") as file:
-            file.write(img_binary)
-    except:
-        return operators.handle_error("Couldn't write to temp file.", "temp_file_write")
+    # ensure we have the type of response we are expecting
+    if not decoder or not decoder.has_image:
+        if decoder:
+            print("Automatic1111 response content (start): ")
+            print(decoder.head)
+        return operators.handle_error(
+            "Received an unexpected response from the Automatic1111 Stable Diffusion server.",
+            "unexpected_response",
+        )
 
-    # return the temp file
-    return output_file
+    # return the image (it's only written to a file if it needs to be)
+    return generated_image.GeneratedImage(img_file.getvalue(), get_image_format().lower(), filename_prefix)
 
 
 def handle_error(response):
@@ -210,8 +205,12 @@ def create_headers():
     }
 
 
-def get_server_url(path):
-    base_url = utils.local_sd_url().rstrip("/").strip()
+def get_session(job=None):
+    return http_sessions.get_session("automatic1111", job.http_pool_size if job else None)
+
+
+def get_server_url(path, job=None):
+    base_url = (job.local_sd_url if job else utils.local_sd_url()).rstrip("/").strip()
     if not base_url:
         raise Exception("Couldn't get the Automatic1111 server url")
     else:
@@ -223,11 +222,15 @@ def map_params(params):
     params["sampler_index"] = params["sampler"]
 
 
-def do_post(url, data):
-    # send the API request
+def do_post(url, data, job):
+    # stream the json body, so the base 64 images are never fully in memory
+    body = streaming_json.JSONBody(data)
+    headers = {**create_headers(), "Content-Type": "application/json"}
+
+    # send the API request (the response is streamed too, so handle_success can decode it in chunks)
     try:
-        return requests.post(
-            url, json=data, headers=create_headers(), timeout=utils.local_sd_timeout()
+        return get_session(job).post(
+            url, data=body, headers=headers, timeout=job.local_sd_timeout, stream=True
         )
     except requests.exceptions.ConnectionError:
         return operators.handle_error(
@@ -244,6 +247,8 @@ def do_post(url, data):
             "The local Stable Diffusion server timed out. Set a longer timeout in AI Render preferences, or use a smaller image size.",
             "timeout",
         )
+    finally:
+        body.close()
 
 
 def debug_log(response):
@@ -375,6 +380,12 @@ def max_upscaled_image_size():
     return 4096 * 4096
 
 
+def max_in_flight_frames():
+    preferences = utils.get_addon_preferences()
+    if preferences.use_server_pool:
+        return utils.server_pool_capacity()
+    return preferences.automatic1111_max_in_flight_frames
+
 def is_using_sdxl_1024_model(props):
     # TODO: Use the actual model loaded in Automatic1111. For now, we're just
     # returning false, because that way the UI will allow the user to select
@@ -445,7 +456,7 @@ def load_upscaler_models(context):
         # get the list of available upscaler models from the Automatic1111 api
         server_url = get_server_url("/sdapi/v1/upscalers")
         headers = {"Accept": "application/json"}
-        response = requests.get(server_url, headers=headers, timeout=5)
+        response = get_session().get(server_url, headers=headers, timeout=5)
         response_obj = response.json()
         print("Upscaler models returned from Automatic1111 API:")
         print(response_obj)
@@ -482,7 +493,7 @@ def load_controlnet_models(context):
         # get the list of available controlnet models from the Automatic1111 api
         server_url = get_server_url("/controlnet/model_list")
         headers = {"Accept": "application/json"}
-        response = requests.get(server_url, headers=headers, timeout=5)
+        response = get_session().get(server_url, headers=headers, timeout=5)
         response_obj = response.json()
         print("ControlNet models returned from Automatic1111 API:")
         print(response_obj)
@@ -507,7 +518,7 @@ def load_controlnet_modules(context):
         # get the list of available controlnet modules from the Automatic1111 api
         server_url = get_server_url("/controlnet/module_list")
         headers = {"Accept": "application/json"}
-        response = requests.get(server_url, headers=headers, timeout=5)
+        response = get_session().get(server_url, headers=headers, timeout=5)
         response_obj = response.json()
         print("ControlNet modules returned from Automatic1111 API:")
         print(response_obj)
@@ -0,0 +1,231 @@
+import bpy
+import base64
+import functools
+import threading
+import time
+from .. import (
+    config,
+    progress_bar,
+    task_queue,
+    utils,
+)
+
+
+# servers that have requests in flight, by base url
+servers = {}
+servers_condition = threading.Condition()
+poller = None
+
+
+class ProgressRequest:
+    """A request in flight to a server. If it's cancelled, its result is thrown away"""
+
+    def __init__(self, server, job):
+        self.server = server
+        self.job = job
+        self.is_cancelled = False
+
+
+class ServerProgress:
+    """The progress of the requests in flight on one Automatic1111 server, from its /sdapi/v1/progress endpoint"""
+
+    def __init__(self, base_url, session, timeout):
+        self.base_url = base_url
+        self.session = session
+        self.timeout = timeout
+        self.requests = set()
+        self.num_preview_requests = 0
+        self.progress = 0
+        self.eta = 0
+        self.step = 0
+        self.num_steps = 0
+        self.last_preview_at = 0
+
+    def should_get_preview(self):
+        return self.num_preview_requests > 0 and time.monotonic() - self.last_preview_at >= config.automatic1111_preview_interval
+
+    def check(self):
+        """Get the server's progress once. Returns the current (in progress) image, if one was asked for"""
+        should_get_preview = self.should_get_preview()
+        try:
+            response = self.session.get(
+                self.base_url + "/sdapi/v1/progress",
+                params={"skip_current_image": "false" if should_get_preview else "true"},
+                timeout=self.timeout,
+            )
+            status = response.json()
+        except Exception as e:
+            # the progress is only informational, so errors are ignored (the request itself
+            # reports any real problem)
+            print(f"WARN: Couldn't get the progress from the Automatic1111 server ({e})")
+            return None
+
+        state = status.get("state") or {}
+        self.progress = status.get("progress") or 0
+        self.eta = status.get("eta_relative") or 0
+        self.step = state.get("sampling_step") or 0
+        self.num_steps = state.get("sampling_steps") or 0
+
+        # an interrupt only stops the server's current job, so keep interrupting while it's
+        # still working on requests that were all cancelled (like queued animation frames)
+        if self.is_cancelled() and (self.progress > 0 or (state.get("job_count") or 0) > 0):
+            self.interrupt()
+            return None
+
+        if not should_get_preview or not status.get("current_image"):
+            return None
+
+        self.last_preview_at = time.monotonic()
+        try:
+            return base64.b64decode(status["current_image"].rpartition("base64,")[2])
+        except Exception:
+            return None
+
+    def is_cancelled(self):
+        with servers_condition:
+            return bool(self.requests) and all(request.is_cancelled for request in self.requests)
+
+    def interrupt(self):
+        """Ask the server to stop what it's generating"""
+        try:
+            print(f"Interrupting the Automatic1111 server at {self.base_url}")
+            self.session.post(self.base_url + "/sdapi/v1/interrupt", timeout=self.timeout)
+        except Exception as e:
+            print(f"WARN: Couldn't interrupt the Automatic1111 server ({e})")
+
+    def get_status_message(self):
+        if self.is_cancelled():
+            return "Automatic1111: cancelling"
+        if not self.num_steps:
+            return "Automatic1111: waiting"
+        return f"Automatic1111: step {self.step}/{self.num_steps} (~{round(self.eta)}s left)"
+
+
+def run_poller():
+    while True:
+        with servers_condition:
+            while not servers:
+                servers_condition.wait()
+            active_servers = list(servers.values())
+
+        # check the servers outside the lock, so requests can start and end in the meantime
+        for server in active_servers:
+            preview_data = server.check()
+            if preview_data:
+                task_queue.add(functools.partial(show_preview, preview_data))
+
+        task_queue.add(show_status)
+
+        with servers_condition:
+            servers_condition.wait(config.automatic1111_progress_interval)
+
+
+def start_poller():
+    global poller
+
+    if not poller or not poller.is_alive():
+        poller = threading.Thread(target=run_poller, daemon=True)
+        poller.start()
+
+
+def get_active_servers():
+    with servers_condition:
+        return list(servers.values())
+
+
+def should_show_preview(job):
+    # previews are only shown for single images that are going to be viewed anyway
+    return job.show_progress_preview and job.should_view_result and not job.is_animation_frame
+
+
+def show_status():
+    """Show the progress in the progress bar (in the main thread). While an animation is rendering, its own progress is kept, and only the status message is set"""
+    scene = bpy.context.scene
+    if not scene:
+        return
+
+    is_rendering_animation = scene.air_props.is_rendering_animation_manually
+    active_servers = get_active_servers()
+
+    if active_servers:
+        scene.air_progress_status_message = ", ".join(server.get_status_message() for server in active_servers)
+        if not is_rendering_animation:
+            scene.air_progress_label = "Automatic1111"
+            scene.air_progress = round(min(server.progress for server in active_servers) * 100)
+            scene.air_progress_can_cancel = not all(server.is_cancelled() for server in active_servers)
+    elif scene.air_progress_status_message.startswith("Automatic1111:"):
+        scene.air_progress_status_message = ""
+        if not is_rendering_animation:
+            scene.air_progress = 100
+            progress_bar.hide_progress_bar_after_delay()
+
+    if not active_servers and scene.air_progress_can_cancel:
+        scene.air_progress_can_cancel = False
+
+
+def show_preview(data):
+    """Show an image that's still being generated in the render view (in the main thread), so a bad result can be spotted early"""
+    if not get_active_servers():
+        return
+
+    img = bpy.data.images.get(config.automatic1111_preview_image_name)
+    if not img:
+        img = bpy.data.images.new(config.automatic1111_preview_image_name, 8, 8)
+
+    img.pack(data=data, data_len=len(data))
+    if img.source == 'GENERATED':
+        img.source = 'FILE'
+    else:
+        img.reload()
+
+    utils.view_sd_in_render_view(img, bpy.context.scene)
+
+
+# public methods
+def start(job, session):
+    """Start showing the progress of a request to the server in the job (call stop() once it's done)"""
+    base_url = job.local_sd_url.rstrip("/").strip()
+    with servers_condition:
+        server = servers.get(base_url)
+        if not server:
+            server = servers[base_url] = ServerProgress(base_url, session, config.automatic1111_progress_timeout)
+        request = ProgressRequest(server, job)
+        server.requests.add(request)
+        if should_show_preview(job):
+            server.num_preview_requests += 1
+        servers_condition.notify_all()
+
+    start_poller()
+    return request
+
+
+def stop(request):
+    server = request.server
+    with servers_condition:
+        server.requests.discard(request)
+        if should_show_preview(request.job):
+            server.num_preview_requests -= 1
+        if not server.requests:
+            servers.pop(server.base_url, None)
+
+    task_queue.add(show_status)
+
+
+def is_running():
+    with servers_condition:
+        return bool(servers)
+
+
+def cancel():
+    """Cancel every request in flight (their results are thrown away), and interrupt the servers they were sent to"""
+    with servers_condition:
+        active_servers = list(servers.values())
+        for server in active_servers:
+            for request in server.requests:
+                request.is_cancelled = True
+
+    for server in active_servers:
+        task_queue.add_background(server.interrupt)
+
+    task_queue.add(show_status)
+    return bool(active_servers)
@@ -1,10 +1,14 @@
 import bpy
-import base64
+import binascii
+import io
 import requests
 import random
 from .. import (
     config,
+    generated_image,
+    http_sessions,
     operators,
+    streaming_json,
     utils,
 )
 
@@ -12,19 +16,16 @@ from .. import (
 # TODO: Support Model Choice
 
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, job):
     # Configuring custom params for shark
     params["denoising_strength"] = round(1 - params["image_similarity"], 2)
 
-    # add a base 64 encoded image to the params
-    params["init_images"] = [
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    ]
-    img_file.close()
+    # add the image to the params (it's base 64 encoded while the request is sent)
+    params["init_images"] = [streaming_json.Base64File(img_file, f"data:image/{job.upload_format.lower()};base64,")]
 
     # get server url
     try:
-        server_url = get_server_url("/sdapi/v1/img2img")
+        server_url = get_server_url("/sdapi/v1/img2img", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})",
@@ -32,7 +33,7 @@ def generate(params, img_file, filename_prefix, props):
         )
 
     # send the API request
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, job)
 
     # Error already handled
     if response is False:
@@ -44,33 +45,30 @@ def generate(params, img_file, filename_prefix, props):
         return handle_error(response)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, job):
 
     data = {
         "prompt": "",
         "negative_prompt": "",
         "seed": random.randint(1000000000, 2147483647),
-        "height": utils.sanitized_upscaled_height(max_upscaled_image_size()),
-        "width": utils.sanitized_upscaled_width(max_upscaled_image_size()),
+        "height": job.upscaled_height,
+        "width": job.upscaled_width,
         "steps": 50,
         "noise_level": 20,
         "cfg_scale": 7,
     }
 
-    data["init_images"] = [
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    ]
-    img_file.close()
+    data["init_images"] = [streaming_json.Base64File(img_file)]
 
     try:
-        server_url = get_server_url("/sdapi/v1/upscaler")
+        server_url = get_server_url("/sdapi/v1/upscaler", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})",
             "local_server_url_missing",
         )
 
-    response = do_post(server_url, data)
+    response = do_post(server_url, data, job)
 
     if response is False:
         return False
@@ -81,27 +79,20 @@ def upscale(img_file, filename_prefix, props):
         return handle_error(response)
 
 
-def inpaint(params, img_file, mask_file, filename_prefix, props):
+def inpaint(params, img_file, mask_file, filename_prefix, job):
 
-    params["image"] = (
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    )
-    img_file.close()
-
-    params["mask"] = (
-        "data:image/png;base64," + base64.b64encode(mask_file.read()).decode()
-    )
-    mask_file.close()
+    params["image"] = streaming_json.Base64File(img_file)
+    params["mask"] = streaming_json.Base64File(mask_file)
 
     try:
-        server_url = get_server_url("/sdapi/v1/inpaint")
+        server_url = get_server_url("/sdapi/v1/inpaint", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})",
             "local_server_url_missing",
         )
 
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, job)
 
     if response is False:
         return False
@@ -112,22 +103,19 @@ def inpaint(params, img_file, mask_file, filename_prefix, props):
         return handle_error(response)
 
 
-def outpaint(params, img_file, filename_prefix, props):
+def outpaint(params, img_file, filename_prefix, job):
 
-    params["init_images"] = [
-        "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    ]
-    img_file.close()
+    params["init_images"] = [streaming_json.Base64File(img_file)]
 
     try:
-        server_url = get_server_url("/sdapi/v1/outpaint")
+        server_url = get_server_url("/sdapi/v1/outpaint", job)
     except:
         return operators.handle_error(
             f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})",
             "local_server_url_missing",
         )
 
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, job)
 
     if response is False:
         return False
@@ -140,44 +128,31 @@ def outpaint(params, img_file, filename_prefix, props):
 
 def handle_success(response, filename_prefix):
 
-    # ensure we have the type of response we are expecting
-    try:
-        response_obj = response.json()
-        base64_img = response_obj.get("images", [False])[0] or response_obj.get("image")
-    except:
-        print("SHARK response content: ")
-        print(response.content)
-        return operators.handle_error(
-            "Received an unexpected response from the Shark Stable Diffusion server.",
-            "unexpected_response",
-        )
-
-    # create a temp file
-    try:
-        output_file = utils.create_temp_file(filename_prefix + "-")
-    except:
-        return operators.handle_error(
-            "Couldn't create a temp file to save image.", "temp_file"
-        )
-
-    # decode base64 image
+    # decode the base64 image as the response arrives (the rest of the response is skipped)
+    img_file = io.BytesIO()
     try:
-        img_binary = base64.b64decode(base64_img.replace("data:image/png;base64,", ""))
-    except:
+        decoder = streaming_json.decode_image_response(response, img_file)
+    except binascii.Error:
         return operators.handle_error(
             "Couldn't decode base64 image from the Shark Stable Diffusion server.",
             "base64_decode",
         )
+    except Exception as e:
+        print(f"Couldn't read the SHARK response: {e}")
+        decoder = None
 
-    # save the image to the temp file
-    try:
-        with open(output_file, "wb") as file:
-            file.write(img_binary)
-    except:
-        return operators.handle_error("Couldn't write to temp file.", "temp_file_write")
+    # ensure we have the type of response we are expecting
+    if not decoder or not decoder.has_image:
+        if decoder:
+            print("SHARK response content (start): ")
+            print(decoder.head)
+        return operators.handle_error(
+            "Received an unexpected response from the Shark Stable Diffusion server.",
+            "unexpected_response",
+        )
 
-    # return the temp file
-    return output_file
+    # return the image (it's only written to a file if it needs to be)
+    return generated_image.GeneratedImage(img_file.getvalue(), get_image_format().lower(), filename_prefix)
 
 
 def handle_error(response):
@@ -225,11 +200,15 @@ def create_headers():
     }
 
 
-def do_post(url, data):
-    # send the API request
+def do_post(url, data, job):
+    # stream the json body, so the base 64 images are never fully in memory
+    body = streaming_json.JSONBody(data)
+    headers = {**create_headers(), "Content-Type": "application/json"}
+
+    # send the API request (the response is streamed too, so handle_success can decode it in chunks)
     try:
-        return requests.post(
-            url, json=data, headers=create_headers(), timeout=utils.local_sd_timeout()
+        return get_session(job).post(
+            url, data=body, headers=headers, timeout=job.local_sd_timeout, stream=True
         )
     except requests.exceptions.ConnectionError:
         return operators.handle_error(
@@ -246,10 +225,16 @@ def do_post(url, data):
             "The local Stable Diffusion server timed out. Set a longer timeout in AI Render preferences, or use a smaller image size.",
             "timeout",
         )
+    finally:
+        body.close()
 
 
-def get_server_url(path):
-    base_url = utils.local_sd_url().rstrip("/").strip()
+def get_session(job=None):
+    return http_sessions.get_session("shark", job.http_pool_size if job else None)
+
+
+def get_server_url(path, job=None):
+    base_url = (job.local_sd_url if job else utils.local_sd_url()).rstrip("/").strip()
     if not base_url:
         raise Exception("Couldn't get the shark server url")
     else:
@@ -268,6 +253,12 @@ def max_upscaled_image_size():
     return 512 * 512
 
 
+def max_in_flight_frames():
+    preferences = utils.get_addon_preferences()
+    if preferences.use_server_pool:
+        return utils.server_pool_capacity()
+    return preferences.shark_max_in_flight_frames
+
 def is_using_sdxl_1024_model(props):
     return False
 
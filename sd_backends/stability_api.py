@@ -3,6 +3,8 @@ import base64
 import requests
 from .. import (
     config,
+    generated_image,
+    http_sessions,
     operators,
     utils,
 )
@@ -11,19 +13,19 @@ from .. import (
 # CORE FUNCTIONS:
 
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, job):
     # validate the params, specifically for the Stability API
-    if not validate_params(params, props):
+    if not validate_params(params, job):
         return False
 
     # map the generic params to the specific ones for the Stability API
     mapped_params = map_params(params)
 
     # create the headers
-    headers = create_headers()
+    headers = create_headers(job)
 
     # prepare the URL (specifically setting the engine id)
-    api_url = f"{config.STABILITY_API_V1_URL}{props.sd_model}/image-to-image"
+    api_url = f"{config.STABILITY_API_V1_URL}{job.sd_model}/image-to-image"
 
     # prepare the file input
     files = {
@@ -32,7 +34,7 @@ def generate(params, img_file, filename_prefix, props):
 
     # send the API request
     try:
-        response = requests.post(
+        response = get_session(job).post(
             api_url,
             headers=headers,
             files=files,
@@ -57,9 +59,9 @@ def generate(params, img_file, filename_prefix, props):
         return handle_error(response)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, job):
     # create the headers
-    headers = create_headers()
+    headers = create_headers(job)
 
     # prepare the URL
     api_url = f"{config.STABILITY_API_V2_URL}upscale/fast"
@@ -74,7 +76,7 @@ def upscale(img_file, filename_prefix, props):
 
     # send the API request
     try:
-        response = requests.post(
+        response = get_session(job).post(
             api_url, headers=headers, files=files, data=data, timeout=request_timeout()
         )
         img_file.close()
@@ -98,26 +100,18 @@ def upscale(img_file, filename_prefix, props):
 def handle_success(response, filename_prefix):
     try:
         data = response.json()
-        output_file = utils.create_temp_file(filename_prefix + "-")
-    except:
-        return operators.handle_error(
-            f"Couldn't create a temp file to save image", "temp_file"
-        )
 
-    try:
         if "image" in data:
-            with open(output_file, "wb") as file:
-                file.write(base64.b64decode(data["image"]))
+            img_binary = base64.b64decode(data["image"])
         elif "artifacts" in data:
-            for i, image in enumerate(data["artifacts"]):
-                with open(output_file, "wb") as file:
-                    file.write(base64.b64decode(image["base64"]))
+            img_binary = base64.b64decode(data["artifacts"][-1]["base64"])
         else:
             return operators.handle_error(
                 f"DreamStudio returned an unexpected response", "unexpected_response"
             )
 
-        return output_file
+        # return the image (it's only written to a file if it needs to be)
+        return generated_image.GeneratedImage(img_binary, get_image_format().lower(), filename_prefix)
     except:
         return operators.handle_error(
             f"DreamStudio returned an unexpected response", "unexpected_response"
@@ -152,11 +146,15 @@ def handle_error(response):
 # PRIVATE SUPPORT FUNCTIONS:
 
 
-def create_headers():
+def get_session(job=None):
+    return http_sessions.get_session("dreamstudio", job.http_pool_size if job else None)
+
+
+def create_headers(job):
     return {
         "User-Agent": f"Blender/{bpy.app.version_string}",
         "Accept": "application/json",
-        "Authorization": f"Bearer {utils.get_dream_studio_api_key()}",
+        "Authorization": f"Bearer {job.dream_studio_api_key}",
     }
 
 
@@ -182,9 +180,9 @@ def map_params(params):
     return mapped_params
 
 
-def validate_params(params, props):
+def validate_params(params, job):
     # validate the dimensions (the sdxl 1024 model only supports a few specific image sizes)
-    if props.sd_model.startswith(
+    if job.sd_model.startswith(
         "stable-diffusion-xl-1024"
     ) and not utils.are_sdxl_1024_dimensions_valid(params["width"], params["height"]):
         return operators.handle_error(
@@ -360,5 +358,8 @@ def max_upscaled_image_size():
     return 4096 * 4096
 
 
+def max_in_flight_frames():
+    return 1
+
 def is_using_sdxl_1024_model(props):
     return props.sd_model.startswith("stable-diffusion-xl-1024")
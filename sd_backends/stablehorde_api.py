@@ -1,13 +1,16 @@
 import bpy
 import base64
-import time
 import requests
+import time
 
 from .. import (
     config,
+    generated_image,
+    http_sessions,
     operators,
     utils,
 )
+from . import stablehorde_jobs
 
 API_REQUEST_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/async"
 API_CHECK_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/check"
@@ -16,7 +19,7 @@ API_GET_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/status"
 # CORE FUNCTIONS:
 
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, job):
 
     # map the generic params to the specific ones for the Stable Horde API
     stablehorde_params = map_params(params)
@@ -28,15 +31,24 @@ def generate(params, img_file, filename_prefix, props):
     img_file.close()
 
     # create the headers
-    headers = create_headers()
+    headers = create_headers(job)
 
-    # send the API request
-    start_time = time.monotonic()
+    # send the API request. if the horde won't take any more requests from us right now (because
+    # other frames are already in flight), wait for one of them to finish and try again
+    submit_deadline = time.monotonic() + request_timeout()
     try:
-        print(f"Sending request to Stable Horde API: {API_REQUEST_URL}")
-        response = requests.post(
-            API_REQUEST_URL, json=stablehorde_params, headers=headers, timeout=20
-        )
+        while True:
+            print(f"Sending request to Stable Horde API: {API_REQUEST_URL}")
+            response = get_session(job).post(
+                API_REQUEST_URL, json=stablehorde_params, headers=headers, timeout=20
+            )
+            if response.status_code != 429 or time.monotonic() > submit_deadline:
+                break
+            print("Stable Horde has too many of our requests in flight. Waiting to send this one...")
+            stablehorde_jobs.wait_for_finished_job(config.stablehorde_submit_retry_interval)
+
+        if response.status_code == 429:
+            return handle_error(response)
         id = response.json()["id"]
         img_file.close()
     except requests.exceptions.ReadTimeout:
@@ -45,47 +57,35 @@ def generate(params, img_file, filename_prefix, props):
             f"There was an error sending this request to Stable Horde. Please try again in a moment.",
             "timeout",
         )
+    except requests.exceptions.ConnectionError:
+        img_file.close()
+        return operators.handle_error(
+            f"Couldn't connect to Stable Horde. Please try again in a moment.",
+            "connection_error",
+        )
     except Exception as e:
         img_file.close()
         return operators.handle_error(
             f"Error with Stable Horde. Full error message: {e}", "unknown_error"
         )
 
-    # Check the status of the request (For at most request_timeout seconds)
-    for i in range(request_timeout()):
-        try:
-            time.sleep(1)
-            URL = API_CHECK_URL + "/" + id
-            print(f"Checking status of request at Stable Horde API: {URL}")
-            response = requests.get(URL, headers=headers, timeout=20)
-            print(
-                f"Waiting for {str(time.monotonic() - start_time)}s. Response: {response.json()}"
-            )
-            if response.json()["done"] == True:
-                print(
-                    "The horde took "
-                    + str(time.monotonic() - start_time)
-                    + "s to imagine this frame."
-                )
-                break
-        except requests.exceptions.ReadTimeout:
-            # Ignore timeouts
-            print("WARN: Timeout while checking status")
-        except Exception as e:  # Catch all other errors
-            return operators.handle_error(
-                f"Error while checking status: {e}", "unknown_error"
-            )
-    if i == request_timeout() - 1:
-        return operators.handle_error(
-            f"Timeout generating image. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})",
-            "timeout",
-        )
+    # track the job until it's done (the shared poller checks its status, so this thread
+    # just waits)
+    horde_job = stablehorde_jobs.track(id, API_CHECK_URL, headers, get_session(job), request_timeout())
+    try:
+        if not horde_job.wait():
+            return operators.handle_error(*horde_job.error)
+        return get_result(horde_job, headers, filename_prefix, job)
+    finally:
+        stablehorde_jobs.finish(horde_job)
+
 
+def get_result(horde_job, headers, filename_prefix, job):
     # Get the image
     try:
-        URL = API_GET_URL + "/" + id
+        URL = API_GET_URL + "/" + horde_job.id
         print(f"Retrieving image from Stable Horde API: {URL}")
-        response = requests.get(URL, headers=headers, timeout=20)
+        response = get_session(job).get(URL, headers=headers, timeout=20)
         # handle the response
         if response.status_code == 200:
             return handle_success(response, filename_prefix)
@@ -97,6 +97,11 @@ def generate(params, img_file, filename_prefix, props):
             f"Timeout getting image from Stable Horde. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})",
             "timeout",
         )
+    except requests.exceptions.ConnectionError:
+        return operators.handle_error(
+            f"Couldn't connect to Stable Horde to get the image. Please try again in a moment.",
+            "connection_error",
+        )
     except Exception as e:
         return operators.handle_error(
             f"Error with Stable Horde. Full error message: {e}", "unknown_error"
@@ -121,54 +126,48 @@ def handle_success(response, filename_prefix):
             "unexpected_response",
         )
 
-    # create a temp file
-    try:
-        output_file = utils.create_temp_file(
-            filename_prefix + "-", suffix=f".{get_image_format().lower()}"
-        )
-    except:
-        return operators.handle_error(
-            "Couldn't create a temp file to save image.", "temp_file"
-        )
-
-    # Retrieve img from img_url and write it to the temp file
-    img_binary = None
+    # stream the image from img_url straight to a temp file (resuming if the transfer is
+    # interrupted)
+    image_format = get_image_format().lower()
+    file_path = utils.create_temp_file(filename_prefix + "-", suffix=f".{image_format}")
     try:
         print(f"Retrieving image file from R2: {img_url}")
-        response = requests.get(img_url, timeout=20)
-        img_binary = response.content
-    except requests.exceptions.ReadTimeout:
+        num_bytes = http_sessions.download_file(get_session(), img_url, file_path)
+        print(f"Retrieved {num_bytes} bytes")
+    except requests.exceptions.Timeout:
         return operators.handle_error(
             f"Timeout retrieving file. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})",
             "timeout",
         )
+    except Exception as e:
+        return operators.handle_error(
+            f"Error retrieving the image from Stable Horde. Full error message: {e}", "unknown_error"
+        )
 
-    # save the image to the temp file
-    try:
-        with open(output_file, "wb") as file:
-            file.write(img_binary)
-    except:
-        return operators.handle_error("Couldn't write to temp file.", "temp_file_write")
-
-    # return the temp file
-    return output_file
+    # return the image (it's already in a file, so it isn't held in memory)
+    return generated_image.GeneratedImage(None, image_format, filename_prefix, file_path)
 
 
 def handle_error(response):
+    # (a server error might go away if the request is tried again, but any other error won't)
     return operators.handle_error(
         "The Stable Horde server returned an error: " + str(response.content),
-        "unknown_error",
+        "unknown_error_response" if response.status_code >= 500 else "unknown_error",
     )
 
 
 # PRIVATE SUPPORT FUNCTIONS:
 
 
-def create_headers():
+def get_session(job=None):
+    return http_sessions.get_session("stablehorde", job.http_pool_size if job else None)
+
+
+def create_headers(job):
     # if no api-key specified, use the default non-authenticated api-key
     apikey = (
-        utils.get_stable_horde_api_key()
-        if not utils.get_stable_horde_api_key().strip() == ""
+        job.stable_horde_api_key
+        if not job.stable_horde_api_key.strip() == ""
         else "0000000000"
     )
 
@@ -295,5 +294,8 @@ def max_upscaled_image_size():
     return 2048 * 2048
 
 
+def max_in_flight_frames():
+    return utils.get_addon_preferences().stablehorde_max_in_flight_frames
+
 def is_using_sdxl_1024_model(props):
     return False
@@ -0,0 +1,263 @@
+import bpy
+import random
+import threading
+import time
+import traceback
+import requests
+from .. import (
+    config,
+    progress_bar,
+    task_queue,
+)
+
+
+# job states (a job moves through these in order, unless it fails)
+SUBMITTED = "submitted"
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+DOWNLOADED = "downloaded"
+FAILED = "failed"
+
+# jobs that are being tracked, by id
+jobs = {}
+jobs_condition = threading.Condition()
+poller = None
+
+# totals for jobs that have finished, so the number of status checks can be compared with the
+# time spent waiting
+stats = {"jobs": 0, "polls": 0, "seconds": 0}
+
+
+class HordeJob:
+    """A request that has been submitted to Stable Horde, and is being tracked until its result has been downloaded"""
+
+    def __init__(self, id, check_url, headers, session, timeout):
+        self.id = id
+        self.check_url = check_url
+        self.headers = headers
+        self.session = session
+        self.state = SUBMITTED
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.next_check_at = self.submitted_at + config.stablehorde_poll_min_interval
+        self.num_polls = 0
+        self.queue_position = 0
+        self.wait_time = 0
+        self.error = None
+        self.is_finished = threading.Event()
+
+    def set_state(self, state, error=None):
+        if state != self.state:
+            print(f"Stable Horde job {self.id}: {self.state} -> {state}")
+        self.state = state
+        self.error = error
+        if state in (DONE, FAILED):
+            self.is_finished.set()
+
+    def check(self):
+        """Check the status of the job once, and move it to its new state"""
+        if time.monotonic() > self.deadline:
+            return self.set_state(FAILED, (
+                f"Timeout generating image. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})",
+                "timeout",
+            ))
+
+        self.num_polls += 1
+        try:
+            response = self.session.get(f"{self.check_url}/{self.id}", headers=self.headers, timeout=20)
+            status = response.json()
+        except requests.exceptions.ReadTimeout:
+            # ignore timeouts (the job will be checked again)
+            print(f"WARN: Timeout while checking the status of Stable Horde job {self.id}")
+            return
+        except Exception as e:
+            # (the horde's status endpoint failing is usually temporary, so this can be retried)
+            return self.set_state(FAILED, (f"Error while checking status: {e}", "status_check_failed"))
+
+        if status.get("faulted") or status.get("is_possible") is False:
+            return self.set_state(FAILED, (
+                f"Stable Horde couldn't generate this image. Full server response: {status}",
+                "unknown_error",
+            ))
+
+        # (the horde can send null for these)
+        self.queue_position = status.get("queue_position") or 0
+        self.wait_time = status.get("wait_time") or 0
+
+        if status.get("done"):
+            print(f"The horde took {round(time.monotonic() - self.submitted_at, 1)}s to imagine this frame.")
+            self.set_state(DONE)
+        elif status.get("processing"):
+            self.set_state(PROCESSING)
+        else:
+            self.set_state(QUEUED)
+
+    def get_next_check_delay(self):
+        """Return how long to wait before checking the job again. This is a fraction of the time the horde says is left (so the estimate can be corrected as it changes), kept between the min and max interval, with some jitter so many jobs don't all poll at once"""
+        if self.state in (QUEUED, PROCESSING):
+            delay = self.wait_time * config.stablehorde_poll_wait_fraction
+        else:
+            # nothing is known about the job yet (or the last check failed)
+            delay = config.stablehorde_poll_min_interval
+
+        delay = min(max(delay, config.stablehorde_poll_min_interval), config.stablehorde_poll_max_interval)
+        delay *= random.uniform(1 - config.stablehorde_poll_jitter, 1 + config.stablehorde_poll_jitter)
+
+        # don't sleep past the deadline (so the timeout is reported on time)
+        return max(min(delay, self.deadline - time.monotonic()), 0)
+
+    def schedule_next_check(self):
+        self.next_check_at = time.monotonic() + self.get_next_check_delay()
+
+    def get_progress(self):
+        """Estimate how far along the job is (0-1), from how long it has taken so far and how much longer the horde expects it to take"""
+        elapsed_time = time.monotonic() - self.submitted_at
+        return elapsed_time / max(elapsed_time + self.wait_time, 1)
+
+    def wait(self):
+        """Block (in a background thread) until the job is done or has failed. If the poller never gets to it, the job fails a little after its deadline"""
+        if not self.is_finished.wait(max(self.deadline - time.monotonic(), 0) + config.stablehorde_wait_grace_period):
+            with jobs_condition:
+                if not self.is_finished.is_set():
+                    self.set_state(FAILED, (
+                        f"Timeout generating image. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})",
+                        "timeout",
+                    ))
+        return self.state == DONE
+
+
+def run_poller():
+    while True:
+        with jobs_condition:
+            # sleep until the next job is due (or a new job is added)
+            while True:
+                pending_jobs = [job for job in jobs.values() if job.state not in (DONE, DOWNLOADED, FAILED)]
+                if pending_jobs:
+                    delay = min(job.next_check_at for job in pending_jobs) - time.monotonic()
+                    if delay <= 0:
+                        break
+                    jobs_condition.wait(delay)
+                else:
+                    jobs_condition.wait()
+
+            # check any other jobs that are almost due at the same time, so several frames in
+            # flight share one wake-up and a burst of requests on the same connection
+            due_jobs = [job for job in pending_jobs if job.next_check_at <= time.monotonic() + config.stablehorde_poll_batch_window]
+
+        # check the jobs outside the lock, so new jobs can be added in the meantime
+        for job in due_jobs:
+            # an unexpected error fails this job, but mustn't stop the poller (every other
+            # job would wait forever)
+            try:
+                job.check()
+                job.schedule_next_check()
+            except Exception as e:
+                print(f"AI Render: Error checking Stable Horde job {job.id}")
+                traceback.print_exc()
+                job.set_state(FAILED, (f"Error while checking status: {e}", "unknown_error"))
+
+        task_queue.add(show_status)
+
+
+def start_poller():
+    global poller
+
+    if not poller or not poller.is_alive():
+        poller = threading.Thread(target=run_poller, daemon=True)
+        poller.start()
+
+
+def get_status_message():
+    with jobs_condition:
+        active_jobs = [job for job in jobs.values() if job.state in (SUBMITTED, QUEUED, PROCESSING)]
+
+    if not active_jobs:
+        return ""
+
+    num_processing = sum(1 for job in active_jobs if job.state == PROCESSING)
+    num_queued = len(active_jobs) - num_processing
+    wait_time = max(job.wait_time for job in active_jobs)
+
+    if len(active_jobs) == 1:
+        job = active_jobs[0]
+        if job.state == PROCESSING:
+            return f"Stable Horde: processing (~{wait_time}s)"
+        return f"Stable Horde: queue position {job.queue_position} (~{wait_time}s)"
+
+    return f"Stable Horde: {num_processing} processing, {num_queued} queued (~{wait_time}s)"
+
+
+def get_progress():
+    with jobs_condition:
+        active_jobs = [job for job in jobs.values() if job.state in (SUBMITTED, QUEUED, PROCESSING)]
+    return min((job.get_progress() for job in active_jobs), default=1)
+
+
+def show_status():
+    """Show the status of the horde jobs in the progress bar (in the main thread). While an animation is rendering, its own progress is kept, and only the status message is set"""
+    scene = bpy.context.scene
+    if not scene:
+        return
+
+    is_rendering_animation = scene.air_props.is_rendering_animation_manually
+    status_message = get_status_message()
+
+    if status_message:
+        scene.air_progress_status_message = status_message
+        if not is_rendering_animation:
+            scene.air_progress_label = "Stable Horde"
+            scene.air_progress = round(get_progress() * 100)
+    elif scene.air_progress_status_message.startswith("Stable Horde:"):
+        scene.air_progress_status_message = ""
+        if not is_rendering_animation:
+            scene.air_progress = 100
+            progress_bar.hide_progress_bar_after_delay()
+
+
+# public methods
+def track(id, check_url, headers, session, timeout):
+    """Start tracking a submitted job, and return it"""
+    job = HordeJob(id, check_url, headers, session, timeout)
+    with jobs_condition:
+        jobs[id] = job
+        jobs_condition.notify_all()
+
+    start_poller()
+    return job
+
+
+def finish(job, was_downloaded=True):
+    """Stop tracking a job (once its result has been downloaded, or it has failed)"""
+    with jobs_condition:
+        if was_downloaded and job.state == DONE:
+            job.set_state(DOWNLOADED)
+        if jobs.pop(job.id, None):
+            elapsed_time = time.monotonic() - job.submitted_at
+            stats["jobs"] += 1
+            stats["polls"] += job.num_polls
+            stats["seconds"] += elapsed_time
+            print(f"Stable Horde job {job.id}: {job.num_polls} status checks in {round(elapsed_time, 1)}s")
+        jobs_condition.notify_all()
+
+    task_queue.add(show_status)
+
+
+def wait_for_finished_job(timeout):
+    """Block (in a background thread) until a tracked job finishes, or the timeout passes"""
+    with jobs_condition:
+        jobs_condition.wait(timeout)
+
+
+def get_jobs():
+    with jobs_condition:
+        return list(jobs.values())
+
+
+def get_stats():
+    """Return how many jobs have finished, and how many status checks and seconds they took in total (status checks for jobs that are still being tracked are counted too)"""
+    with jobs_condition:
+        current_stats = dict(stats)
+        for job in jobs.values():
+            current_stats["polls"] += job.num_polls
+        return current_stats
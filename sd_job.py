@@ -0,0 +1,222 @@
+import bpy
+import dataclasses
+import io
+import os
+from types import ModuleType
+from . import (
+    config,
+    temp_store,
+    utils,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class SDJob:
+    """A snapshot of everything needed to run one Stable Diffusion request.
+
+    Jobs are created in the main thread (from the scene properties and add-on
+    preferences) and are then safe to use from a background thread, because they
+    never read any Blender data again.
+    """
+
+    # the operation ("generate", "upscale", "inpaint" or "outpaint") and the backend
+    operation: str
+    backend: ModuleType
+    backend_name: str
+    image_format: str
+
+    # prompt and generation settings
+    prompt: str = ""
+    negative_prompt: str = ""
+    width: int = 0
+    height: int = 0
+    image_similarity: float = 0.0
+    seed: int = 0
+    use_random_seed: bool = False
+    cfg_scale: float = 0.0
+    steps: int = 0
+    sampler: str = ""
+    sd_model: str = ""
+
+    # controlnet (automatic1111 only)
+    controlnet_is_enabled: bool = False
+    controlnet_model: str = ""
+    controlnet_module: str = ""
+    controlnet_weight: float = 1.0
+
+    # upscaling
+    do_upscale: bool = False
+    upscale_factor: float = 2.0
+    upscaler_model: str = ""
+    upscaled_width: int = 0
+    upscaled_height: int = 0
+
+    # inpainting and outpainting
+    inpaint_full_res: bool = True
+    inpaint_padding: int = 32
+    outpaint_direction: str = "up"
+    outpaint_pixels_to_expand: int = 8
+    outpaint_mask_blur: int = 0
+    outpaint_noise_q: float = 1.0
+    outpaint_color_variation: float = 0.05
+
+    # server and account settings
+    local_sd_url: str = ""
+    local_sd_timeout: int = 360
+    server_pool: tuple = ()
+    http_pool_size: int = 4
+    dream_studio_api_key: str = ""
+    stable_horde_api_key: str = ""
+    show_progress_preview: bool = False
+
+    # input and output (output paths are absolute, and empty when not saving there)
+    input_file: str = ""
+    input_image_data: bytes = b""
+    upload_format: str = "PNG"
+    mask_file: str = ""
+    before_output_filename_prefix: str = ""
+    after_output_filename_prefix: str = ""
+    animation_output_filename_prefix: str = config.animation_output_filename_prefix
+    autosave_image_path: str = ""
+    animation_output_path: str = ""
+    frame: int = 1
+    is_animation_frame: bool = False
+    should_view_result: bool = True
+
+    # extra info (for analytics)
+    use_preset: bool = False
+    preset_style: str = ""
+    use_animated_prompts: bool = False
+    do_upscale_automatically: bool = False
+
+    def generation_params(self):
+        """Return a new dict of the generic params for a generate request"""
+        return {
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
+            "width": self.width,
+            "height": self.height,
+            "image_similarity": self.image_similarity,
+            "seed": self.seed,
+            "cfg_scale": self.cfg_scale,
+            "steps": self.steps,
+            "sampler": self.sampler,
+        }
+
+    def inpaint_params(self):
+        """Return a new dict of the generic params for an inpaint request"""
+        return {
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
+            "width": self.width,
+            "height": self.height,
+            "seed": self.seed,
+            "cfg_scale": self.cfg_scale,
+            "steps": self.steps,
+            "is_full_res": self.inpaint_full_res,
+            "full_res_padding": self.inpaint_padding,
+        }
+
+    def outpaint_params(self):
+        """Return a new dict of the generic params for an outpaint request"""
+        return {
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
+            "width": self.width,
+            "height": self.height,
+            "seed": self.seed,
+            "cfg_scale": self.cfg_scale,
+            "steps": self.steps,
+            "pixels": self.outpaint_pixels_to_expand,
+            "mask_blur": self.outpaint_mask_blur,
+            "directions": [self.outpaint_direction],
+            "noise_q": self.outpaint_noise_q,
+            "color_variation": self.outpaint_color_variation,
+        }
+
+    def open_input_file(self):
+        # the input image can be in memory (captured straight from the render) or in a file
+        if self.input_image_data:
+            input_file = io.BytesIO(self.input_image_data)
+            input_file.name = f"input.{utils.get_extension_from_file_format(self.upload_format)}"
+            return input_file
+
+        temp_store.touch(self.input_file)
+        return open(self.input_file, 'rb')
+
+    def open_mask_file(self):
+        return open(self.mask_file, 'rb')
+
+    def replace(self, **changes):
+        """Return a copy of this job with some values changed"""
+        return dataclasses.replace(self, **changes)
+
+
+def get_absolute_dir(path):
+    return os.path.abspath(bpy.path.abspath(path)) if path else ""
+
+
+def create_job(scene, operation, prompt="", negative_prompt="", **kwargs):
+    """Capture the scene properties and add-on preferences in a new SDJob (this must be called in the main thread)"""
+    props = scene.air_props
+    preferences = utils.get_addon_preferences()
+    backend = utils.get_active_backend()
+    is_animation_frame = props.is_rendering_animation_manually
+
+    job_values = {
+        "operation": operation,
+        "backend": backend,
+        "backend_name": preferences.sd_backend,
+        "image_format": backend.get_image_format().lower(),
+        "upload_format": backend.get_image_format(),
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "width": utils.get_output_width(scene),
+        "height": utils.get_output_height(scene),
+        "image_similarity": props.image_similarity,
+        "seed": props.seed,
+        "use_random_seed": props.use_random_seed,
+        "cfg_scale": props.cfg_scale,
+        "steps": props.steps,
+        "sampler": props.sampler,
+        "sd_model": props.sd_model,
+        "controlnet_is_enabled": props.controlnet_is_enabled,
+        "controlnet_model": props.controlnet_model,
+        "controlnet_module": props.controlnet_module,
+        "controlnet_weight": props.controlnet_weight,
+        "do_upscale": (
+            operation == "generate"
+            and props.do_upscale_automatically
+            and backend.supports_upscaling()
+            and backend.is_upscaler_model_list_loaded()
+        ),
+        "upscale_factor": props.upscale_factor,
+        "upscaler_model": props.upscaler_model,
+        "upscaled_width": utils.sanitized_upscaled_width(backend.max_upscaled_image_size(), scene),
+        "upscaled_height": utils.sanitized_upscaled_height(backend.max_upscaled_image_size(), scene),
+        "inpaint_full_res": props.inpaint_full_res,
+        "inpaint_padding": props.inpaint_padding,
+        "outpaint_direction": props.outpaint_direction,
+        "outpaint_pixels_to_expand": props.outpaint_pixels_to_expand,
+        "outpaint_mask_blur": props.outpaint_mask_blur,
+        "outpaint_noise_q": props.outpaint_noise_q,
+        "outpaint_color_variation": props.outpaint_color_variation,
+        "local_sd_url": preferences.local_sd_url,
+        "local_sd_timeout": preferences.local_sd_timeout,
+        "server_pool": utils.get_server_pool(),
+        "http_pool_size": utils.get_http_pool_size(),
+        "dream_studio_api_key": preferences.dream_studio_api_key,
+        "stable_horde_api_key": preferences.stable_horde_api_key,
+        "show_progress_preview": preferences.automatic1111_show_progress_preview,
+        "autosave_image_path": get_absolute_dir(props.autosave_image_path) if utils.should_autosave_after_image(props) else "",
+        "animation_output_path": get_absolute_dir(props.animation_output_path) if is_animation_frame else "",
+        "frame": scene.frame_current,
+        "is_animation_frame": is_animation_frame,
+        "use_preset": props.use_preset,
+        "preset_style": props.preset_style,
+        "use_animated_prompts": props.use_animated_prompts,
+        "do_upscale_automatically": props.do_upscale_automatically,
+    }
+    job_values.update(kwargs)
+
+    return SDJob(**job_values)
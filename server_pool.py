@@ -0,0 +1,259 @@
+import random
+import threading
+import time
+from . import (
+    config,
+    http_sessions,
+    operators,
+)
+
+
+# errors that mean a server in the pool is down or misconfigured (rather than a
+# problem with the request itself), so the server is taken out of the pool and the
+# request is tried on another server
+SERVER_FAILURE_ERROR_KEYS = [
+    "local_server_not_found",
+    "local_server_url_invalid",
+    "automatic1111_not_in_api_mode",
+]
+
+# errors that could be the server's fault or the request's (e.g. a request that takes
+# too long anywhere). the request is tried on another server, but a server is only
+# taken out of the pool after several of these in a row
+POSSIBLE_SERVER_FAILURE_ERROR_KEYS = [
+    "unknown_error_response",
+    "timeout",
+]
+
+
+class PoolServer:
+    """The runtime state of one server in the pool"""
+
+    def __init__(self, url, weight=1, max_concurrency=1):
+        self.url = url
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.num_outstanding = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_consecutive_failures = 0
+        self.is_healthy = True
+        self.last_error = ""
+
+    def load(self):
+        return (self.num_outstanding + 1) / max(self.weight, 1)
+
+    def has_capacity(self):
+        return self.is_healthy and self.num_outstanding < self.max_concurrency
+
+
+# private
+servers = {}
+servers_condition = threading.Condition()
+health_check_thread = None
+
+
+def update_servers(server_pool):
+    # add new servers and update the settings of existing ones, keeping their state
+    for url, weight, max_concurrency in server_pool:
+        if url not in servers:
+            servers[url] = PoolServer(url, weight, max_concurrency)
+        else:
+            servers[url].weight = weight
+            servers[url].max_concurrency = max_concurrency
+
+
+def acquire_server(server_pool, excluded_urls=()):
+    """Choose the healthy server with the fewest outstanding requests (relative to its weight), waiting for a free slot if they're all busy. Servers in excluded_urls aren't used. Returns None if no other servers are healthy"""
+    urls = [server[0] for server in server_pool if server[0] not in excluded_urls]
+
+    with servers_condition:
+        update_servers(server_pool)
+
+        while True:
+            pool_servers = [servers[url] for url in urls]
+            healthy_servers = [server for server in pool_servers if server.is_healthy]
+            if not healthy_servers:
+                return None
+
+            available_servers = [server for server in healthy_servers if server.has_capacity()]
+            if available_servers:
+                lowest_load = min(server.load() for server in available_servers)
+                server = random.choice([server for server in available_servers if server.load() == lowest_load])
+                server.num_outstanding += 1
+                return server
+
+            servers_condition.wait(timeout=1)
+
+
+def release_server(server, was_successful, error=None, is_server_down=False):
+    """Give back a server after a request. An error is a failure that might be the server's fault. The server is taken out of the pool if it's down, or after several of these in a row"""
+    with servers_condition:
+        server.num_outstanding -= 1
+        if was_successful:
+            server.num_completed += 1
+        else:
+            server.num_failed += 1
+
+        if error:
+            server.num_consecutive_failures += 1
+        else:
+            server.num_consecutive_failures = 0
+
+        # take a failing server out of the pool (the health check will bring it back
+        # when it's working again)
+        if error and server.is_healthy and (is_server_down or server.num_consecutive_failures >= config.server_pool_max_consecutive_failures):
+            server.is_healthy = False
+            server.last_error = error
+            print(f"AI Render: Removing {server.url} from the server pool ({error})")
+            ensure_health_check_thread()
+
+        servers_condition.notify_all()
+
+
+def is_server_failure(errors):
+    return any(error_key in SERVER_FAILURE_ERROR_KEYS for msg, error_key in errors)
+
+
+def is_possible_server_failure(errors):
+    return any(error_key in POSSIBLE_SERVER_FAILURE_ERROR_KEYS for msg, error_key in errors)
+
+
+def get_error_keys(errors):
+    return {error_key for msg, error_key in errors}
+
+
+def report_errors(errors):
+    for msg, error_key in errors:
+        operators.handle_error(msg, error_key)
+    return False
+
+
+def check_server(url, timeout=config.server_pool_health_check_timeout):
+    """Return True if the server responds at all (any response that isn't a server error)"""
+    try:
+        response = http_sessions.get_session("server_pool").get(url.rstrip("/") + "/sdapi/v1/progress?skip_current_image=true", timeout=timeout)
+        return response.status_code < 500
+    except:
+        return False
+
+
+def check_servers(urls=None):
+    """Check the health of the given servers (or all known servers), and update their state"""
+    with servers_condition:
+        if urls is None:
+            urls = list(servers.keys())
+        for url in urls:
+            if url not in servers:
+                servers[url] = PoolServer(url)
+
+    results = {url: check_server(url) for url in urls}
+
+    with servers_condition:
+        for url, is_healthy in results.items():
+            server = servers[url]
+            if is_healthy and not server.is_healthy:
+                print(f"AI Render: Adding {url} back to the server pool")
+            server.is_healthy = is_healthy
+            if is_healthy:
+                server.last_error = ""
+            elif not server.last_error:
+                server.last_error = "health check failed"
+        servers_condition.notify_all()
+
+    return results
+
+
+def run_health_checks():
+    global health_check_thread
+
+    while True:
+        time.sleep(config.server_pool_health_check_interval)
+
+        with servers_condition:
+            unhealthy_urls = [server.url for server in servers.values() if not server.is_healthy]
+            if not unhealthy_urls:
+                health_check_thread = None
+                return
+
+        check_servers(unhealthy_urls)
+
+
+def ensure_health_check_thread():
+    # NOTE: Must be called while holding servers_condition
+    global health_check_thread
+
+    if health_check_thread is None:
+        health_check_thread = threading.Thread(target=run_health_checks, daemon=True)
+        health_check_thread.start()
+
+
+# public methods
+def run_request(job, request_function):
+    """Run request_function(job) on a server from the job's server pool, trying other servers if one fails. Without a pool, this just runs request_function(job)"""
+    if not job.server_pool:
+        return request_function(job)
+
+    # the servers this request has been tried on, and the errors from the first one
+    tried_urls = set()
+    first_errors = None
+
+    while True:
+        server = acquire_server(job.server_pool, tried_urls)
+        if not server:
+            # if the request failed on every server it was tried on, report why it
+            # failed the first time
+            if first_errors:
+                return report_errors(first_errors)
+            return operators.handle_error(
+                "None of the servers in your server pool are available. Check that they're running, and check the server pool in the add-on preferences.",
+                "server_pool_unavailable",
+            )
+
+        tried_urls.add(server.url)
+
+        # run the request on this server, collecting any errors so that we can decide
+        # whether to try another server
+        with operators.capture_errors() as errors:
+            result = request_function(job.replace(local_sd_url=server.url))
+
+        if result:
+            release_server(server, True)
+            return result
+
+        # if the server is down, take it out of the pool and try another one
+        if is_server_failure(errors):
+            release_server(server, False, errors[-1][0], is_server_down=True)
+            first_errors = first_errors or errors
+            continue
+
+        # if it might be the server's fault, try another one. but if the request fails the
+        # same way there too, it's probably the request, so stop and report the error
+        if is_possible_server_failure(errors):
+            release_server(server, False, errors[-1][0])
+            if first_errors and get_error_keys(errors) & get_error_keys(first_errors):
+                return report_errors(first_errors)
+            first_errors = first_errors or errors
+            continue
+
+        # otherwise, the request itself was the problem, so show the error and stop
+        release_server(server, False)
+        return report_errors(errors)
+
+
+def get_server_status(url):
+    """Return a short status for a server in the pool, for the ui"""
+    with servers_condition:
+        server = servers.get(url.strip())
+        if not server:
+            return "Not used yet"
+        elif not server.is_healthy:
+            return f"Down ({server.last_error})" if server.last_error else "Down"
+        else:
+            return f"OK ({server.num_outstanding} running, {server.num_completed} done, {server.num_failed} failed)"
+
+
+def is_server_healthy(url):
+    with servers_condition:
+        server = servers.get(url.strip())
+        return server is None or server.is_healthy
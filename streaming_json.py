@@ -0,0 +1,253 @@
+import base64
+import json
+
+
+# read a multiple of 3 bytes at a time, so the base64 chunks can be joined without padding
+BASE64_READ_SIZE = 3 * 64 * 1024
+
+
+class Base64File:
+    """A value in a json request body that's a file, base64 encoded as a string. The file is only read (in chunks) while the body is being sent"""
+
+    def __init__(self, file, prefix="data:image/png;base64,"):
+        self.file = file
+        self.prefix = prefix
+
+    def get_size(self):
+        """Return the length of the encoded json string, including the quotes"""
+        position = self.file.tell()
+        self.file.seek(0, 2)
+        file_size = self.file.tell() - position
+        self.file.seek(position)
+
+        return len(json.dumps(self.prefix)) + 4 * ((file_size + 2) // 3)
+
+    def iter_chunks(self):
+        # the prefix and the base64 alphabet never need escaping in json
+        yield json.dumps(self.prefix)[:-1].encode()
+        while True:
+            chunk = self.file.read(BASE64_READ_SIZE)
+            if not chunk:
+                break
+            yield base64.b64encode(chunk)
+        yield b'"'
+
+    def close(self):
+        self.file.close()
+
+
+class JSONBody:
+    """A json request body that can be streamed to requests (as `data=`). Any Base64File values are encoded while the body is sent, so the whole body is never in memory at once"""
+
+    def __init__(self, value):
+        self.parts = []
+        self.add_value(value)
+
+    def add_bytes(self, data):
+        # merge neighbouring bytes, so the body is sent in as few chunks as possible
+        if self.parts and isinstance(self.parts[-1], bytes):
+            self.parts[-1] += data
+        else:
+            self.parts.append(data)
+
+    def add_value(self, value):
+        if isinstance(value, Base64File):
+            self.parts.append(value)
+        elif isinstance(value, dict):
+            self.add_bytes(b"{")
+            for i, (key, item) in enumerate(value.items()):
+                self.add_bytes((", " if i else "").encode() + json.dumps(str(key)).encode() + b": ")
+                self.add_value(item)
+            self.add_bytes(b"}")
+        elif isinstance(value, (list, tuple)):
+            self.add_bytes(b"[")
+            for i, item in enumerate(value):
+                if i:
+                    self.add_bytes(b", ")
+                self.add_value(item)
+            self.add_bytes(b"]")
+        else:
+            self.add_bytes(json.dumps(value).encode())
+
+    def __len__(self):
+        # requests uses this to send a Content-Length header instead of a chunked body
+        return sum(part.get_size() if isinstance(part, Base64File) else len(part) for part in self.parts)
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, Base64File):
+                yield from part.iter_chunks()
+            else:
+                yield part
+
+    def close(self):
+        """Close the files in the body"""
+        for part in self.parts:
+            if isinstance(part, Base64File):
+                part.close()
+
+
+# the size of the chunks the response is read in
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# how much of the start of a response is kept, for printing when it isn't what we expected
+RESPONSE_HEAD_SIZE = 1024
+
+QUOTE = ord('"')
+BACKSLASH = ord("\\")
+WHITESPACE = b" \t\r\n"
+
+
+class ImageResponseDecoder:
+    """Incrementally parse a json response (fed in chunks) and base 64 decode the first image in it straight into output_file. Only the top level fields in keep_keys are parsed; everything else is skipped"""
+
+    def __init__(self, output_file, image_keys=("images", "image"), keep_keys=()):
+        self.output_file = output_file
+        self.image_keys = image_keys
+        self.keep_keys = keep_keys
+
+        self.fields = {}
+        self.image_size = 0
+        self.has_image = False
+        self.head = b""
+
+        self.depth = 0
+        self.is_expecting_key = False
+        self.key = None
+        self.is_in_string = False
+        self.is_escaped = False
+        self.string_kind = None
+        self.key_parts = []
+        self.kept_parts = None
+        self.kept_from = 0
+        self.base64_buffer = b""
+        self.has_checked_prefix = False
+
+    # parsing
+    def feed(self, data):
+        if len(self.head) < RESPONSE_HEAD_SIZE:
+            self.head += data[:RESPONSE_HEAD_SIZE - len(self.head)]
+
+        i = 0
+        while i < len(data):
+            if self.is_in_string:
+                i = self.feed_string(data, i)
+                continue
+
+            char = data[i]
+            if char == QUOTE:
+                self.start_string()
+            elif char in b"{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.is_expecting_key = char == ord("{")
+            elif char in b"}]":
+                if self.depth == 1:
+                    self.end_value(data, i)
+                self.depth -= 1
+            elif self.depth == 1 and char == ord(":"):
+                self.is_expecting_key = False
+                if self.key in self.keep_keys:
+                    self.kept_parts = []
+                    self.kept_from = i + 1
+            elif self.depth == 1 and char == ord(","):
+                self.end_value(data, i)
+                self.is_expecting_key = True
+            i += 1
+
+        # keep the part of a kept field that's in this chunk
+        if self.kept_parts is not None:
+            self.kept_parts.append(data[self.kept_from:])
+            self.kept_from = 0
+
+    def start_string(self):
+        self.is_in_string = True
+        if self.depth == 1 and self.is_expecting_key:
+            self.string_kind = "key"
+            self.key_parts = []
+        elif not self.has_image and self.key in self.image_keys and self.depth <= 2:
+            self.string_kind = "image"
+        else:
+            self.string_kind = "skip"
+
+    def feed_string(self, data, i):
+        """Consume string contents from data[i:], and return the index to continue from"""
+        if self.is_escaped:
+            self.is_escaped = False
+            self.add_string_content(b"\\" + data[i:i + 1], is_escape=True)
+            i += 1
+
+        # find the end of the string (or an escape) without looking at every byte
+        end = data.find(b'"', i)
+        escape = data.find(b"\\", i, end if end != -1 else len(data))
+        stop = escape if escape != -1 else end
+
+        if stop == -1:
+            self.add_string_content(data[i:])
+            return len(data)
+
+        self.add_string_content(data[i:stop])
+        if stop == escape:
+            if escape + 1 < len(data):
+                self.add_string_content(data[escape:escape + 2], is_escape=True)
+                return escape + 2
+            self.is_escaped = True
+            return len(data)
+
+        self.end_string()
+        return end + 1
+
+    def add_string_content(self, content, is_escape=False):
+        if self.string_kind == "key":
+            self.key_parts.append(content)
+        elif self.string_kind == "image":
+            # base 64 only needs "/" to be escaped (the rest of the escapes aren't in its alphabet)
+            if is_escape:
+                content = b"/" if content == b"\\/" else b""
+            self.add_base64(content)
+
+    def end_string(self):
+        self.is_in_string = False
+        if self.string_kind == "key":
+            self.key = json.loads(b'"' + b"".join(self.key_parts) + b'"')
+        elif self.string_kind == "image":
+            self.add_base64(b"", is_final=True)
+            self.has_image = True
+
+    def end_value(self, data, i):
+        if self.kept_parts is not None:
+            self.kept_parts.append(data[self.kept_from:i])
+            self.fields[self.key] = json.loads(b"".join(self.kept_parts))
+            self.kept_parts = None
+        self.key = None
+
+    # decoding
+    def add_base64(self, content, is_final=False):
+        self.base64_buffer += content
+
+        # strip a data url prefix, like "data:image/png;base64,"
+        if not self.has_checked_prefix:
+            if len(self.base64_buffer) < 64 and not is_final:
+                return
+            if self.base64_buffer.startswith(b"data:"):
+                self.base64_buffer = self.base64_buffer[self.base64_buffer.find(b",") + 1:]
+            self.has_checked_prefix = True
+
+        # decode whole groups of 4 characters, and keep the rest for later
+        end = len(self.base64_buffer) if is_final else len(self.base64_buffer) - len(self.base64_buffer) % 4
+        if end:
+            decoded = base64.b64decode(self.base64_buffer[:end], validate=True)
+            self.output_file.write(decoded)
+            self.image_size += len(decoded)
+            self.base64_buffer = self.base64_buffer[end:]
+
+
+def decode_image_response(response, output_file, keep_keys=()):
+    """Read a response (requested with stream=True) and decode its image into output_file as it arrives. Returns the decoder, with its has_image, image_size and (kept) fields"""
+    decoder = ImageResponseDecoder(output_file, keep_keys=keep_keys)
+    try:
+        for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+            decoder.feed(chunk)
+    finally:
+        response.close()
+    return decoder
@@ -1,24 +1,77 @@
 import bpy
+import functools
 import queue
+import threading
+import time
+import traceback
 from bpy.app.handlers import persistent
 
 
 # private
 execution_queue = queue.Queue()
+background_threads = set()
+background_threads_lock = threading.Lock()
 
 def execute_queued_functions():
     while not execution_queue.empty():
         function = execution_queue.get()
-        function()
+
+        # an error in one function mustn't stop the rest (blender unregisters a timer
+        # that raises, and then no more results would be processed)
+        try:
+            function()
+        except:
+            print("AI Render: Error in queued task")
+            traceback.print_exc()
     return 0.2
 
 
-# public method
+def run_in_background(function, on_complete):
+    try:
+        result = function()
+    except:
+        print("AI Render: Error in background task")
+        traceback.print_exc()
+        result = False
+
+    # hand the result back to the main thread
+    if on_complete:
+        add(functools.partial(on_complete, result))
+
+    with background_threads_lock:
+        background_threads.discard(threading.current_thread())
+
+
+# public methods
 def add(function):
     """Add a function to the task queue, to be executed in the main thread"""
     execution_queue.put(function)
 
 
+def add_background(function, on_complete=None):
+    """Run a function on a background thread. When it finishes, on_complete (if given) is called with its return value in the main thread"""
+    thread = threading.Thread(target=run_in_background, args=(function, on_complete), daemon=True)
+    with background_threads_lock:
+        background_threads.add(thread)
+    thread.start()
+
+
+def wait_for_background_tasks():
+    """Block until every background task has finished, running the queued functions as they come in. This is for background mode (blender -b), where the timer that normally runs the queue doesn't run during a render"""
+    while num_background_tasks() > 0 or not execution_queue.empty():
+        execute_queued_functions()
+        time.sleep(0.2)
+
+
+def is_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+
+def num_background_tasks():
+    with background_threads_lock:
+        return len(background_threads)
+
+
 def register():
     if not bpy.app.timers.is_registered(execute_queued_functions):
         bpy.app.timers.register(execute_queued_functions)
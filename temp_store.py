@@ -0,0 +1,164 @@
+import atexit
+import bpy
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+from . import (
+    config,
+    task_queue,
+    utils,
+    write_queue,
+)
+
+
+# temp files in the store, least recently used first (path -> time it was created)
+files = collections.OrderedDict()
+files_lock = threading.Lock()
+
+stats = {
+    "created": 0,
+    "hits": 0,
+    "evictions": 0,
+    "evicted_bytes": 0,
+}
+
+
+def get_stores_dir():
+    return os.path.join(tempfile.gettempdir(), config.tmp_path_subfolder)
+
+
+def get_store_dir():
+    # each blender instance gets its own folder, so instances never evict (or clean up)
+    # each other's files
+    return os.path.join(get_stores_dir(), str(os.getpid()))
+
+
+def remove_stale_stores():
+    """Delete the folders left behind by blender instances that have quit or crashed (unregister isn't called when blender quits)"""
+    try:
+        names = os.listdir(get_stores_dir())
+    except OSError:
+        return
+
+    for name in names:
+        if name.isdigit() and not utils.is_process_running(int(name)):
+            print(f"AI Render: Removing temp files left by a previous session ({name})")
+            shutil.rmtree(os.path.join(get_stores_dir(), name), ignore_errors=True)
+
+
+def is_in_store(path):
+    if not path:
+        return False
+    return os.path.dirname(os.path.abspath(path)) == get_store_dir()
+
+
+def get_protected_paths():
+    """Return the paths of temp files that are still in use (the last generated image in any scene, and any loaded image)"""
+    paths = set()
+    for scene in bpy.data.scenes:
+        if hasattr(scene, "air_props") and scene.air_props.last_generated_image_filename:
+            paths.add(os.path.abspath(scene.air_props.last_generated_image_filename))
+    for img in bpy.data.images:
+        if img.filepath_raw:
+            paths.add(os.path.abspath(bpy.path.abspath(img.filepath_raw)))
+    return paths
+
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def evict(max_size, protected_paths):
+    """Delete the least recently used files until the store is under max_size bytes. Protected files, and files that are new enough that they may still be the input of a request, are kept"""
+    with files_lock:
+        sizes = {path: get_file_size(path) for path in files}
+        total_size = sum(sizes.values())
+        min_created_time = time.time() - config.temp_store_min_file_age
+
+        for path, created_time in list(files.items()):
+            if total_size <= max_size:
+                break
+            if path in protected_paths or created_time > min_created_time:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"AI Render: Couldn't remove temp file {path} ({e})")
+                continue
+
+            del files[path]
+            total_size -= sizes[path]
+            stats["evictions"] += 1
+            stats["evicted_bytes"] += sizes[path]
+
+
+# public methods
+def create_file(prefix, suffix=".png"):
+    """Create an empty temp file in the store (making room for it first), and return its path"""
+    # making room reads blender data, so it's only done in the main thread. files created
+    # in a background thread are counted the next time
+    if task_queue.is_main_thread():
+        evict(utils.get_addon_preferences().temp_store_max_size * 1024 * 1024, get_protected_paths())
+
+    os.makedirs(get_store_dir(), exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=get_store_dir())
+    os.close(fd)
+
+    with files_lock:
+        files[path] = time.time()
+        stats["created"] += 1
+    return path
+
+
+def touch(path):
+    """Mark a temp file as just used, so it's evicted last. Returns True if the file is in the store"""
+    with files_lock:
+        path = os.path.abspath(path)
+        if path not in files:
+            return False
+        files.move_to_end(path)
+        stats["hits"] += 1
+        return True
+
+
+def get_stats():
+    with files_lock:
+        return {
+            **stats,
+            "files": len(files),
+            "bytes": sum(get_file_size(path) for path in files),
+        }
+
+
+def clear():
+    """Delete the store's folder and everything in it"""
+    with files_lock:
+        files.clear()
+    shutil.rmtree(get_store_dir(), ignore_errors=True)
+
+
+def clear_on_exit():
+    # finish writing any files that are being copied out of the store first
+    write_queue.flush(should_run_callbacks=False)
+    clear()
+
+
+def register():
+    remove_stale_stores()
+
+    # clean up when blender quits, too
+    atexit.register(clear_on_exit)
+
+
+def unregister():
+    atexit.unregister(clear_on_exit)
+    clear()
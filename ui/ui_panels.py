@@ -813,6 +813,40 @@ class AIR_PT_animation(bpy.types.Panel):
         row = layout.row()
         row.prop(props, "animation_output_path", text="Path")
 
+        # Pipelining
+        row = layout.row()
+        row.prop(props, "animation_lookahead_frames")
+
+        # Failures and Resuming
+        row = layout.row()
+        row.prop(props, "animation_max_retries")
+
+        row = layout.row()
+        row.prop(props, "animation_failure_policy", text="If a Frame Fails")
+
+        row = layout.row()
+        row.prop(props, "resume_animation", text="Resume Previous Render")
+
+        row = layout.row()
+        row.prop(props, "use_native_animation_render")
+
+        # Sharing frames with other instances
+        row = layout.row()
+        row.prop(props, "animation_shard_mode", text="Share Frames")
+
+        if props.animation_shard_mode == "index":
+            row = layout.row(align=True)
+            row.prop(props, "animation_shard_index", text="Index")
+            row.prop(props, "animation_shard_count", text="Count")
+
+        row = layout.row()
+        row.operator(operators.AIR_OT_verify_animation_frames.bl_idname, icon="CHECKMARK")
+        row.enabled = is_animation_enabled_button_enabled
+
+        row = layout.row()
+        row.operator(operators.AIR_OT_render_failed_animation_frames.bl_idname, icon="FILE_REFRESH")
+        row.enabled = is_animation_enabled_button_enabled
+
         # Animated Prompts
         layout.separator()
 
@@ -20,12 +20,13 @@
 import bpy
 import re
 import os
-import shutil
 import math
 import platform
 import time
-import tempfile
-from . import config
+from . import (
+    config,
+    temp_store,
+)
 from .sd_backends import (
     automatic1111_api,
     stability_api,
@@ -51,7 +52,34 @@ def get_addon_preferences(context=None):
 
 
 def create_temp_file(prefix, suffix=".png"):
-    return tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix).name
+    return temp_store.create_file(prefix, suffix)
+
+
+def is_process_running(pid):
+    if pid == os.getpid():
+        return True
+
+    if platform.system() == "Windows":
+        # (os.kill would end the process on windows)
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5  # ERROR_ACCESS_DENIED (it exists, but isn't ours)
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
 
 
 def sanitize_filename(filename, extra_length=0):
@@ -99,6 +127,27 @@ def get_image_format(to_lower = True):
     return image_format.lower() if to_lower else image_format
 
 
+def get_http_pool_size(context=None):
+    """Return how many connections to keep alive to the active backend (by default, enough for every frame in flight, plus a couple for status checks)"""
+    preferences = get_addon_preferences(context)
+    if preferences.http_pool_size:
+        return preferences.http_pool_size
+    return get_active_backend().max_in_flight_frames() + config.http_pool_extra_connections
+
+
+def get_upload_settings(context=None):
+    preferences = get_addon_preferences(context)
+    return getattr(preferences, f"{preferences.sd_backend}_upload_settings")
+
+
+def get_upload_format(context=None):
+    """Return the file format rendered images are uploaded to the active backend in (like "PNG")"""
+    upload_settings = get_upload_settings(context)
+    if upload_settings.image_format == "DEFAULT":
+        return get_image_format(to_lower=False)
+    return upload_settings.image_format
+
+
 def should_autosave_after_image(props):
     # return true to signify we should autosave the after image, if that setting is on,
     # and the path is valid, and we're not rendering an animation
@@ -125,6 +174,14 @@ def does_path_exist(path):
     return os.path.exists(os.path.abspath(bpy.path.abspath(path)))
 
 
+def is_file_readable(file_path):
+    return os.path.isfile(file_path) and os.access(file_path, os.R_OK)
+
+
+def get_animation_frame_filename(filename_prefix, frame, image_format):
+    return f"{filename_prefix}{str(frame).zfill(4)}.{image_format}"
+
+
 def get_filename_from_path(file_path, include_extension=True):
     filename_and_extension = os.path.splitext(os.path.basename(file_path))
     if include_extension:
@@ -133,10 +190,6 @@ def get_filename_from_path(file_path, include_extension=True):
         return filename_and_extension[0]
 
 
-def copy_file(src, dest):
-    shutil.copy2(src, dest)
-
-
 def get_preset_style_thumnails_filepath():
     return get_filepath_in_package("style_thumbnails")
 
@@ -268,6 +321,23 @@ def local_sd_timeout(context=None):
     return get_addon_preferences(context).local_sd_timeout
 
 
+def get_server_pool(context=None):
+    """Return the enabled servers in the pool as a tuple of (url, weight, max_concurrency), or an empty tuple if the pool isn't in use"""
+    preferences = get_addon_preferences(context)
+    if not preferences.use_server_pool or preferences.sd_backend not in ["automatic1111", "shark"]:
+        return ()
+
+    return tuple(
+        (server.url.strip(), server.weight, server.max_concurrency)
+        for server in preferences.server_pool
+        if server.is_enabled and server.url.strip()
+    )
+
+
+def server_pool_capacity(context=None):
+    return max(1, sum(server[2] for server in get_server_pool(context)))
+
+
 def get_output_width(scene):
     return round(scene.render.resolution_x * scene.render.resolution_percentage / 100)
 
@@ -0,0 +1,153 @@
+import collections
+import functools
+import os
+import shutil
+import threading
+import traceback
+import uuid
+from . import (
+    config,
+    task_queue,
+)
+
+
+# writes waiting for the background thread, oldest first
+pending_writes = collections.deque()
+pending_bytes = 0
+num_unfinished = 0
+writes_condition = threading.Condition()
+worker = None
+
+
+class FileWrite:
+    """A file to write in the background: either data, or a copy of an existing file (source_path)"""
+
+    def __init__(self, file_path, data=None, source_path="", should_move=False, on_done=None, on_error=None):
+        self.file_path = file_path
+        self.data = data
+        self.source_path = source_path
+        self.should_move = should_move
+        self.on_done = on_done
+        self.on_error = on_error
+
+    def get_size(self):
+        return len(self.data) if self.data is not None else 0
+
+
+def is_same_filesystem(source_path, file_path):
+    try:
+        return os.stat(source_path).st_dev == os.stat(os.path.dirname(file_path) or ".").st_dev
+    except OSError:
+        return False
+
+
+def create_temp_path(file_path):
+    # a temp file next to the final file, so it can be renamed into place atomically. (it's
+    # not created with tempfile, so it gets the usual permissions rather than 0600)
+    return os.path.join(os.path.dirname(file_path), f".ai-render-{uuid.uuid4().hex}.tmp")
+
+
+def write_file(write):
+    """Write a file so it appears all at once (other instances and resumed renders never see a partial image)"""
+    if write.source_path and is_same_filesystem(write.source_path, write.file_path):
+        if write.should_move:
+            os.replace(write.source_path, write.file_path)
+            return
+
+        # a hard link costs nothing, but not every filesystem supports them
+        temp_path = create_temp_path(write.file_path)
+        try:
+            os.link(write.source_path, temp_path)
+            os.replace(temp_path, write.file_path)
+            return
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    temp_path = create_temp_path(write.file_path)
+    try:
+        if write.data is not None:
+            with open(temp_path, "xb") as file:
+                file.write(write.data)
+        else:
+            shutil.copyfile(write.source_path, temp_path)
+        os.replace(temp_path, write.file_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if write.should_move:
+        os.remove(write.source_path)
+
+
+def run_writes():
+    global pending_bytes, num_unfinished
+
+    while True:
+        with writes_condition:
+            while not pending_writes:
+                writes_condition.wait()
+            write = pending_writes.popleft()
+
+        try:
+            write_file(write)
+            callback = functools.partial(write.on_done, write.file_path) if write.on_done else None
+        except Exception as e:
+            print(f"AI Render: Couldn't write {write.file_path} ({e})")
+            traceback.print_exc()
+            callback = functools.partial(write.on_error, str(e)) if write.on_error else None
+
+        # hand the result back to the main thread
+        if callback:
+            task_queue.add(callback)
+
+        with writes_condition:
+            pending_bytes -= write.get_size()
+            num_unfinished -= 1
+            writes_condition.notify_all()
+
+
+def start_worker():
+    global worker
+
+    if not worker or not worker.is_alive():
+        worker = threading.Thread(target=run_writes, daemon=True)
+        worker.start()
+
+
+# public methods
+def add(file_path, data=None, source_path="", should_move=False, on_done=None, on_error=None):
+    """Write data (or copy/move the file at source_path) to file_path in the background. on_done is called with the path, or on_error with an error message, in the main thread. If too much data is already waiting to be written, this blocks until there's room"""
+    global pending_bytes, num_unfinished
+
+    write = FileWrite(file_path, data, source_path, should_move, on_done, on_error)
+    start_worker()
+
+    with writes_condition:
+        while num_unfinished and pending_bytes + write.get_size() > config.write_queue_max_bytes:
+            writes_condition.wait()
+
+        pending_writes.append(write)
+        pending_bytes += write.get_size()
+        num_unfinished += 1
+        writes_condition.notify_all()
+
+
+def flush(should_run_callbacks=True):
+    """Block until every queued write has finished, and (in the main thread) run their callbacks"""
+    with writes_condition:
+        while num_unfinished:
+            writes_condition.wait()
+
+    if should_run_callbacks and task_queue.is_main_thread():
+        task_queue.execute_queued_functions()
+
+
+def num_pending_writes():
+    with writes_condition:
+        return num_unfinished
+
+
+def unregister():
+    flush(should_run_callbacks=False)